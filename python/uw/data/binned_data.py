@@ -4,9 +4,8 @@ Duplicates the functionality of the C++ class BinnedPhotonData
 Implements the new standard data format
 http://gamma-astro-data-formats.readthedocs.io/en/latest/skymaps/healpix/index.html#hpx-bands-table
 """
-import os, glob, StringIO, pickle
+import os, glob, StringIO, pickle, copy
 import healpy
-from collections import Counter 
 import numpy as np
 from astropy.io import fits
 import pandas as pd
@@ -129,6 +128,17 @@ class BandList(object):
         df.nside = df.nside.astype(int)
         return df
     
+def merge_counts(keys, counts):
+    """Sum the counts for equal keys
+    keys, counts : arrays of int
+    returns a tuple of arrays (unique sorted keys, summed counts)
+    """
+    order = np.argsort(keys, kind='mergesort')
+    keys, counts = keys[order], counts[order]
+    if len(keys)==0: return keys, counts
+    starts = np.flatnonzero(np.hstack([[True], keys[1:]!=keys[:-1]]))
+    return keys[starts], np.add.reduceat(counts, starts)
+
 class Pixels(object):
     """The list of pixels
     Each line is a pixel, with a HEALPix index, a channel index, and the number of photons in the pixel 
@@ -156,39 +166,31 @@ class Pixels(object):
             self.pix = pixeldata.field('PIX')     # pixel index (depends on channel)
             self.cnt = pixeldata.field('VALUE')   # number of photons in bin
         
-        self.counter = None
         self._sorted = False
 
-    def _make_counter(self):
-        # Make a Counter, with keys combined from channel and pixel id
-        if self.counter is None:
-            chn = np.array(self.chn,int) # convert to int for shift
-            keys = list(np.left_shift(chn,32) + self.pix)
-            self.counter = Counter(dict(zip(keys, self.cnt)))
-        return self.counter
+    def keys(self):
+        """return an int64 array of keys combined from channel and pixel id
+        """
+        return np.left_shift(np.asarray(self.chn, np.int64), 32) + np.asarray(self.pix, np.int64)
+
+    def set_keys(self, keys, cnt):
+        """replace the pixels with arrays of keys, as returned by keys(), and counts
+        """
+        self.chn = np.right_shift(keys,32)
+        self.pix = np.bitwise_and(keys, 2**32-1)
+        self.cnt = cnt
+        self._sorted = False
  
     def add(self, other):
         """combine the current list of pixels with another
         other : Pixels object
         """
-        # combine the pixels by updating the Counter dictionary-like objects
-        self._make_counter() # create local Counter only if adding another
-        self.counter.update(other._make_counter())
-    
-    def _decode_counter(self):
-        # Update the three arrays following adding another set of data
-        assert self.counter is not None, 'logic failure'
-        items = np.array(self.counter.items(), int)
-        keys = items[:,0]
-        self.chn = np.right_shift(keys,32)
-        self.pix = np.bitwise_and(keys, 2**32-1)
-        self.cnt = items[:,1]
+        self.set_keys(*merge_counts(np.hstack([self.keys(), other.keys()]),
+                np.hstack([np.asarray(self.cnt, np.int64), np.asarray(other.cnt, np.int64)])))
 
     def dataframe(self):
         """return a DataFrame with number of pixels and photons per channel
         """
-        if self.counter is not None:
-            self._decode_counter()
         channels = sorted(list(set(self.chn))); 
         d = dict()
         for channel in channels:
@@ -202,8 +204,6 @@ class Pixels(object):
         """return a list of (pixel, count) pairs for the band 
         """
         if not self._sorted:
-            if self.counter is not None:
-                self._decode_counter()
             # sort the list of pixels according to channel number (band)
             # create a lookup dictionary with limits for the pixel and count lists
             csort = self.chn.argsort()
@@ -224,9 +224,6 @@ class Pixels(object):
         """ create a new HDU in new format
             
         """
-        if self.counter is not None:
-            # needed it result of combining
-            self._decode_counter()
         skymap_cols = [
             fits.Column(name='PIX', format='J',    array=self.pix),
             fits.Column(name='CHANNEL', format='I',array=self.chn),
@@ -244,10 +241,7 @@ class Pixels(object):
         return skymap_hdu
     
     def __repr__(self):
-        if self.counter is not None:
-            npix, nphot = len(self.counter), sum(self.counter.values())
-        else:
-            npix, nphot = len(self.cnt), sum(self.cnt)
+        npix, nphot = len(self.cnt), sum(self.cnt)
         return '{}: {:,} pixels, {:,} photons'.format(self.__class__, npix, nphot) 
 
 
@@ -359,6 +353,11 @@ class BinFile(object):
         """
         return sum(self.pixels.cnt)    
 
+    def write_store(self, folder, quiet=True):
+        """write the pixels to a folder in the memory-mapped layout, return a PixelStore object
+        """
+        return PixelStore.create(folder, self, quiet)
+
     def roi_subset(self,  roi_number, channel, radius=5):
         """Return a tuple:
             (l,b,radius), nside, DataFrame with data values for the HEALPix pixels within the pointlike ROI
@@ -487,6 +486,227 @@ class BinFile(object):
         ax.legend()
 
 
+def combine_files(filenames, outfile=None, quiet=False):
+    """Combine any number of binned photon files, one channel at a time
+    filenames : list of string
+    outfile : string | None
+        if set, write the combined file
+    Returns a BinFile object, the first file with the pixels and GTI of all of them.
+    
+    The FITS tables are memory-mapped, and the pixel and count columns are read one channel at a time.
+    To find the channels, the full channel column of each file is read, and if a file is not sorted by 
+    channel, as written by ConvertFT1 or BinFile.writeto, it is also argsorted. The merged keys and
+    counts for all channels are kept until the end, so the memory needed is that for the combined 
+    pixels, the channel columns, and the current channel of all files.
+    """
+    assert len(filenames)>0, 'No files to combine'
+    def channel_slices(pixels, nchan):
+        # list of index arrays or slices into the pixel arrays for each channel
+        chn = pixels.chn
+        if np.all(chn[1:]>=chn[:-1]):
+            offsets = np.searchsorted(chn, np.arange(nchan+1))
+            return [slice(a,b) for a,b in zip(offsets[:-1], offsets[1:])]
+        order = np.argsort(chn, kind='mergesort')
+        offsets = np.searchsorted(chn[order], np.arange(nchan+1))
+        return [order[a:b] for a,b in zip(offsets[:-1], offsets[1:])]
+
+    files = [BinFile(filename) for filename in filenames]
+    nchan = max(len(f) for f in files)
+    slices = [channel_slices(f.pixels, nchan) for f in files]
+    keys, cnt = [], []
+    for channel in range(nchan):
+        p, c = merge_counts(
+            np.hstack([np.asarray(f.pixels.pix[s[channel]], np.int64) for f,s in zip(files,slices)]),
+            np.hstack([np.asarray(f.pixels.cnt[s[channel]], np.int64) for f,s in zip(files,slices)]))
+        keys.append(np.left_shift(np.int64(channel), 32) + p); cnt.append(c)
+    combined = files[0]
+    for f in files[1:]:
+        combined.gti.add(f.gti)
+    combined.pixels.set_keys(np.hstack(keys), np.hstack(cnt))
+    if not quiet: print 'combined {} files: {}'.format(len(files), combined.pixels)
+    if outfile is not None:
+        combined.writeto(outfile)
+    return combined
+
+
+class PixelStore(object):
+    """ Columnar, memory-mapped copy of the pixels of a BinFile
+    
+    A folder with the files
+        pix.npy     : int64 nested HEALPix index of each pixel
+        cnt.npy     : int32 number of photons in the pixel
+        offsets.npy : int64 start of each channel in the above, with total length at the end
+        bands.csv   : the band list, as from BandList.dataframe
+        gti.npy     : GTI start and stop times
+    The pixels are sorted by channel, then nested index, so the pixels of a channel within
+    a disk are found with a binary search for each of the contiguous ranges of nested indices
+    that cover the disk. The arrays are memory-mapped: only the pages needed are read, and
+    they are shared by all processes reading the same folder.
+    
+    Implements the same indexing interface as BinFile, returning skymaps.Band objects. A view
+    returned by roi_view, which shares the arrays, returns only the pixels in its ROI.
+    """
+    def __init__(self, folder):
+        """ folder : string
+            created by BinFile.write_store
+        """
+        self.folder = os.path.expandvars(folder)
+        load = lambda name: np.load(os.path.join(self.folder, name+'.npy'), mmap_mode='r')
+        self.pix, self.cnt = load('pix'), load('cnt')
+        self.offsets = np.load(os.path.join(self.folder,'offsets.npy'))
+        self.bands = pd.read_csv(os.path.join(self.folder, 'bands.csv'), index_col=0)
+        self.gti = np.load(os.path.join(self.folder, 'gti.npy'))
+        self.roi = None
+        
+    @staticmethod
+    def create(folder, binfile, quiet=True):
+        """ write the pixels of a BinFile object to a new folder 
+        """
+        folder = os.path.expandvars(folder)
+        if not os.path.exists(folder): os.makedirs(folder)
+        pixels = binfile.pixels
+        bands = binfile.bands.dataframe()
+        chn = np.asarray(pixels.chn, np.int64)
+        nest = np.empty(len(chn), np.int64)
+        for channel in np.unique(chn):
+            sel = chn==channel
+            nest[sel] = healpy.ring2nest(int(bands.nside[channel]), np.asarray(pixels.pix[sel], np.int64))
+        order = np.lexsort((nest, chn))
+        np.save(os.path.join(folder, 'pix.npy'), nest[order])
+        np.save(os.path.join(folder, 'cnt.npy'), np.asarray(pixels.cnt, np.int32)[order])
+        np.save(os.path.join(folder, 'offsets.npy'), 
+            np.searchsorted(chn[order], np.arange(len(bands)+1)).astype(np.int64))
+        bands.to_csv(os.path.join(folder, 'bands.csv'))
+        np.save(os.path.join(folder, 'gti.npy'), np.array([binfile.gti.start, binfile.gti.stop]))
+        if not quiet: print 'wrote pixel store {}'.format(folder)
+        return PixelStore(folder)
+
+    def __repr__(self):
+        return '{}: {} bands, {:,} pixels, {:,} photons, in {}'.format(self.__class__, 
+            len(self), len(self.pix), self.photonCount(), self.folder)
+
+    def __len__(self): return len(self.bands)
+
+    def photonCount(self):
+        """ method to be consistent with skymaps.BinnedPhotonData
+        """
+        return int(self.cnt.sum())
+
+    def channel(self, channel):
+        """ return (pix, cnt) arrays, the nested indices and counts for a channel """
+        a,b = self.offsets[channel], self.offsets[channel+1]
+        return self.pix[a:b], self.cnt[a:b]
+
+    def disk_pixels(self, channel, glon, glat, radius):
+        """ return (pix, cnt) arrays for the pixels in a channel with data, that overlap a disk
+        glon, glat, radius : float
+            center and radius of the disk, in degrees
+        """
+        nside = int(self.bands.nside[channel])
+        qpix = healpy.query_disc(nside, healpy.dir2vec(glon,glat,lonlat=True), np.radians(radius), 
+            inclusive=True, nest=True)
+        if len(qpix)==0: 
+            return np.array([], np.int64), np.array([], np.int32)
+        qpix = np.sort(qpix)
+        # the disk is a set of contiguous ranges [start, stop) of nested indices
+        breaks = np.flatnonzero(np.diff(qpix)>1)+1
+        starts = qpix[np.hstack([[0], breaks])]
+        stops = qpix[np.hstack([breaks-1, [len(qpix)-1]])]+1
+        pix, cnt = self.channel(channel)
+        lo, hi = np.searchsorted(pix, starts), np.searchsorted(pix, stops)
+        ranges = [(a,b) for a,b in zip(lo,hi) if b>a]
+        if len(ranges)==0:
+            return np.array([], np.int64), np.array([], np.int32)
+        return (np.hstack([pix[a:b] for a,b in ranges]),
+                np.hstack([cnt[a:b] for a,b in ranges]))
+
+    def roi_view(self, glon, glat, radius):
+        """ return a new PixelStore, sharing the arrays, with indexing limited to the pixels 
+        overlapping a disk. The store itself, which may be shared by other ROIs, is unchanged.
+        """
+        view = copy.copy(self)
+        view.roi = (glon, glat, radius)
+        return view
+
+    def __getitem__(self, index):
+        """ return a skymaps.Band C++ object corresponding to the band index, with RING indices
+        """
+        from skymaps import Band
+        if index>=len(self): raise IndexError
+        b = self.bands.iloc[index]
+        nside = int(b.nside)
+        bb = Band(nside, int(b.event_type), b.e_min, b.e_max, 0,0)
+        if self.roi is None:
+            pix, cnt = self.channel(index)
+        else:
+            pix, cnt = self.disk_pixels(index, *self.roi)
+        for p, c in zip(healpy.nest2ring(nside, np.asarray(pix)), cnt):
+            bb.add(int(p), int(c))
+        return bb
+
+    def roi_subset(self, roi_number, channel, radius=5):
+        """ Same as BinFile.roi_subset, reading only pixels in the ROI
+        """
+        nside = int(self.bands.nside[channel])
+        glon, glat, _ = roi_circle(roi_number)
+        pix = healpy.query_disc(nside, healpy.dir2vec(glon,glat,lonlat=True), np.radians(radius))
+        roi_pix = pd.DataFrame(np.zeros_like(pix), index=pix, columns=['value'])
+        npix, ncnt = self.disk_pixels(channel, glon, glat, radius)
+        data_pix = pd.Series(np.asarray(ncnt, int), index=healpy.nest2ring(nside, np.asarray(npix)))
+        data_in_roi = data_pix.index.intersection(roi_pix.index)
+        print 'Found {} nside={} data pixels for channel {} in ROI {}'.format(len(data_in_roi),nside, channel, roi_number)
+        roi_pix.loc[data_in_roi, 'value'] = data_pix.loc[data_in_roi]
+        return roi_circle(roi_number, galactic=False), nside, roi_pix
+
+
+def band_table(ebins, orders, etypes):
+    """ DataFrame with component values for energy and event type, nside, indexed by channel
+    """
+    t = {}
+    band=0
+    for ie in range(len(ebins)-1):
+        for et in etypes:
+            order = orders[et if et<2 else 0][ie] # use max if PSF
+            nside = 2**order
+            t[band]= dict(ie=ie, event_type=et, nside=nside)
+            band+=1
+    return pd.DataFrame(t).T
+
+def binned_hdus(primary, ebins, df, pix, chn, cnt, gti_hdu):
+    """ return the list of HDUs for a binned photon file
+    primary : the primary HDU, from the FT1 file
+    ebins, df : energy bins, and channel table from band_table
+    pix, chn, cnt : arrays with the pixel index, channel, and count
+    gti_hdu : the GTI HDU
+    """
+    elow, ehigh = ebins[:-1], ebins[1:]
+    e_min = np.array([elow[i] for i in df.ie])
+    e_max = np.array([ehigh[i] for i in df.ie])
+
+    band_cols = [
+        fits.Column(name='NSIDE', format='J', array=df.nside),
+        fits.Column(name='E_MIN', format='D', array=e_min*1e+3, unit='keV'),
+        fits.Column(name='E_MAX', format='D', array=e_max*1e+3, unit='keV'),
+        fits.Column(name='EVENT_TYPE', format='J', array=df.event_type),
+    ]
+    bands_hdu=fits.BinTableHDU.from_columns(band_cols, name='BANDS')
+
+    skymap_cols = [
+        fits.Column(name='PIX', format='J',    array=pix),
+        fits.Column(name='CHANNEL', format='I',array=chn),
+        fits.Column(name='VALUE', format='J',  array=cnt),
+    ]
+    skymap_hdu=fits.BinTableHDU.from_columns(skymap_cols, name='SKYMAP')
+    skymap_hdu.header.update(
+        PIXTYPE='HEALPIX',
+        INDXSCHM='SPARSE',
+        ORDERING='RING',
+        COORDSYS='GAL',
+        BANDSHDU='BANDS',
+        AXCOLS='E_MIN,E_MAX',
+                )
+    return [primary,  skymap_hdu, bands_hdu, gti_hdu]
+
 class ConvertFT1(object):
 
     defaults=(
@@ -520,15 +740,7 @@ class ConvertFT1(object):
         print 'Found {} events. Removed: {:.2f} %'.format(len(data), 100.- 100*sum(self.data_cut)/float(len(data)));
 
         # DataFrame with component values for energy and event type, nside
-        t = {}
-        band=0
-        for ie in range(len(self.ebins)-1):
-            for et in self.etypes:
-                order = self.orders[et if et<2 else 0][ie] # use max if PSF
-                nside = 2**order
-                t[band]= dict(ie=ie, event_type=et, nside=nside)
-                band+=1
-        self.df = pd.DataFrame(t).T
+        self.df = band_table(self.ebins, self.orders, self.etypes)
 
     def cuthist(self):
         import matplotlib.pyplot  as plt
@@ -576,34 +788,9 @@ class ConvertFT1(object):
                 print '{:8} {:8}'.format(sum(sel), len(a))
 
     def create_fits(self, outfile='test.fits', overwrite=True):
-        elow, ehigh = self.ebins[:-1], self.ebins[1:]
-        e_min = np.array([elow[i] for i in self.df.ie])
-        e_max = np.array([ehigh[i] for i in self.df.ie])
-
-        band_cols = [
-            fits.Column(name='NSIDE', format='J', array=self.df.nside),
-            fits.Column(name='E_MIN', format='D', array=e_min*1e+3, unit='keV'),
-            fits.Column(name='E_MAX', format='D', array=e_max*1e+3, unit='keV'),
-            fits.Column(name='EVENT_TYPE', format='J', array=self.df.event_type),
-        ]
-        bands_hdu=fits.BinTableHDU.from_columns(band_cols, name='BANDS')
-
-        skymap_cols = [
-            fits.Column(name='PIX', format='J',    array=self.pix),
-            fits.Column(name='CHANNEL', format='I',array=self.chn),
-            fits.Column(name='VALUE', format='J',  array=self.cnt),
-        ]
-        skymap_hdu=fits.BinTableHDU.from_columns(skymap_cols, name='SKYMAP')
-        skymap_hdu.header.update(
-            PIXTYPE='HEALPIX',
-            INDXSCHM='SPARSE',
-            ORDERING='RING',
-            COORDSYS='GAL',
-            BANDSHDU='BANDS',
-            AXCOLS='E_MIN,E_MAX',
-                    )
         # add the GTI from the FT1 file and write it out
-        hdus = [self.ft1_hdus[0],  skymap_hdu, bands_hdu, self.ft1_hdus['GTI']]
+        hdus = binned_hdus(self.ft1_hdus[0], self.ebins, self.df, self.pix, self.chn, self.cnt, 
+            self.ft1_hdus['GTI'])
         fits.HDUList(hdus).writeto(outfile, overwrite=overwrite)
 
     def time_record(self, nside=1024):
@@ -636,6 +823,124 @@ class ConvertFT1(object):
                 names='band hpindex time'.split())
         )
 
+def _bin_file(args):
+    # for the worker pool in StreamingBinner
+    binner, filename = args
+    return binner.bin_file(filename)
+
+class StreamingBinner(object):
+    """ Bin FT1 files into channel and pixel counts, reading blocks of events
+
+    The events are read chunk_size rows at a time from the memory-mapped EVENTS table, and 
+    the counts for each block are merged into those for the file, as sorted (channel<<32 | pixel)
+    keys; the files are binned by a pool of workers, and the results merged. The memory used depends 
+    only on the chunk size and the number of pixels with data.
+    The binning, and the output file for a single FT1 file, are the same as for ConvertFT1.
+    """
+    defaults = ConvertFT1.defaults + (
+        ('chunk_size', 2000000, 'number of events per block'),
+        ('workers', 1, 'number of processes, for multiple files'),
+        ('quiet', True, 'set False for progress output'),
+    )
+
+    @keyword_options.decorate(defaults)
+    def __init__(self, ft1_files, **kwargs):
+        """ ft1_files : a FT1 file name, or a list
+        """
+        keyword_options.process(self, kwargs)
+        if not hasattr(ft1_files, '__iter__'):
+            ft1_files = [ft1_files]
+        self.ft1_files = list(ft1_files)
+        self.df = band_table(self.ebins, self.orders, self.etypes)
+        # channel for (energy index, event type), -1 if none
+        self.channel_index = -np.ones((len(self.ebins)-1, max(self.etypes)+1), int)
+        self.channel_index[np.array(self.df.ie, int), np.array(self.df.event_type, int)] = self.df.index
+        self.nsides = np.array(self.df.nside, int)
+
+    def __repr__(self):
+        return '{}: {} FT1 files, {} channels'.format(self.__class__, len(self.ft1_files), len(self.df))
+
+    def bin_events(self, data):
+        """ return sorted unique keys and counts for a block of events, a FITS_rec
+        """
+        glon, glat, energy, et, z, theta =\
+             [data[x] for x in 'L B ENERGY EVENT_TYPE ZENITH_ANGLE THETA'.split()]
+        eindex = np.digitize(energy, self.ebins)-1
+        cut = (theta<self.theta_cut) & (z<self.z_cut) & (eindex>=0) & (eindex<len(self.ebins)-1)
+        keys = []
+        for etype in self.etypes:
+            sel = cut & et[:,-1-etype]
+            channel = self.channel_index[eindex[sel], etype]
+            lon, lat = glon[sel], glat[sel]
+            nsides = self.nsides[channel]
+            for nside in np.unique(nsides):
+                s = nsides==nside
+                hpindex = healpy.ang2pix(int(nside), lon[s], lat[s], nest=False, lonlat=True)
+                keys.append(np.left_shift(channel[s].astype(np.int64), 32) + hpindex)
+        if len(keys)==0:
+            return np.array([], np.int64), np.array([], np.int64)
+        keys = np.hstack(keys)
+        return merge_counts(keys, np.ones(len(keys), np.int64))
+
+    def bin_file(self, filename):
+        """ return sorted unique keys and counts for the events in a FT1 file
+        """
+        with fits.open(filename, memmap=True) as hdus:
+            events = hdus['EVENTS'].data
+            nevents = len(events)
+            keys, counts = np.array([], np.int64), np.array([], np.int64)
+            for start in range(0, nevents, self.chunk_size):
+                k, c = self.bin_events(events[start:start+self.chunk_size])
+                keys, counts = merge_counts(np.hstack([keys,k]), np.hstack([counts,c]))
+        if not self.quiet:
+            print '{}: {:,} events, {:,} pixels'.format(filename, nevents, len(keys))
+        return keys, counts
+
+    def __call__(self):
+        """ bin all the files, set arrays pix, chn, cnt as for ConvertFT1.binner
+        """
+        if self.workers>1 and len(self.ft1_files)>1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(self.workers, len(self.ft1_files)))
+            try:
+                results = pool.imap_unordered(_bin_file, [(self, f) for f in self.ft1_files])
+                keys, counts = self._merge(results)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            keys, counts = self._merge(self.bin_file(f) for f in self.ft1_files)
+        self.chn = np.right_shift(keys, 32)
+        self.pix = np.bitwise_and(keys, 2**32-1)
+        self.cnt = counts
+
+    def _merge(self, results):
+        keys, counts = np.array([], np.int64), np.array([], np.int64)
+        for k, c in results:
+            keys, counts = merge_counts(np.hstack([keys,k]), np.hstack([counts,c]))
+        return keys, counts
+
+    def create_fits(self, outfile='test.fits', overwrite=True):
+        """ write the binned file, with the primary HDU of the first FT1 file and the combined GTI
+
+        For a single file, the GTI HDU is copied, as by ConvertFT1. For several, the intervals are
+        concatenated, in the order of the files, by GTI.add, and GTI.make_hdu uses the header of the
+        first file's GTI HDU: keywords other than the table structure, such as TSTOP, or a checksum, 
+        describe the first file only.
+        """
+        with fits.open(self.ft1_files[0]) as ft1:
+            if len(self.ft1_files)==1:
+                gti_hdu = ft1['GTI']
+            else:
+                gti = GTI(ft1['GTI'])
+                for f in self.ft1_files[1:]:
+                    with fits.open(f) as other:
+                        gti.add(GTI(other['GTI']))
+                gti_hdu = gti.make_hdu()
+            hdus = binned_hdus(ft1[0], self.ebins, self.df, self.pix, self.chn, self.cnt, gti_hdu)
+            fits.HDUList(hdus).writeto(outfile, overwrite=overwrite)
+
+
 def run_binner(monthly_ft1_files='/afs/slac/g/glast/groups/catalog/P8_P305/zmax105/*.fits',
         outfolder='$FERMI/data/P8_P305/monthly',
         overwrite=False):
@@ -678,13 +983,11 @@ def combine_monthly(
     os.chdir(outfolder) 
     
     for year in range((len(months)+1)/12):
-        t = BinFile(months[12*year])
         outfile = 'P305_Source_year{:02d}_zmax100_4bpd.fits'.format(year+1)
         if not overwrite and os.path.exists(outfile):
             print 'File {} exists'.format(outfile)
             continue
-        for m in months[12*year+1:12*year+12]:
-            t.add(BinFile(m))
+        t = combine_files(months[12*year:12*year+12])
         if not test:
             t.writeto(outfile)
         else:
@@ -705,11 +1008,9 @@ def combine_yearly(
     
     outfolder=os.path.expandvars(outfolder)
     os.chdir(outfolder) 
-    print 'loading {}'.format(os.path.split(years[0])[-1])
-    t = BinFile(years[0])
-    for year in years[1:nyears]:
+    for year in years[:nyears]:
         print ' adding {}'.format(os.path.split(year)[-1])
-        t.add(BinFile(year))
+    t = combine_files(years[:nyears])
     outfile = outfilename.format(nyears)
     if not test:
         t.writeto(outfile)
@@ -0,0 +1,174 @@
+"""
+Tests of the data package, using unittest
+"""
+import os, sys, shutil, tempfile, unittest
+from collections import Counter
+import numpy as np
+from astropy.io import fits
+
+from uw.data import binned_data
+
+def make_ft1(filename, nevents=2000, tstart=0, tstop=1e5, seed=0):
+    """ write a small FT1 file with random events, and a single GTI interval
+    """
+    rng = np.random.RandomState(seed)
+    et = np.zeros((nevents, 32), bool)
+    front = rng.rand(nevents)<0.5
+    et[:,-1], et[:,-2] = front, ~front
+    cols = [
+        fits.Column(name='ENERGY', format='E', array=10**rng.uniform(1.8, 5.5, nevents)),
+        fits.Column(name='L', format='E', array=rng.uniform(0, 360, nevents)),
+        fits.Column(name='B', format='E', array=np.degrees(np.arcsin(rng.uniform(-1, 1, nevents)))),
+        fits.Column(name='THETA', format='E', array=rng.uniform(0, 80, nevents)),
+        fits.Column(name='ZENITH_ANGLE', format='E', array=rng.uniform(0, 120, nevents)),
+        fits.Column(name='TIME', format='D', array=np.sort(rng.uniform(tstart, tstop, nevents))),
+        fits.Column(name='EVENT_TYPE', format='32X', array=et),
+    ]
+    primary = fits.PrimaryHDU()
+    primary.header.update(TSTART=tstart, TSTOP=tstop)
+    gti = fits.BinTableHDU.from_columns([
+        fits.Column(name='START', format='D', unit='s', array=[tstart]),
+        fits.Column(name='STOP', format='D', unit='s', array=[tstop])], name='GTI')
+    fits.HDUList([primary, fits.BinTableHDU.from_columns(cols, name='EVENTS'), gti]).writeto(filename)
+
+
+def counter_merge(sets):
+    """ reference for merging: sum the counts for each (channel<<32 | pixel) key with a Counter,
+        as the Pixels class did; return sorted arrays of keys and counts 
+    sets : list of (chn, pix, cnt) arrays
+    """
+    c = Counter()
+    for chn, pix, cnt in sets:
+        for k, n in zip(np.left_shift(np.asarray(chn, np.int64), 32) + pix, cnt):
+            c[k] += n
+    keys = np.array(sorted(c.keys()), np.int64)
+    return keys, np.array([c[k] for k in keys], np.int64)
+
+def random_pixels(rng, npix, channels=(0,1,3), maxpix=200, shuffle=True):
+    """ return chn, pix, cnt arrays with unique keys, for the channels, sorted by key unless shuffled """
+    keys = np.sort(rng.choice(len(channels)*maxpix, npix, replace=False))
+    chn = np.asarray(channels)[keys//maxpix]
+    pix = keys % maxpix
+    cnt = rng.randint(1, 10, npix)
+    order = rng.permutation(npix) if shuffle else np.arange(npix)
+    return chn[order], pix[order], cnt[order]
+
+def write_binned(filename, chn, pix, cnt, gti=(0,1)):
+    """ write a binned photon file with four channels, two energy bands and two event types """
+    ebins = np.logspace(2, 3, 3)
+    df = binned_data.band_table(ebins, [[6,6],[6,6]], (0,1))
+    gti_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='START', format='D', unit='s', array=[gti[0]]),
+        fits.Column(name='STOP', format='D', unit='s', array=[gti[1]])], name='GTI')
+    hdus = binned_data.binned_hdus(fits.PrimaryHDU(), ebins, df, pix, chn, cnt, gti_hdu)
+    fits.HDUList(hdus).writeto(filename)
+
+
+class TestMerge(unittest.TestCase):
+    """ merging pixels with sorted keys, compared with the Counter that was used before """
+    def setUp(self):
+        self.rng = np.random.RandomState(2)
+        self.folder = tempfile.mkdtemp()
+        # channel 2 is empty; the first file is sorted, the others not
+        self.sets = [random_pixels(self.rng, n, shuffle=i>0) for i,n in enumerate((300, 200, 250))]
+        self.filenames = [os.path.join(self.folder, 'binned_%d.fits' % i) for i in range(3)]
+        for i, (f, s) in enumerate(zip(self.filenames, self.sets)):
+            write_binned(f, *s, gti=(i, i+1))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def check(self, keys, cnt, sets):
+        rkeys, rcnt = counter_merge(sets)
+        self.assertTrue(np.all(np.asarray(keys)==rkeys))
+        self.assertTrue(np.all(np.asarray(cnt)==rcnt))
+
+    def test_merge_counts(self):
+        """-->merge_counts: unsorted keys with duplicates, and empty input"""
+        keys = self.rng.randint(0, 50, 500).astype(np.int64)
+        cnt = self.rng.randint(1, 5, 500).astype(np.int64)
+        self.check(*binned_data.merge_counts(keys, cnt), sets=[(np.zeros(500), keys, cnt)])
+        k, c = binned_data.merge_counts(np.array([], np.int64), np.array([], np.int64))
+        self.assertEqual(0, len(k)+len(c))
+
+    def test_pixels_add(self):
+        """-->Pixels.add: same as updating a Counter"""
+        a, b = [binned_data.BinFile(f).pixels for f in self.filenames[:2]]
+        a.add(b)
+        self.check(a.keys(), a.cnt, self.sets[:2])
+        self.assertEqual([], a[2])
+
+    def test_combine_files(self):
+        """-->combine_files: same pixels as a Counter, and as BinFile adding the files"""
+        combined = binned_data.combine_files(self.filenames, quiet=True)
+        self.check(combined.pixels.keys(), combined.pixels.cnt, self.sets)
+        self.assertTrue(np.all(combined.gti.start==[0,1,2]))
+        added = binned_data.BinFile(self.filenames)
+        self.check(added.pixels.keys(), added.pixels.cnt, self.sets)
+
+
+class TestStreamingBinner(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.ft1_files = [os.path.join(self.folder, 'ft1_%d.fits' % i) for i in range(2)]
+        for i, f in enumerate(self.ft1_files):
+            make_ft1(f, tstart=i*1e5, tstop=(i+1)*1e5, seed=i)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def binned_file(self, binner, name):
+        outfile = os.path.join(self.folder, name)
+        binner.create_fits(outfile)
+        return fits.open(outfile)
+
+    def compare(self, hdus, expect, hdu_names=('SKYMAP', 'BANDS', 'GTI')):
+        for name in hdu_names:
+            a, b = hdus[name].data, expect[name].data
+            self.assertEqual(a.columns.names, b.columns.names)
+            for col in a.columns.names:
+                self.assertTrue(np.all(a[col]==b[col]), msg='{} {}'.format(name, col))
+
+    def test_single(self):
+        """-->binned file for one FT1 file the same as from ConvertFT1"""
+        cvt = binned_data.ConvertFT1(self.ft1_files[0])
+        cvt.binner()
+        binner = binned_data.StreamingBinner(self.ft1_files[0], chunk_size=300)
+        binner()
+        with self.binned_file(cvt, 'convert.fits') as expect:
+            with self.binned_file(binner, 'streaming.fits') as hdus:
+                self.compare(hdus, expect)
+
+    def test_multiple(self):
+        """-->two FT1 files: counts summed, GTI intervals concatenated"""
+        binners = [binned_data.StreamingBinner(f) for f in self.ft1_files]
+        for b in binners: b()
+        binner = binned_data.StreamingBinner(self.ft1_files)
+        binner()
+        self.assertEqual(sum(b.cnt.sum() for b in binners), binner.cnt.sum())
+        with self.binned_file(binner, 'streaming.fits') as hdus:
+            gti = hdus['GTI'].data
+            self.assertTrue(np.all(gti.START==[0, 1e5]))
+            self.assertTrue(np.all(gti.STOP==[1e5, 2e5]))
+
+
+test_cases = (
+    TestMerge,
+    TestStreamingBinner,
+    )
+
+def run(t='all', loader=unittest.TestLoader(), debug=False):
+    if t=='all':
+        suite = unittest.TestSuite()
+        for test_class in test_cases:
+            suite.addTests(loader.loadTestsFromTestCase(test_class))
+    else:
+        suite = loader.loadTestsFromTestCase(t)
+    print 'running %d tests %s' % (suite.countTestCases(), 'in debug mode' if debug else '')
+    if debug:
+        suite.debug()
+    else:
+        unittest.TextTestRunner(stream=sys.stdout,verbosity=2).run(suite)
+
+if __name__=='__main__':
+    run()
@@ -111,5 +111,5 @@ class ExposureIntegral(object):
         model_function : function
             if it returns an array, if it is a gradient, tnen axis should be 1
         """
-        axis = 1 if hasattr(model_function(self.sp_points[0]), '__iter__') else None
-        return (model_function(self.sp_points)*self.sp_vector).sum(axis=axis)
+        # a gradient returns (npar x npoints), so the product sums over the points in either case
+        return np.dot(model_function(self.sp_points), self.sp_vector)
@@ -14,6 +14,14 @@ from scipy.optimize import fmin
 from skymaps import (SkyDir, ExposureWeighter, PythonPsf,)
 from . import caldb
 
+def angular_distance(a, b):
+    """ return the (M,N) array of angles, in radians, between the unit vectors in the rows
+        of the (M,3) array a and the (N,3) array b. 
+        The chord length is used, since arccos of the dot product loses precision at small angles
+    """
+    chord2 = np.clip(2-2*np.dot(np.atleast_2d(a), np.atleast_2d(b).T), 0, 4)
+    return 2*np.arcsin(0.5*np.sqrt(chord2))
+
 
 class PSFmanager(dict):
     """ manage the PSF
@@ -153,6 +161,16 @@ class PSFmanager(dict):
         u = 0.5 * np.outer(delta,1./s)**2
         return (1-1./g)*(1+u/g)**(-g)
 
+    def psf_base_derivatives(self,g,s,delta):
+        """First and second derivatives of the PSF base function with respect to delta;
+            arrays of shape (n_angles,n_params), like psf_base
+        """
+        u = 0.5 * np.outer(delta,1./s)**2
+        t = (1-1./g)/s**2 * (1+u/g)**(-g-2)
+        d1 = -t * (1+u/g) * np.outer(delta, np.ones_like(s))
+        d2 = -t * (1+u/g-2*u*(1+1./g))
+        return d1, d2
+
 
     def __call__(self, event_type, energy=1000):
         """Return a PSF functor of distance for the given event type (e.g., front or back)
@@ -184,6 +202,7 @@ class PSFmanager(dict):
                 # Get the Python function for internal use
                 nc,nt,gc,gt,sc,st,w = self.par
                 self._cpsf = PythonPsf(sc,st,gc,gt,nc,nt,w)
+                self._table = None
                 self.r68= self.inverse_integral()
  
             def __repr__(self):
@@ -195,9 +214,19 @@ class PSFmanager(dict):
                 yt = psfman.psf_base(gt,st,delta)
                 return (w*(nc*yc + nt*yt)).sum(axis=1)
 
+            def derivatives(self, delta):
+                """ return the PSF, and its first and second derivatives with respect to delta,
+                    for an array of angles in radians
+                """
+                nc,nt,gc,gt,sc,st,w = self.par
+                dc1, dc2 = psfman.psf_base_derivatives(gc,sc,delta)
+                dt1, dt2 = psfman.psf_base_derivatives(gt,st,delta)
+                return (self(delta), (w*(nc*dc1 + nt*dt1)).sum(axis=1),
+                        (w*(nc*dc2 + nt*dt2)).sum(axis=1))
+
             def integral(self, dmax, dmin=0):
                 """ this does not seem to be the integral over solid angle
-                Note -- does *not* take a vector argument right now.
+                dmax may be an array, in which case an array is returned
                 """
                 # more expressive
                 #return integrate.quad(lambda r: 2*np.pi*r*self(r), dmin, dmax)[0]
@@ -207,7 +236,32 @@ class PSFmanager(dict):
                         psfman.psf_base_integral(gc,sc,dmax,dmin=dmin)
                 itail = TWOPI*st**2*nt*\
                         psfman.psf_base_integral(gt,st,dmax,dmin=dmin)
-                return (w*(icore+itail)).sum()
+                ret = (w*(icore+itail)).sum(axis=-1)
+                return ret[0] if np.isscalar(dmax) else ret
+
+            def radial_table(self, npts=1000):
+                """ return arrays of angles, in radians, and the PSF values, for interpolation. 
+                The angles are logarithmically spaced from 1e-3 of R68 to pi. 
+                The table is saved until the energy is changed
+                """
+                if self._table is None or len(self._table[0])!=npts:
+                    r = np.concatenate([[0], np.logspace(np.log10(1e-3*np.radians(self.r68)), 
+                                np.log10(np.pi), npts-1)])
+                    self._table = (r, self(r))
+                return self._table
+
+            def matrix(self, sources, pixels, table=False):
+                """ return the (M,N) array of PSF values for sources at M positions and N pixels
+                    sources : (M,3) array of unit vectors
+                    pixels  : (N,3) array of unit vectors
+                    table   : bool
+                        if set, interpolate in the radial_table rather than evaluate the function
+                """
+                delta = angular_distance(sources, pixels)
+                if table:
+                    r, v = self.radial_table()
+                    return np.interp(delta, r, v)
+                return self(delta.ravel()).reshape(delta.shape)
 
 
             def inverse_integral(self, percent=68,on_axis=False): 
@@ -225,10 +279,10 @@ class PSFmanager(dict):
                     u2 = gt[0]*( (1-percent)**(1./(1-gt[0])) - 1)
                     return RAD2DEG*sf*(nc[0]*(u1*2)**0.5*sc[0] + nt[0]*(u2*2)**0.5*st[0])           
                 # off axis
-                f = lambda x: abs(self.integral(x) - percent)
+                f = lambda x: abs(self.integral(float(x[0])) - percent)
 
                 seeds = np.asarray([5,4,3,2.5,2,1.5,1,0.5,0.25])*self.scale
-                seedvals = np.asarray([self.integral(x) for x in seeds])
+                seedvals = self.integral(seeds)
                 seed = seeds[np.argmin(np.abs(seedvals-percent))]
                 trial = fmin(f,seed,disp=0,ftol=0.000001,xtol=0.01)
                 if trial > 0:
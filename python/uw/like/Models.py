@@ -601,6 +601,69 @@ class Model(object):
             dextdint=dextdint.reshape((len(dextdint)),1)
         return self.external_gradient(e)*dextdint
 
+    def batch_call(self, pars, e):
+        """ Evaluate the model for a set of parameter vectors.
+
+            pars : array (nsets, npar) of external parameter values
+            e    : array of energies, shape (ne)
+            Returns an array (nsets, ne)
+
+            Models with a method _batch_call(p, e) evaluate all sets in one call: its arguments
+            are the parameter columns, each with shape (nsets,1), and the energies, shape (1,ne).
+            Otherwise the parameters are set in turn, and restored.
+
+                >>> model = PowerLaw()
+                >>> pars = [[1e-11, 2.0], [1e-11, 2.5]]
+                >>> np.allclose(model.batch_call(pars, [100,1000])[1], PowerLaw(p=pars[1])([100,1000]))
+                True
+        """
+        pars, e = self._batch_args(pars, e)
+        if hasattr(self, '_batch_call'):
+            return self._batch_call(pars.T[:,:,None], e[None,:]) * np.ones((len(pars), len(e)))
+        return self._batch_loop(lambda: self(e), pars)
+
+    def batch_external_gradient(self, pars, e):
+        """ Gradient with respect to the external parameters for a set of parameter vectors.
+
+            pars : array (nsets, npar) of external parameter values
+            e    : array of energies, shape (ne)
+            Returns an array (nsets, npar, ne)
+        """
+        pars, e = self._batch_args(pars, e)
+        if hasattr(self, '_batch_external_gradient'):
+            shape = (len(pars), len(e))
+            g = self._batch_external_gradient(pars.T[:,:,None], e[None,:])
+            return np.array([gi * np.ones(shape) for gi in g]).transpose(1,0,2)
+        return self._batch_loop(lambda: self.external_gradient(e), pars)
+
+    def batch_gradient(self, pars, e):
+        """ Gradient with respect to the internal parameters for a set of parameter vectors.
+            Returns an array (nsets, npar, ne)
+        """
+        pars, e = self._batch_args(pars, e)
+        dextdint = np.array([m.dexternaldinternal(p)*np.ones(len(pars)) 
+                    for m,p in zip(self.mappers, pars.T)]).T
+        return self.batch_external_gradient(pars, e) * dextdint[:,:,None]
+
+    def _batch_args(self, pars, e):
+        pars = np.atleast_2d(np.asarray(pars, dtype=float))
+        assert pars.shape[1]==self.npar, 'expected (nsets, %d) parameters, got %s' % (self.npar, pars.shape)
+        return pars, np.atleast_1d(np.asarray(e, dtype=float))
+
+    def _batch_loop(self, fun, pars):
+        # generic evaluation: set each parameter vector in turn, then restore the current state
+        saved = self._p.copy()
+        saved_external = self._external.copy() if hasattr(self, '_external') else None
+        try:
+            ret = []
+            for p in pars:
+                self.set_all_parameters(p)
+                ret.append(np.array(fun(), dtype=float))
+        finally:
+            self._p = saved
+            if saved_external is not None: self._external = saved_external
+        return np.array(ret)
+
     def error(self,i):
         """ Get the EXTERNAL error for parameter i """
         i=self.name_mapper(i)
@@ -1324,6 +1387,15 @@ class PowerLaw(Model):
         n0,gamma = self.get_all_parameters()
         return n0*(self.e0/e)**gamma
 
+    def _batch_call(self, p, e):
+        n0,gamma = p
+        return n0*(self.e0/e)**gamma
+
+    def _batch_external_gradient(self, p, e):
+        n0,gamma = p
+        f = n0*(self.e0/e)**gamma
+        return [f/n0, f*np.log(self.e0/e)]
+
     def fast_iflux(self,emin=100,emax=1e6):
         n0,gamma=self['Norm'],self['Index']
         return n0/(1-gamma)*self.e0**gamma*(emax**(1-gamma)-emin**(1-gamma))
@@ -1459,6 +1531,18 @@ class PowerLawFlux(Model):
         f  = (flux*(1-gamma)/(d1-d0))*e**(-gamma)
         return np.asarray([f/flux,-f*(np.log(e) + (1./(1-gamma) + t))])
 
+    def _batch_call(self, p, e):
+        flux,gamma = p
+        return (flux*(1-gamma)/(self.emax**(1-gamma)-self.emin**(1-gamma)))*e**(-gamma)
+
+    def _batch_external_gradient(self, p, e):
+        flux,gamma = p
+        d1 = self.emax**(1-gamma)
+        d0 = self.emin**(1-gamma)
+        t  = (np.log(self.emin)*d0 - np.log(self.emax)*d1)/(d1 - d0)
+        f  = (flux*(1-gamma)/(d1-d0))*e**(-gamma)
+        return [f/flux, -f*(np.log(e) + (1./(1-gamma) + t))]
+
     def full_name(self):
         return '%s, emin=%.0f emax=%.0f'% (self.pretty_name,self.emin,self.emax)
 
@@ -1507,6 +1591,19 @@ class BrokenPowerLaw(Model):
         f = n0*x**g
         return np.asarray([f/n0,f*lx*mask,f*lx*(~mask),f/e_break*g])
 
+    def _batch_call(self, p, e):
+        n0,gamma1,gamma2,e_break = p
+        return n0*(e_break/e)**np.where(e<e_break,gamma1,gamma2)
+
+    def _batch_external_gradient(self, p, e):
+        n0,gamma1,gamma2,e_break = p
+        mask = e < e_break
+        x = e_break/e
+        lx = np.log(x)
+        g = np.where(mask,gamma1,gamma2)
+        f = n0*x**g
+        return [f/n0, f*lx*mask, f*lx*(~mask), f/e_break*g]
+
 class BrokenPowerLawFlux(Model):
     """ Similar to PowerLawFlux for BrokenPowerLaw spectrum, the integral 
         flux is the free parameter rather than the Prefactor.
@@ -1698,6 +1795,17 @@ class LogParabola(Model):
         f = n0*np.exp(y) # np.clip(y, -10, 100))
         return np.asarray([f/n0, f*x, -f*x**2, f*(alpha-2*beta*x)/e_break])
 
+    def _batch_call(self, p, e):
+        n0,alpha,beta,e_break = p
+        x = np.log(e_break/e)
+        return n0*np.exp((alpha - beta*x)*x)
+
+    def _batch_external_gradient(self, p, e):
+        n0,alpha,beta,e_break = p
+        x = np.log(e_break/e)
+        f = n0*np.exp((alpha - beta*x)*x)
+        return [f/n0, f*x, -f*x**2, f*(alpha-2*beta*x)/e_break]
+
     # overridden in base class -- leave here for refererence or later check
     #def pivot_energy(self):
     #    """  
@@ -1795,6 +1903,15 @@ class ExpCutoff(Model):
         f = n0* (self.e0/e)**gamma * np.exp(-e/cutoff)
         return np.asarray([f/n0,f*np.log(self.e0/e),f*e/cutoff**2])
 
+    def _batch_call(self, p, e):
+        n0,gamma,cutoff = p
+        return n0* (self.e0/e)**gamma * np.exp(-e/cutoff)
+
+    def _batch_external_gradient(self, p, e):
+        n0,gamma,cutoff = p
+        f = n0* (self.e0/e)**gamma * np.exp(-e/cutoff)
+        return [f/n0, f*np.log(self.e0/e), f*e/cutoff**2]
+
 
     #def pivot_energy(self):
     #    """ assuming a fit was done, estimate the pivot energy 
@@ -1932,6 +2049,16 @@ class PLSuperExpCutoff(Model):
         return np.asarray([f/n0,f*np.log(self.e0/e),
                            f*(b/cutoff)*(e/cutoff)**b,f*(e/cutoff)**b*np.log(cutoff/e)])
 
+    def _batch_call(self, p, e):
+        n0,gamma,cutoff,b = p
+        return n0*(self.e0/e)**gamma*np.exp(-(e/cutoff)**b)
+
+    def _batch_external_gradient(self, p, e):
+        n0,gamma,cutoff,b = p
+        f = n0*(self.e0/e)**gamma*np.exp(-(e/cutoff)**b)
+        return [f/n0, f*np.log(self.e0/e),
+                f*(b/cutoff)*(e/cutoff)**b, f*(e/cutoff)**b*np.log(cutoff/e)]
+
 
     #def pivot_energy(self):
     #    """  
@@ -2507,6 +2634,12 @@ class Constant(Model):
     def external_gradient(self,e):
         return  np.array([np.ones_like(e)])
 
+    def _batch_call(self, p, e):
+        return p[0]*np.ones_like(e)
+
+    def _batch_external_gradient(self, p, e):
+        return [np.ones_like(e)]
+
 class InterpConstants(Model):
     default_p=[1.]*5
     default_extra_params=OrderedDict((('e_breaks',np.log10([100,300,1000,3000,3e5])),))
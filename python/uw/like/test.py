@@ -0,0 +1,90 @@
+"""
+Tests of the like package, using unittest
+"""
+import sys, unittest
+import numpy as np
+
+from uw.like import Models
+
+# models with native _batch_call and _batch_external_gradient forms
+batch_models = (
+    Models.PowerLaw,
+    Models.PowerLawFlux,
+    Models.BrokenPowerLaw,
+    Models.LogParabola,
+    Models.ExpCutoff,
+    Models.PLSuperExpCutoff,
+    Models.Constant,
+    )
+
+class TestBatch(unittest.TestCase):
+    """ batch_call, batch_external_gradient and batch_gradient compared with setting each parameter set """
+    def setUp(self):
+        self.rng = np.random.RandomState(6)
+        # spans the default break and cutoff energies
+        self.e = np.logspace(2, 5, 13)
+
+    def parameter_sets(self, model, nsets=5):
+        """ the model parameters, varied by 10 percent """
+        p = model.get_all_parameters()
+        return p * (1 + 0.1*self.rng.randn(nsets, len(p)))
+
+    def close(self, a, b, msg):
+        self.assertEqual(a.shape, b.shape, msg=msg)
+        self.assertTrue(np.allclose(a, b, rtol=1e-12, atol=1e-12*np.abs(b).max()),
+            msg='%s: maximum relative difference %.3g' % (msg, np.max(np.abs(a-b)/np.abs(b).max())))
+
+    def compare(self, model_class):
+        name = model_class.__name__
+        model = model_class()
+        pars = self.parameter_sets(model)
+        ref = model_class()
+        expect = dict(call=[], external_gradient=[], gradient=[])
+        for p in pars:
+            ref.set_all_parameters(p)
+            expect['call'].append(ref(self.e))
+            expect['external_gradient'].append(ref.external_gradient(self.e))
+            expect['gradient'].append(ref.gradient(self.e))
+        self.close(model.batch_call(pars, self.e), np.array(expect['call']), name+' call')
+        self.close(model.batch_external_gradient(pars, self.e), np.array(expect['external_gradient']),
+            name+' external_gradient')
+        self.close(model.batch_gradient(pars, self.e), np.array(expect['gradient']), name+' gradient')
+
+    def test_batch_forms(self):
+        """-->models with a batch form: the same as each parameter set in turn"""
+        for model_class in batch_models:
+            self.assertTrue(hasattr(model_class, '_batch_external_gradient'))
+            self.compare(model_class)
+
+    def test_loop(self):
+        """-->a model without a batch form: the same, and the parameters restored"""
+        model_class = Models.SmoothBrokenPowerLaw
+        self.assertFalse(hasattr(model_class, '_batch_external_gradient'))
+        self.compare(model_class)
+        model = model_class()
+        p, internal = model.get_all_parameters().copy(), model._p.copy()
+        model.batch_call(self.parameter_sets(model), self.e)
+        model.batch_gradient(self.parameter_sets(model), self.e)
+        self.assertTrue(np.all(model._p==internal))
+        self.assertTrue(np.all(model.get_all_parameters()==p))
+
+
+test_cases = (
+    TestBatch,
+    )
+
+def run(t='all', loader=unittest.TestLoader(), debug=False):
+    if t=='all':
+        suite = unittest.TestSuite()
+        for test_class in test_cases:
+            suite.addTests(loader.loadTestsFromTestCase(test_class))
+    else:
+        suite = loader.loadTestsFromTestCase(t)
+    print 'running %d tests %s' % (suite.countTestCases(), 'in debug mode' if debug else '')
+    if debug:
+        suite.debug()
+    else:
+        unittest.TextTestRunner(stream=sys.stdout,verbosity=2).run(suite)
+
+if __name__=='__main__':
+    run()
@@ -17,6 +17,10 @@ class BandLike(object):
     """
     defaults = (
         ('quiet', True, 'set False for info'),
+        ('vectorized', False, 'set True to keep the free-source pixel templates in a single array'),
+        ('full_update_interval', 0, 'if >0, update the model pixels incrementally, for sources flagged as changed,'
+                    ' with a full recalculation after this many updates. A response changed without setting'
+                    ' source.changed is missed until then. Default 0: always recalculate'),
         )
     @keyword_options.decorate(defaults)
     def __init__(self, band, sources, free, roi, **kwargs):
@@ -105,6 +109,7 @@ class BandLike(object):
         """
         assert free is not None, 'bad call?'
         self.free = free
+        self.last_counts = None # no saved contributions for incremental updates
         self.free_sources = self.bandsources[self.free]
         self.active_mask = map(lambda s: s.active, self.bandsources)
         #compile counts and count masks only for pointsources that are "active", i.e. not too far away or weak
@@ -112,6 +117,7 @@ class BandLike(object):
         self.counts = self.fixed_counts = sum([b.counts for b in fixed_sources])
         if not self.band.has_pixels: 
             self.model_pixels=self.fixed_pixels = self.weights= np.array([])
+            if self.vectorized: self.fill_templates()
             return
         self.fixed_pixels = np.zeros(self.pixels)
         for m in fixed_sources:
@@ -122,6 +128,28 @@ class BandLike(object):
                 print 'Source {} is inactive, but free'.format(m.source.name) 
                 continue # should be no inactive free sources?
             self.model_pixels += m.pix_counts
+        if self.vectorized:
+            self.fill_templates()
+
+    def fill_templates(self):
+        """ copy the pixel values of the free sources into the rows of a (nfree x npixels) array,
+        so that the free-source model and the pixel part of the gradient are each a single matrix product
+        """
+        nfree = len(self.free_sources)
+        self.last_counts = None # saved contributions refer to the old templates
+        self.template_version = getattr(self, 'template_version', 0)+1
+        self.templates = np.zeros((nfree, self.pixels))
+        self.template_refs = [None]*nfree # the arrays that were copied, to detect reinitialization
+        self.pix_norms = np.zeros(nfree)
+        for i, m in enumerate(self.free_sources):
+            self.set_template(i, m)
+
+    def set_template(self, i, bandsource):
+        """ (re)load row i of the template array from the pixel values of the bandsource """
+        pv = getattr(bandsource, 'pixel_values', None)
+        self.template_refs[i] = pv
+        self.templates[i] = 0 if pv is None else pv
+        self.template_version +=1
        
     def update(self, reset=False, force=False, **kwargs):
         """ assume that parameters have changed. Update only contributions 
@@ -133,20 +161,69 @@ class BandLike(object):
         force: bool, default False
             Force update of response even if source unchanged.
         """
-        self.model_pixels[:]=self.fixed_pixels
+        if self.band.has_pixels and not (reset or force) and self.last_counts is not None \
+                and 0 < self.updates_since_full < self.full_update_interval:
+            self.update_changed()
+        else:
+            self.model_pixels[:]=self.fixed_pixels
+            self.update_sources(reset, force)
+            if self.band.has_pixels and self.vectorized and len(self.free_sources)>0:
+                self.model_pixels += np.dot(self.pix_norms, self.templates)
+            self.save_contributions()
+        if self.band.has_pixels: 
+            self.weights = self.data / self.model_pixels
+
+    def save_contributions(self):
+        """ save the current counts and pixel predictions of the free sources, for update_changed """
+        self.updates_since_full = 1
+        if not self.band.has_pixels: return
+        self.last_counts = [m.counts for m in self.free_sources]
+        if not self.vectorized:
+            self.last_pix = [np.array(m.pix_counts, float) for m in self.free_sources]
+
+    def update_changed(self):
+        """ incremental update: for each free source that has changed, update it and add the 
+        difference from its previous contribution to model_pixels and counts
+        The accumulated rounding is removed by a full update every full_update_interval calls
+        """
+        self.updates_since_full += 1
+        for i, m in enumerate(self.free_sources):
+            if not m.source.changed: continue
+            m.update()
+            self.counts += m.counts - self.last_counts[i]
+            self.last_counts[i] = m.counts
+            if self.vectorized:
+                old = self.pix_norms[i] * self.templates[i]
+                if getattr(m, 'pixel_values', None) is not self.template_refs[i]:
+                    self.set_template(i, m)
+                self.pix_norms[i] = getattr(m, 'pix_norm', 0)
+                self.model_pixels += self.pix_norms[i] * self.templates[i] - old
+            else:
+                new = np.array(m.pix_counts, float)
+                self.model_pixels += new - self.last_pix[i]
+                self.last_pix[i] = new
+
+    def update_sources(self, reset=False, force=False):
+        """ update the responses of the free sources, and the total counts.
+        If not vectorized, also add their pixel predictions to model_pixels, 
+        which must have been set to fixed_pixels
+        """
         self.counts = self.fixed_counts
-        for bandsource in self.free_sources:
+        for i, bandsource in enumerate(self.free_sources):
             if reset: 
                 bandsource.initialize()
                 bandsource.source.changed=False
             elif bandsource.source.changed or force:
                 bandsource.update()
-            if self.band.has_pixels: 
+            if not self.band.has_pixels: continue
+            if self.vectorized:
+                # pixel values are replaced by a new array when a source is reinitialized
+                if getattr(bandsource, 'pixel_values', None) is not self.template_refs[i]:
+                    self.set_template(i, bandsource)
+                self.pix_norms[i] = getattr(bandsource, 'pix_norm', 0)
+            else:
                 self.model_pixels += bandsource.pix_counts
-                self.counts+= bandsource.counts
- 
-        if self.band.has_pixels: 
-            self.weights = self.data / self.model_pixels
+            self.counts+= bandsource.counts
  
     def log_like(self):
         """ return the Poisson extended log likelihood """
@@ -164,13 +241,46 @@ class BandLike(object):
         """ gradient of the likelihood with resepect to the free parameters
         """
         if len(self.free_sources)==0: return np.array([])
-        grads = []
-        for m in self.free_sources:
-            grads.append(m.grad(self.weights, self.exposure_factor))
-            
+        if self.vectorized and self.band.has_pixels:
+            # pixel terms for all free sources from one product with the weights
+            pixterms = np.dot(self.templates, self.weights)
+            return self.unweight * np.concatenate(
+                [m.grad(self.weights, self.exposure_factor, pixterm=p) 
+                    for m,p in zip(self.free_sources, pixterms)]
+            )
         return self.unweight * np.concatenate(
                 [m.grad(self.weights, self.exposure_factor) for m in self.free_sources]
             )
+
+    def fisher_hessian(self):
+        """ Fisher information (Gauss-Newton) approximation to the hessian of the negative 
+        log likelihood with respect to the free parameters:
+            sum over pixels of data/model_pixels**2 * (d model/d p_i) * (d model/d p_j)
+        where the model derivatives are the pixel values of each free source times the gradient
+        of its normalization. 
+        It is not the exact hessian: that has in addition the sum over pixels, and the counts, of 
+        (1 - data/model_pixels) times the second derivatives of the model, which vanish only if 
+        the model is linear in the parameters. It is small near the maximum, where the residuals 
+        average out, but not for parameters far from it. For a normalization with the usual log10 
+        internal parameter, the second derivative is ln(10) times the first, so the exact diagonal 
+        element is the Fisher one plus ln(10) times the gradient.
+        """
+        grads = [np.asarray(m.norm_gradient()) for m in self.free_sources]
+        npar = sum(map(len, grads))
+        if npar==0 or not self.band.has_pixels: return np.zeros((npar,npar))
+        if self.vectorized:
+            templates = self.templates
+        else:
+            templates = np.array([getattr(m, 'pixel_values', np.zeros(self.pixels)) for m in self.free_sources])
+        # source x source sums over pixels
+        c = np.dot(templates * (self.data/self.model_pixels**2), templates.T)
+        # expand to the parameters: each source row has its gradient in its parameter slots
+        j = np.zeros((len(grads), npar))
+        k=0
+        for i,g in enumerate(grads):
+            j[i,k:k+len(g)] = g
+            k += len(g)
+        return self.unweight * np.dot(j.T, np.dot(c, j))
        
     def model_counts(self, sourcemask=None):
         """ return the model predicted counts for all or a subset of the sources
@@ -284,12 +394,120 @@ class BandLike(object):
         assert not np.isnan(ret), 'NaN value detected at skydir {}'.format(skydir)
         return ret
     
-         
+
+class PackedBandLike(object):
+    """ Evaluate the likelihood and gradient for a list of (vectorized) BandLike objects together.
+    
+    The data, fixed model and free-source templates of all bands are concatenated into flat arrays,
+    with the offsets of each band. A selection of bands is a mask applied to the offsets, so that
+    log_like and gradient are a few operations on the arrays for the selected bands.
+    The model_pixels and weights of each selected BandLike are views into the packed arrays.
+    """
+    def __init__(self, bandlikes):
+        """ bandlikes : list of BandLike objects, all with vectorized=True
+        """
+        assert np.all([b.vectorized for b in bandlikes]), 'BandLike objects must be vectorized'
+        self.bandlikes = list(bandlikes)
+        self.pack()
+        self.select()
+
+    def __repr__(self):
+        return '%s.%s: %d/%d bands selected, %d pixels, %d free sources' % (self.__module__, 
+            self.__class__.__name__, len(self.selected), len(self.bandlikes), len(self.data), self.nfree)
+
+    def pack(self):
+        """ concatenate the arrays for all bands """
+        bls = self.bandlikes
+        self.nfree = len(bls[0].free_sources)
+        self.versions = [b.template_version for b in bls]
+        self.lengths = np.array([len(b.fixed_pixels) for b in bls], int)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)])
+        self.all_data = np.concatenate([np.asarray(b.data, float) for b in bls])
+        self.all_fixed = np.concatenate([b.fixed_pixels for b in bls])
+        self.all_templates = np.hstack([b.templates for b in bls])
+
+    def repack(self, k):
+        """ copy the fixed pixels and templates of band k, after a change """
+        b = self.bandlikes[k]
+        if b.templates.shape[0] != self.nfree:
+            # number of free sources changed: start over
+            self.pack()
+            return
+        a,z = self.offsets[k:k+2]
+        self.all_fixed[a:z] = b.fixed_pixels
+        self.all_templates[:,a:z] = b.templates
+        self.versions[k] = b.template_version
+
+    def select(self, band_mask=None):
+        """ select a subset of the bands
+        band_mask : None or array of bool
+            if None, select all
+        """
+        bls = self.bandlikes
+        mask = np.ones(len(bls), bool) if band_mask is None else np.asarray(band_mask, bool)
+        assert len(mask)==len(bls), 'mask must have an entry for each band'
+        self.band_mask = mask
+        self.selected = [b for b,m in zip(bls, mask) if m]
+        pixel_mask = np.repeat(mask, self.lengths)
+        self.data = self.all_data[pixel_mask]
+        self.fixed_pixels = self.all_fixed[pixel_mask]
+        self.templates = self.all_templates[:, pixel_mask]
+        lengths = self.lengths[mask]
+        offsets = self.selected_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.band_index = np.repeat(np.arange(len(lengths)), lengths) # selected band for each pixel
+        self.starts = offsets[:-1][lengths>0] # for reduceat, which must skip empty bands
+        self.has_pixels = lengths>0
+        self.unweights = np.array([b.unweight for b in self.selected])
+        self.unweight_pixels = self.unweights[self.band_index]
+        self.exposure_factors = np.array([b.exposure_factor for b in self.selected])
+
+        # the BandLike objects will see the packed model and weights
+        self.model_pixels = np.concatenate([b.model_pixels for b in self.selected])
+        self.weights = np.empty(len(self.data))
+        for b, a, z in zip(self.selected, offsets[:-1], offsets[1:]):
+            b.model_pixels = self.model_pixels[a:z]
+            b.weights = self.weights[a:z]
+
+    def update(self, reset=False, force=False, **kwargs):
+        """ update the free sources in the selected bands, then the packed model and weights """
+        for b in self.selected:
+            b.update_sources(reset, force)
+        changed = [k for k,b in enumerate(self.bandlikes) if b.template_version!=self.versions[k]]
+        if len(changed)>0:
+            for k in changed: self.repack(k)
+            self.select(self.band_mask)
+        self.counts = np.array([b.counts for b in self.selected])
+        if len(self.data)==0: return
+        self.model_pixels[:] = self.fixed_pixels
+        if self.nfree>0:
+            # a matrix-vector product per band: no temporary the size of the templates
+            offsets = self.selected_offsets
+            for b, a, z in zip(self.selected, offsets[:-1], offsets[1:]):
+                if z>a: self.model_pixels[a:z] += np.dot(b.pix_norms, self.templates[:,a:z])
+        np.divide(self.data, self.model_pixels, self.weights)
+
+    def log_like(self):
+        """ return the Poisson extended log likelihood, summed over the selected bands """
+        pix = np.sum(self.unweight_pixels * self.data * np.log(self.model_pixels))
+        return pix - np.sum(self.unweights * self.counts * self.exposure_factors)
+
+    def gradient(self):
+        """ gradient of the likelihood with respect to the free parameters, summed over selected bands
+        """
+        if self.nfree==0: return np.array([])
+        pixterms = np.zeros((self.nfree, len(self.selected)))
+        if len(self.starts)>0:
+            pixterms[:, self.has_pixels] = np.add.reduceat(self.templates * self.weights, self.starts, axis=1)
+        return np.sum([u * np.concatenate(
+                    [m.grad(None, b.exposure_factor, pixterm=p) for m,p in zip(b.free_sources, pt)])
+                for b, u, pt in zip(self.selected, self.unweights, pixterms.T)], axis=0)
+
+
 class BandLikeList(list):
     """Manage a list of BandLike objects
     """
     
-    def __init__(self, roi_bands, roi_sources):
+    def __init__(self, roi_bands, roi_sources, **kwargs):
         """ create a list, one per band, of BandLike objects for a given ROI 
         Methods to calculate the likelihood, gradient, and hessian
         
@@ -298,7 +516,17 @@ class BandLikeList(list):
         roi_bands : list of ROIBand objects
         roi_sources :  sourcelist.SourceList object
             a list of Source objects 
+        kwargs : passed to each BandLike object, e.g. vectorized=True
+            packed : bool
+                if set, evaluate all selected bands together with a PackedBandLike object
+                (implies vectorized)
+            fisher_hessian : bool
+                if set, hessian is the Fisher information approximation rather than a numerical derivative
         """
+        self.packed = kwargs.pop('packed', False)
+        self.fisher_hessian = kwargs.pop('fisher_hessian', False)
+        if self.packed: kwargs['vectorized']=True
+        self.bandlike_kw = kwargs
         self.setup(roi_bands, roi_sources)
         
     def setup(self, roi_bands, roi_sources):
@@ -311,10 +539,14 @@ class BandLikeList(list):
         config = roi_bands.config #set global
         while len(self)>0:
             self.pop()
+        self.packer = None
         for band in roi_bands:
-            bl = BandLike(band, self.sources, self.sources.free, self) 
+            bl = BandLike(band, self.sources, self.sources.free, self, 
+                **getattr(self, 'bandlike_kw', {})) 
             self.append( bl)
             
+        if getattr(self, 'packed', False):
+            self.packer = PackedBandLike(self)
         self.set_selected(self)# set selected for a subset?
         self.all_energies = self.energies[:]
         self.roi_dir = roi_bands.roi_dir
@@ -324,9 +556,11 @@ class BandLikeList(list):
         """setter for the property selected, which must be a subset of self"""
         if values in self: # single guy
             self._selected = [values]
-            return
-        assert set(values).issubset(self), 'Improper selection'
-        self._selected = values
+        else:
+            assert set(values).issubset(self), 'Improper selection'
+            self._selected = values
+        if getattr(self, 'packer', None) is not None:
+            self.packer.select([b in self._selected for b in self])
     def get_selected(self):
         return self._selected
     selected = property(get_selected, set_selected)
@@ -438,9 +672,11 @@ class BandLikeList(list):
         for b in self._selected:
             if sourcename is not None:
                 b[sourcename].initialize()
+                b.last_counts = None # its contribution changed: not an incremental update
             else:
                 b.initialize(free if free is not None else self.sources.free)
-            b.update()
+            if self.packer is None: b.update()
+        if self.packer is not None: self.packer.update()
         
     # the following methods sum over the current set of bands
     def log_like(self, summed=True):
@@ -448,30 +684,75 @@ class BandLikeList(list):
         summed : bool, optional
         if false, return the array of likelihods for each band
         """
+        if summed and self.packer is not None:
+            return self.packer.log_like()
         r = np.array([b.log_like() for b in self._selected])
         return  sum(r) if summed else r
         
     def update(self, **kwargs):
-        for b in self._selected: 
-            b.update( **kwargs)
+        if self.packer is not None:
+            self.packer.update(**kwargs)
+        else:
+            for b in self._selected: 
+                b.update( **kwargs)
         self.sources.parameters.clear_changed()
         
     def gradient(self):
+        if self.packer is not None:
+            return self.packer.gradient()
         return np.array([blike.gradient() for blike in self._selected]).sum(axis=0) 
         
-    def hessian(self, mask=None, delta=1e-6):
+    def hessian(self, mask=None, delta=1e-6, fisher=None):
         """ return a hessian matrix based on the current parameter set
         This makes a numerical derivative of the analytic gradient, so not exactly
         symmetric, but the the result must be (nearly) symmetric.
         
         mask : [None | array of bool]
             If present, must have dimension of the parameters, will generate a sub matrix
+        fisher : [None | bool]
+            If True, sum the Fisher information approximation from the bands, see 
+            BandLike.fisher_hessian. If None, use the fisher_hessian setting, falling back to the 
+            numerical derivative if a response does not provide the gradient of its normalization.
         
         For sigmas and correlation coefficients, invert to covariance
                 cov =  self.hessian().I
                 sigs = np.sqrt(cov.diagonal())
                 corr = cov / np.outer(sigs,sigs)
         """
+        if fisher: 
+            return self.fisher_hessian_matrix(mask)
+        if fisher is None and getattr(self, 'fisher_hessian', False):
+            try:
+                return self.fisher_hessian_matrix(mask)
+            except (AttributeError, NotImplementedError), msg:
+                print 'Fisher hessian not available, using numerical derivative: %s' % msg
+        return self.numerical_hessian(mask, delta)
+
+    def fisher_hessian_matrix(self, mask=None):
+        """ the Fisher information approximation to the hessian, summed over the selected bands
+        mask : [None | array of bool]
+            If present, must have dimension of the parameters, will generate a sub matrix
+        """
+        hess = np.sum([b.fisher_hessian() for b in self._selected], axis=0)
+        if mask is None: return hess
+        mask = np.asarray(mask)
+        assert len(mask)==len(hess)
+        return hess[mask][:,mask]
+
+    def check_hessian(self, mask=None, delta=1e-6):
+        """ compare the Fisher approximation and the numerical hessian
+        return a tuple with the two, and the maximum difference relative to the diagonal
+        """
+        ha = self.fisher_hessian_matrix(mask)
+        hn = self.numerical_hessian(mask, delta)
+        d = np.sqrt(np.outer(np.abs(hn.diagonal()), np.abs(hn.diagonal())))
+        return ha, hn, np.max(np.abs(ha-hn)/d) if len(d)>0 else 0
+
+    def numerical_hessian(self, mask=None, delta=1e-6):
+        """ return a hessian matrix from a numerical derivative of the analytic gradient
+        mask : [None | array of bool]
+            If present, must have dimension of the parameters, will generate a sub matrix
+        """
         # get the source parameter management object
         parameters = self.sources.parameters
         parz = parameters.get_parameters()
@@ -5,6 +5,7 @@ import os
 import numpy as np
 import skymaps
 import healpy
+from . import response, exposure, statecache
 
 #energybins = np.logspace(2,5.5,15) # default 100 MeV to 3.16 GeV, 4/decade
 energybins = np.logspace(2,6,17) # 100 MeV to 1 TeV, 4/decade
@@ -114,10 +115,23 @@ class BandSet(list):
             self.roi_index = roi_index
             self.roi_dir = skymaps.Band(12).dir(roi_index) # could be defined otherwise
             self.radius=radius
+        # point source response values shared by all bands in the ROI
+        self.response_cache = response.PointResponseCache()
+        # optional persistent copy of the response values, for a warm start
+        state_folder = config.get('state_cache', None)
+        self.state_cache = statecache.StateCache(config, roi_index, state_folder, quiet=config.quiet)\
+                if state_folder is not None and roi_index is not None else None
         for emin, emax  in zip(energybins[:-1], energybins[1:]):
             for et in config.dataset.event_types:
                 if emin<event_type_min_energy[et]: continue
-                self.append(EnergyBand(config, self.roi_dir,  event_type=et, radius=self.radius, emin=emin,emax=emax))
+                band = EnergyBand(config, self.roi_dir,  event_type=et, radius=self.radius, emin=emin,emax=emax)
+                band.response_cache = self.response_cache
+                band.state_cache = self.state_cache
+                self.append(band)
+        # spectral model integrals evaluated for all bands together, saved per model
+        self.batch_integrator = exposure.BatchExposureIntegral([band.integrator for band in self])
+        for i, band in enumerate(self):
+            band.integrator = self.batch_integrator.band_integrator(i)
         self.has_data = False
         
         if load:
@@ -142,8 +156,15 @@ class BandSet(list):
         """
         dset = self.config.dataset
         dset.load()
+        dmap = dset.dmap
+        if hasattr(dmap, 'roi_view'):
+            # only need the pixels in the ROI
+            dmap = dmap.roi_view(self.roi_dir.l(), self.roi_dir.b(), self.radius)
+        self.response_cache.clear() # pixel values depend on the data
+        if self.state_cache is not None:
+            self.response_cache.restore(self.state_cache)
         found = 0
-        for i,cband in enumerate(dset.dmap):
+        for i,cband in enumerate(dmap):
             emin, emax, event_type =  cband.emin(), cband.emax(), cband.event_class()
             if event_type == -2147483648: event_type=0 # previous bug in FITS setup
             try:
@@ -159,6 +180,13 @@ class BandSet(list):
             self.config.emax=self[-1].emax
         self.has_data = True
 
+    def save_state(self):
+        """ save the response values in the state cache, if enabled, for a subsequent warm start
+        """
+        if self.state_cache is None: return
+        self.response_cache.save(self.state_cache)
+        self.state_cache.save()
+
     @property
     def pixels(self): return sum( band.pixels for band in self) if self.has_data else 0
     @property
@@ -43,6 +43,9 @@ class FillMixin(object):
         if dm is None:
             assert cache is not None, 'Logic error'
             self.bg_vals = self.fill(exp) * cache
+        elif hasattr(dm, 'vector_values') and self.grid_vectors() is not None:
+            # evaluate the diffuse model for all grid points at once
+            self.bg_vals = self.fill(exp) * dm.vector_values(self.grid_vectors()).reshape([self.npix,self.npix])
         else:
             def exp_dm(skydir):
                     return exp(skydir)*dm(skydir)
@@ -59,6 +62,35 @@ class FillMixin(object):
         if np.any(nans) and ignore_nan:
             self.bg_vals[nans]=0
             
+    def grid_vectors(self):
+        """ return a (npix*npix, 3) array of Galactic unit vectors of the grid points, in the order
+        used by fill, or None if they are not consistent with the grid rotation of the C++ code. 
+        The grid, on the equator at the longitude of the center, is rotated about the axis 
+        at 90 degrees longitude from it to the latitude of the center.
+        """
+        if hasattr(self, '_grid_vectors'): return self._grid_vectors
+        self._grid_vectors = None
+        lon, lat = [np.radians(np.array(list(x))) for x in (self.lons, self.lats)]
+        lon, lat = [x.ravel() for x in np.meshgrid(lon, lat, indexing='ij')]
+        v = np.array([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)]).T
+        l0, b0 = np.radians(self.center.l()), np.radians(self.center.b())
+        axis = np.array([np.cos(l0+np.pi/2), np.sin(l0+np.pi/2), 0])
+        cvec = np.array([np.cos(b0)*np.cos(l0), np.cos(b0)*np.sin(l0), np.sin(b0)])
+        for angle in (b0, -b0):
+            # Rodrigues formula, for rotation by angle about axis
+            c, s = np.cos(angle), np.sin(angle)
+            r = v*c + np.cross(axis, v)*s + np.outer(np.dot(v, axis), axis)*(1-c)
+            if np.dot(r[len(r)//2], cvec) > 1-1e-10: break
+        else:
+            return None
+        # check a corner against the C++ rotation 
+        x, y = self.pix(skymaps.SkyDir(np.degrees(np.arctan2(r[0,1],r[0,0])), 
+                    np.degrees(np.arcsin(r[0,2])), skymaps.SkyDir.GALACTIC))
+        if abs(x)>1e-3 or abs(y)>1e-3:
+            return None
+        self._grid_vectors = r
+        return r
+
     def psf_fill(self, psf):
         """ Evaluate PSF on the grid
         """
@@ -266,6 +266,11 @@ class DataSet(dataman.DataSpec):
  
     def _load_binfile(self):
         if not self.quiet: print 'loading binfile %s ...' % self.binfile ,
+        if os.path.isdir(self.binfile):
+            # memory-mapped pixel store, see binned_data.PixelStore
+            self.dmap = binned_data.PixelStore(self.binfile)
+            if not self.quiet: print self.dmap
+            return
         try:
             self.dmap = skymaps.BinnedPhotonData(self.binfile)  
             if not self.quiet: print 'found %d photons in %d bands, energies %.0f-%.0f MeV'\
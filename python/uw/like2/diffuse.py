@@ -8,6 +8,7 @@ author:  Toby Burnett
 import os, types, collections, zipfile, pickle, glob
 import numpy as np
 import pandas as pd
+import healpy
 from astropy.io import fits
 from astropy import wcs
 
@@ -189,8 +190,49 @@ class MapCube(DiffuseBase, skymaps.DiffuseFunction):
         self.energies = np.array(self.energies(), float)
 
 
+def log_interpolate(u, v, a):
+    """ logarithmic interpolation between arrays u and v, with fraction a, a scalar or array.
+    Use u or v if a is within 0.01 of 0 or 1, or the other is not positive or nan; negative results are zero
+    """
+    u, v = np.asarray(u, float), np.asarray(v, float)
+    a = a * np.ones(u.shape)
+    use_u = (np.abs(a)<1e-2) | ~(v>0)
+    use_v = ~use_u & ((np.abs(1-a)<1e-2) | ~(u>0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ret = np.exp(np.log(u) * (1-a) + np.log(v) * a)
+    ret = np.where(use_u, u, np.where(use_v, v, ret))
+    with np.errstate(invalid='ignore'):
+        ret[ret<=0] = 0
+    return ret
+
+class ColumnPlane(object):
+    """ A FITS table column, with shape (rows, n), indexed as a flat HEALPix array without copying it.
+    With a memory-mapped table, only the pages containing the requested pixels are read.
+    """
+    def __init__(self, column):
+        self.column = column
+        self.n = column.shape[1] if column.ndim>1 else 1
+
+    def __len__(self):
+        return len(self.column)*self.n
+
+    def __getitem__(self, index):
+        if self.n==1: 
+            return self.column[index]
+        row, k = np.divmod(index, self.n)
+        return self.column[row, k]
+
+    def __array__(self, dtype=None):
+        return np.asarray(np.ravel(self.column), dtype)
+
+
 class HealpixCube(DiffuseBase):
     """ Jean-Marc's vector format, or the column version
+    
+    astropy memory-maps the FITS file, unless compressed, and in the column version the energy planes are
+    ColumnPlane views: indexing reads only the pages of the two planes bracketing the energy that hold the
+    pixels indexed, and these are shared by all processes on a node. Nothing restricts the reads to the rows
+    of an ROI; column, and the vector format, read whole planes.
     """
     def __init__(self,filename):
         """ filename : string
@@ -222,7 +264,7 @@ class HealpixCube(DiffuseBase):
                 hdu1 = hdus[1]
                 assert len(hdu1.columns)==len(self.energies) , 'wrong number of columns'
                 self.data = hdu1.data
-                self.nside = int(np.sqrt(self.data.field(0).flatten().shape[0]/12.))
+                self.nside = int(np.sqrt(np.prod(self.data.field(0).shape)/12.))
                 
             self.loaded=True
             self.indexfun = skymaps.Band(self.nside).index
@@ -267,6 +309,51 @@ class HealpixCube(DiffuseBase):
             ret = 0
         return ret
 
+    def pixel_values(self, hpindex, energy=None):
+        """ return an array of values for an array of HEALPix (RING) indices
+        energy : None, float, or array of float with the same length as hpindex
+            if None, use the current energy
+        The interpolation is the same as for __call__, for all points at once
+        """
+        if not self.loaded:
+            self.load()
+        hpindex = np.asarray(hpindex, int)
+        if energy is not None and np.ndim(energy)>0:
+            # group by the pair of energy planes used for the interpolation
+            energy = np.asarray(energy, float)
+            i = np.clip(np.searchsorted(self.energies, energy)-1, 0, len(self.energies)-2)
+            ret = np.empty(len(hpindex))
+            for k in np.unique(i):
+                sel = i==k
+                u, v = self.plane(k)[hpindex[sel]], self.plane(k+1)[hpindex[sel]]
+                a = (np.log(energy[sel])-self.loge[k])/(self.loge[k+1]-self.loge[k])
+                ret[sel] = log_interpolate(u, v, a)
+        else:
+            if energy is not None and energy!=self.energy: 
+                self.setEnergy(energy)
+            ret = log_interpolate(self.eplane1[hpindex], self.eplane2[hpindex], 
+                        self.energy_interpolation)
+        assert np.all(np.isfinite(ret)), 'Not finite for {} pixels at {} MeV'.format(
+                    np.sum(~np.isfinite(ret)), self.energy)
+        return ret
+
+    def vector_values(self, vecs, energy=None):
+        """ return an array of values for a (N,3) array of Galactic unit vectors
+        """
+        vecs = np.asarray(vecs)
+        return self.pixel_values(healpy.vec2pix(self.nside, vecs[:,0], vecs[:,1], vecs[:,2]), energy)
+
+    def values(self, skydirs, energy=None):
+        """ return an array of values for a list of SkyDir objects
+        """
+        return self.pixel_values(map(self.indexfun, skydirs), energy)
+
+    def plane(self, index):
+        """ return the energy plane with the index, as an array in HEALPix order """
+        if self.vector_mode:
+            return self.spectra[:,index]
+        return ColumnPlane(self.data.field(index))
+
     def setEnergy(self, energy): 
         # set up logarithmic interpolation
         if not self.loaded:
@@ -282,24 +369,21 @@ class HealpixCube(DiffuseBase):
         a,b = self.loge[i], self.loge[i+1]
         self.energy_index = i #= max(0, min(int(r), len(self.energies)-2))
         self.energy_interpolation = (np.log(energy)-a)/(b-a)
-        if self.vector_mode:
-            self.eplane1 = self.spectra[:,i]
-            self.eplane2 = self.spectra[:,i+1]
-        else:
-            self.eplane1 = np.ravel(self.data.field(i))
-            self.eplane2 = np.ravel(self.data.field(i+1))
+        self.eplane1 = self.plane(i)
+        self.eplane2 = self.plane(i+1)
             
     def column(self, energy):
         """ return a full HEALPix-ordered column for the given energy
         """
         self.setEnergy(energy)
         a = self.energy_interpolation
+        eplane1, eplane2 = np.asarray(self.eplane1), np.asarray(self.eplane2)
         if a<0.002:
-            return self.eplane1
+            return eplane1
         elif a>0.998:
-            return self.eplane2
-        return np.exp( np.log(self.eplane1) * (1-a) 
-             + np.log(self.eplane2) * a      )
+            return eplane2
+        return np.exp( np.log(eplane1) * (1-a) 
+             + np.log(eplane2) * a      )
     @property        
     def array(self):
         """return data as a 2-D Numpy array"""
@@ -3,7 +3,7 @@ Implements exposure calcuations
 
 $Header: /nfs/slac/g/glast/ground/cvs/pointlike/python/uw/like2/exposure.py,v 1.6 2017/08/02 22:57:11 burnett Exp $
 """
-import os
+import os, weakref
 import numpy as np
 import skymaps
 from astropy.io import fits as  pyfits
@@ -136,11 +136,131 @@ class ExposureIntegral(object):
                               np.asarray([1.] + ([4.,2.]*(self.nsp_simps/2))[:-1] + [1.])
         self.sp_vector = sp * exp_points * simps_weights
         
-    def  __call__(self, model_function):
+    def  __call__(self, model_function, gradient=False):
         """ return integral over exposure for function of differential flux 
         model_function : function
             if it returns an array, if it is a gradient, tnen axis should be 1
+        gradient : bool
+            if set, model_function is a spectral model: integrate its gradient
         """
-        axis = 1 if hasattr(model_function(self.sp_points[0]), '__iter__') else None
-        return (model_function(self.sp_points)*self.sp_vector).sum(axis=axis)
+        if gradient: model_function = model_function.gradient
+        # a gradient returns (npar x npoints), so the product sums over the points in either case
+        return np.dot(model_function(self.sp_points), self.sp_vector)
+
+
+def model_state(model):
+    """ return a summary of everything that determines the values of a spectral model,
+    for comparison with a saved state """
+    extra = [getattr(model, k, None) for k in 
+        list(getattr(model, 'default_extra_params', {}).keys()) + list(getattr(model, 'default_extra_attrs', {}).keys())]
+    return (model.__class__.__name__, tuple(model._p), repr(extra))
+
+
+class BatchExposureIntegral(object):
+    """ Exposure integrals for a set of bands, evaluated together.
+    
+    The Simpson's rule energies and weights of the ExposureIntegral objects for the bands are 
+    combined into (bands x points) arrays, so a spectral model, or its gradient, is evaluated
+    once for all bands. Results are saved for each model with the parameters used, so 
+    evaluations for unchanged sources cost nothing.
+    """
+    def __init__(self, integrators):
+        """ integrators : list of ExposureIntegral objects, one per band
+        """
+        npts = max([len(ei.sp_points) for ei in integrators])
+        nbands = len(integrators)
+        self.energies = np.empty((nbands, npts))
+        self.weights = np.zeros((nbands, npts))
+        for i, ei in enumerate(integrators):
+            n = len(ei.sp_points)
+            self.energies[i,:n] = ei.sp_points 
+            self.energies[i,n:] = ei.sp_points[-1] # padding, with zero weight
+            self.weights[i,:n] = ei.sp_vector
+        self.flat_energies = self.energies.flatten()
+        self.integrators = integrators
+        self.clear()
+
+    def __repr__(self):
+        return '%s.%s: %d bands, %d saved models' % (self.__module__, self.__class__.__name__, 
+            len(self.integrators), len(self.saved))
+
+    def clear(self):
+        # key model, value [state, values, gradient]: an entry goes when its model does
+        self.saved = weakref.WeakKeyDictionary()
+
+    def _entry(self, model):
+        state = model_state(model)
+        entry = self.saved.get(model, None)
+        if entry is None or entry[0]!=state:
+            entry = self.saved[model] = [state, None, None]
+        return entry
+
+    def __call__(self, model):
+        """ return an array with the integral over exposure of the model for each band """
+        entry = self._entry(model)
+        if entry[1] is None:
+            entry[1] = self.integrate([model])[0]
+        return entry[1]
+
+    def gradient(self, model):
+        """ return a (bands x npar) array of the integrals of the model gradient """
+        entry = self._entry(model)
+        if entry[2] is None:
+            g = model.gradient(self.flat_energies).reshape((-1,)+self.energies.shape)
+            entry[2] = np.einsum('pbk,bk->bp', g, self.weights)
+        return entry[2]
+
+    def integrate(self, models):
+        """ return a (models x bands) array of the integrals for a list of models,
+        evaluated as a single array product
+        """
+        if len(models)==0: return np.zeros((0, len(self.integrators)))
+        f = np.array([m(self.flat_energies) for m in models]).reshape((len(models),)+self.energies.shape)
+        return np.einsum('sbk,bk->sb', f, self.weights)
+
+    def integrate_sets(self, model, pars):
+        """ return a (sets x bands) array of the integrals of the model, for each row of the
+        (sets x npar) array of external parameters pars; see Models.Model.batch_call
+        """
+        pars = np.atleast_2d(pars)
+        f = model.batch_call(pars, self.flat_energies).reshape((len(pars),)+self.energies.shape)
+        return np.einsum('sbk,bk->sb', f, self.weights)
+
+    def gradient_sets(self, model, pars):
+        """ return a (sets x npar x bands) array of the integrals of the gradient of the model with
+        respect to its external parameters, for each row of pars
+        """
+        pars = np.atleast_2d(pars)
+        g = model.batch_external_gradient(pars, self.flat_energies)
+        g = g.reshape((len(pars), model.npar)+self.energies.shape)
+        return np.einsum('spbk,bk->spb', g, self.weights)
+
+    def update(self, models):
+        """ evaluate, together, the integrals for those models that changed since the last call """
+        changed = [m for m in models if self._entry(m)[1] is None]
+        for m, v in zip(changed, self.integrate(changed)):
+            self.saved[m][1] = v
+
+    def band_integrator(self, index):
+        return BandIntegral(self, index)
+
+
+class BandIntegral(object):
+    """ Integrator for a single band of a BatchExposureIntegral, with the interface of ExposureIntegral.
+    Models, and their gradient methods, are integrated for all bands at once; other functions use 
+    the band's ExposureIntegral.
+    """
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+        self.integral = batch.integrators[index]
+
+    def __repr__(self):
+        return '%s.%s: band %d of %s' % (self.__module__, self.__class__.__name__, self.index, self.batch)
+
+    def __call__(self, model_function, gradient=False):
+        """ see ExposureIntegral.__call__ """
+        if hasattr(model_function, '_p'):
+            return (self.batch.gradient if gradient else self.batch)(model_function)[self.index]
+        return self.integral(model_function, gradient)
 
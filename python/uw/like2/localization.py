@@ -6,10 +6,10 @@ $Header: /nfs/slac/g/glast/ground/cvs/pointlike/python/uw/like2/localization.py,
 """
 import os,sys
 import numpy as np
-from skymaps import SkyDir
+from skymaps import SkyDir, Hep3Vector
 from uw.like import quadform
 from uw.utilities import keyword_options
-from . import (sources, plotting )
+from . import (sources, plotting, views, response )
 
 def moment_analysis(tsmap, wcs, fudge=1.44):
     """ perform localization by a moment analysis of a TS map
@@ -94,7 +94,8 @@ class MomentAnalysis(object):
 
         
 def full_localization(roi, source_name=None, ignore_exception=False, 
-            update=False, associator=None, tsmap_dir='tsmap_fail', tsfits=False, delta_ts_bad=10):
+            update=False, associator=None, tsmap_dir='tsmap_fail', tsfits=False, delta_ts_bad=10,
+            gradient=False):
     import pylab as plt
 
     source = roi.sources.find_source(source_name)
@@ -102,7 +103,7 @@ def full_localization(roi, source_name=None, ignore_exception=False,
     tsp=None
     with roi.tsmap_view(source.name) as tsm:
 
-        loc = Localization(tsm)
+        loc = GradientLocalization(tsm) if gradient else Localization(tsm)
         try:
             if not loc.localize():
                 print 'Failed'
@@ -341,6 +342,189 @@ class Localization(object):
             print len(p)*'%10.4f' % tuple(p)
 
 
+
+class EllipsePar(object):
+    """ the fit results of a GradientLocalization, with the par list of quadform.Localize """
+    def __init__(self, par, sigma):
+        self.par, self.sigma = par, sigma
+
+class GradientLocalization(Localization):
+    """ localization using the gradient and curvature of the likelihood with respect to position
+
+    The pixel predictions of the other sources are fixed, and the PSF values of the source, with
+    their first and second derivatives with respect to the distance from the source, are evaluated
+    for all the data pixels of each band. The gradient and Hessian in the tangent plane follow from
+    these and the data weights, so Newton steps find the maximum, and the inverse of the Hessian is
+    the error ellipse. The position of the source is not changed.
+    """
+    defaults = Localization.defaults + (
+        ('max_step', 0.1, 'maximum step, in degrees'),
+        ('overlap_delta', 0.01, 'offset, in degrees, for the numerical derivative of the aperture overlap'),
+    )
+
+    @keyword_options.decorate(defaults)
+    def __init__(self, tsm, **kwargs):
+        super(GradientLocalization, self).__init__(tsm, **kwargs)
+        blike, name = tsm.blike, tsm.source.name
+        self.bands = []
+        for b in blike.selected:
+            response = b[name]
+            if not response.active: continue
+            band = b.band
+            entry = dict(band=band, counts=response.expected*b.exposure_factor*b.unweight)
+            if band.has_pixels:
+                entry.update(data=np.asarray(b.data, float)*b.unweight,
+                    fixed=np.array(b.model_pixels - response.pix_counts, float),
+                    norm=response.expected*band.pixel_area,
+                    pixels=views.unit_vectors(band.wsdl))
+            self.bands.append(entry)
+
+    @staticmethod
+    def tangent_basis(x):
+        """ unit vectors in the directions of increasing RA and Dec at the unit vector x """
+        east = np.array([-x[1], x[0], 0])
+        east = east/np.sqrt((east**2).sum()) if np.any(east!=0) else np.array([0.,1.,0.])
+        return east, np.cross(x, east)
+
+    def psf_derivatives(self, psf, r):
+        """ PSF value, first and second derivatives, at the distances r in radians """
+        if hasattr(psf, 'derivatives'): return psf.derivatives(r)
+        h = 1e-5
+        f0, fp, fm = [np.asarray(psf(np.abs(r+d))) for d in (0, h, -h)]
+        return f0, (fp-fm)/(2*h), (fp-2*f0+fm)/h**2
+
+    def _overlap(self, band, x):
+        return response.psf_overlap(band, SkyDir(Hep3Vector(*x)))
+
+    def overlap_derivatives(self, band, x, east, north):
+        """ aperture overlap at x, with its gradient and Hessian in the tangent plane, from
+        central differences of the C++ overlap with offset overlap_delta
+        """
+        h = np.radians(self.overlap_delta)
+        ov = lambda a, b: self._overlap(band, x + h*(a*east + b*north))
+        f0 = ov(0,0)
+        fe, fw, fn, fs = ov(1,0), ov(-1,0), ov(0,1), ov(0,-1)
+        grad = np.array([fe-fw, fn-fs])/(2*h)
+        mixed = (ov(1,1) - ov(1,-1) - ov(-1,1) + ov(-1,-1))/(4*h**2)
+        hess = np.array([[(fe-2*f0+fw)/h**2, mixed], [mixed, (fn-2*f0+fs)/h**2]])
+        return f0, grad, hess
+
+    def loglike_position(self, x, derivatives=False):
+        """ log likelihood for the source at the unit vector x, relative to the model without it,
+        and, if derivatives is set, its gradient and Hessian in the tangent plane (radians)
+        """
+        w, grad, hess = 0, np.zeros(2), np.zeros((2,2))
+        east, north = self.tangent_basis(x)
+        for entry in self.bands:
+            band = entry['band']
+            if derivatives:
+                # aperture term, by numerical differentiation of the C++ overlap
+                ov, dov, d2ov = self.overlap_derivatives(band, x, east, north)
+                grad -= entry['counts'] * dov
+                hess -= entry['counts'] * d2ov
+            else:
+                ov = self._overlap(band, x)
+            w -= entry['counts'] * ov
+            if 'data' not in entry: continue
+            p = entry['pixels']
+            c = np.clip(np.dot(p, x), -1, 1)
+            ab = np.array([np.dot(p, east), np.dot(p, north)]) # (2 x pixels)
+            s = np.sqrt((ab**2).sum(axis=0))
+            r = np.arctan2(s, c)
+            f, f1, f2 = self.psf_derivatives(band.psf, r)
+            model = entry['fixed'] + entry['norm']*f
+            d = entry['data']
+            w += np.dot(d, np.log(model/entry['fixed']))
+            if not derivatives: continue
+            # derivatives of r: grad r = -ab/s, hessian r = c/s (I - ab ab^T/s^2)
+            s = np.maximum(s, 1e-10)
+            u = ab/s # unit vector toward each pixel
+            dmu = -entry['norm'] * f1 * u # gradient of the pixel counts
+            # f1/s is finite as s->0, since the PSF is flat at the center
+            d2mu = entry['norm'] * ((f2 - f1*c/s) * u[:,None,:]*u[None,:,:] 
+                        + (f1*c/s) * np.eye(2)[:,:,None])
+            grad += np.dot(dmu, d/model)
+            hess += np.dot(d2mu, d/model) - np.dot(dmu*(d/model**2), dmu.T)
+        if not derivatives: return w
+        return w, grad, hess
+
+    def localize(self):
+        """ Localize the source with Newton iterations using the analytic gradient and Hessian
+        Sets the ellipse dict, like Localization.localize; return True if successful
+        """
+        x0 = views.unit_vectors([self.skydir])[0]
+        x = x0.copy()
+        ll0 = self.loglike_position(x)
+        w = ll0
+        max_step = np.radians(self.max_step)
+        if not self.quiet:
+            print 'Localizing source %s with gradient, tolerance=%.1e' % (self.name, self.tolerance)
+        converged = False
+        for i in xrange(self.max_iteration):
+            w, grad, hess = self.loglike_position(x, True)
+            east, north = self.tangent_basis(x)
+            try:
+                negdef = np.all(np.linalg.eigvalsh(hess)<0)
+            except np.linalg.LinAlgError:
+                negdef = False
+            step = -np.linalg.solve(hess, grad) if negdef else grad*max_step/np.sqrt((grad**2).sum())
+            length = np.sqrt((step**2).sum())
+            if length>max_step: step *= max_step/length
+            for j in range(5):
+                xt = x + step[0]*east + step[1]*north
+                xt /= np.sqrt((xt**2).sum())
+                wt = self.loglike_position(xt)
+                if wt >= w-1e-6: break
+                step /= 2
+            x, w = xt, wt
+            delt = np.degrees(np.arccos(np.clip(np.dot(x, x0), -1, 1)))
+            if not self.quiet:
+                print '\t%3d %10.4f %10.4f %10.2f' % (i, np.degrees(np.sqrt((step**2).sum())), delt, 2*(w-ll0))
+            if delt>self.maxdist:
+                if not self.quiet: print '\t -attempt to move beyond maxdist=%.1f' % self.maxdist
+                break
+            if np.degrees(np.sqrt((step**2).sum())) < self.tolerance:
+                converged = True
+                break
+
+        # the ellipse, from the quadratic form for TS=2 log likelihood in degrees at the final position
+        w, grad, hess = self.loglike_position(x, True)
+        k = np.radians(1)
+        pq = [k**2*hess[0,0], 2*k*grad[0], k**2*hess[1,1], 2*k*grad[1], 2*k**2*hess[0,1], 2*w]
+        skydir = SkyDir(Hep3Vector(*x))
+        try:
+            a, b, phi = quadform.Ellipse(pq, convert=True, raw=False).q[:3]
+            qual = self.quality(x, a, b, phi) if converged and delt<=self.maxdist else 99.
+        except Exception, msg:
+            if not self.quiet: print 'Failed to make ellipse: %s' % msg
+            a = b = 1.0; phi = 0; qual = 99.
+        if qual==99.: skydir = self.skydir
+        self.ellipse = dict(ra=skydir.ra(), dec=skydir.dec(), a=float(a), b=float(b),
+                ang=float(np.degrees(phi)), qual=float(qual), lsigma=float(np.sqrt(a*b)))
+        self.delta_ts = 2*(w-ll0)
+        self.delt = np.degrees(np.arccos(np.clip(np.dot(x, x0), -1, 1)))
+        self.niter = i+1
+        self.qform = EllipsePar([self.ellipse[q] for q in 'ra dec'.split()] + [2*w] 
+            + [self.ellipse[q] for q in 'a b ang qual'.split()], self.ellipse['lsigma'])
+        self.tsm.source.ellipse = self.qform.par[0:2]+self.qform.par[3:7] +[self.delta_ts] 
+        if not self.quiet: self.summary()
+        return qual<99
+
+    def quality(self, x, a, b, phi, radius=2.5):
+        """ quality factor, as in quadform.Localize.quality: sqrt of the sum of squares of the
+        differences of TS at points on the ellipse, at radius sigma, from the expected value
+        """
+        ell = quadform.Ellipse([a, b, phi, 0, 0, 0], raw=False)
+        xp, yp = ell.contour(radius, 8)
+        east, north = self.tangent_basis(x)
+        tszero = 2*self.loglike_position(x) - radius**2
+        ts = []
+        for dx, dy in zip(xp, yp):
+            # the contour x coordinate is measured to the west
+            xt = x + np.radians(-dx)*east + np.radians(dy)*north
+            ts.append(2*self.loglike_position(xt/np.sqrt((xt**2).sum())))
+        return np.sqrt(((np.array(ts)-tszero)**2).sum())
+
        
 def localize_all(roi, ignore_exception=True, **kwargs):
     """ localize all variable local sources in the roi, make TSmaps and associations if requested 
@@ -351,6 +535,7 @@ def localize_all(roi, ignore_exception=True, **kwargs):
     prefix = kwargs.pop('prefix', None)
     source_name = kwargs.pop('source_name', None)
     update = kwargs.pop('update', False)
+    gradient = kwargs.pop('gradient', False)
     def filt(s):
         ok = s.skydir is not None\
             and isinstance(s, sources.PointSource) \
@@ -379,7 +564,7 @@ def localize_all(roi, ignore_exception=True, **kwargs):
         if prefix is not None and not source.name.startswith(prefix): continue
         
         full_localization(roi, source.name, ignore_exception=ignore_exception,
-            update=update, associator=associator, tsmap_dir=tsmap_dir, tsfits=tsfits)
+            update=update, associator=associator, tsmap_dir=tsmap_dir, tsfits=tsfits, gradient=gradient)
         
 
     curw= roi.log_like()
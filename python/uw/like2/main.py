@@ -85,6 +85,7 @@ class ROI(views.LikelihoodViews):
         ('quiet', True, 'set to suppress output'),
         ('load_kw', {'rings':2, 'tsmin':0}, 'a dict specific for the loading'),
         ('postpone', False, 'Set True to not load data until requested'),
+        ('bandlike_kw', {}, 'a dict passed to the BandLike objects, e.g. vectorized=True'),
     )
 
     @keyword_options.decorate(defaults)
@@ -129,7 +130,7 @@ class ROI(views.LikelihoodViews):
         
         roi_bands = bands.BandSet(config, roi_index)
         roi_bands.load_data()
-        super(ROI, self).__init__( roi_bands, roi_sources)
+        super(ROI, self).__init__( roi_bands, roi_sources, **self.bandlike_kw)
     
     def roi_index(self, roi_spec):
         """ roi_spec : [integer | (ra,dec) tuple ]
@@ -307,13 +308,15 @@ class ROI(views.LikelihoodViews):
 
     def localize(self, source_name=None, update=False, ignore_exception=True, **kwargs):
         """ localize the source, return elliptical parameters 
+        kwargs may include gradient=True, to use localization.GradientLocalization
         """
         if source_name=='all':
             localization.localize_all(self, ignore_exception=ignore_exception, **kwargs)
             return
         source = self.sources.find_source(source_name)
+        gradient = kwargs.pop('gradient', False)
         with self.tsmap_view(source.name) as tsm:
-            loc = localization.Localization(tsm, **kwargs)
+            loc = (localization.GradientLocalization if gradient else localization.Localization)(tsm, **kwargs)
             try: 
                 loc.localize()
                 t =  loc.ellipse if hasattr(loc, 'ellipse') else None
@@ -4,6 +4,7 @@ $Header: /nfs/slac/g/glast/ground/cvs/pointlike/python/uw/like2/maps.py,v 1.15 2
 
 """
 import os, sys,  types, glob
+import multiprocessing
 import cPickle as pickle
 import numpy as np
 import pandas as pd
@@ -298,6 +299,17 @@ class ResidualTS(object):
             return self.trial_fit()
         return map(self.trial_fit, self.pars)
 
+    def tsvalues(self, skydirs):
+        """ TS values for a list of positions, fit together: equivalent to the list of tsfun values
+        """
+        ts = []
+        for pars in ([None] if self.pars is None else self.pars):
+            if pars is not None:
+                self.model.set_all_parameters(pars)
+                self.source.changed=True
+            with self.roi.multi_tsmap_view(self.sourcename) as tsm:
+                ts.append(tsm(skydirs))
+        return ts[0] if self.pars is None else np.array(ts).T
         
     def __call__(self, v):
         skydir = SkyDir(Hep3Vector(v[0],v[1],v[2]))
@@ -308,6 +320,8 @@ class ResidualTS(object):
 class ResidualUpperLimit(ResidualTS):
     """ save the likelihood function, as the 3-parameter representation of a shifted Poisson, plss the max dev.
     """
+    tsvalues = None # each position needs a likelihood scan
+
     def tsfun(self, skydir):
         self.source.skydir = skydir
         self.roi.calls =0
@@ -330,6 +344,26 @@ class ResidualUpperLimit(ResidualTS):
                 return 0
  
 
+# the sky function and positions for a table, set before worker processes are forked, so that
+# the workers share the ROI state copy-on-write
+_table_skyfun = None
+_table_positions = None
+_table_multi_ts = False
+
+def _table_values(skyfun, pos_list, multi_ts=False):
+    """ evaluate skyfun at each position; if multi_ts, and it has a tsvalues method, 
+    use that to fit all positions together
+    """
+    if multi_ts and getattr(skyfun, 'tsvalues', None) is not None:
+        return np.asarray(skyfun.tsvalues(pos_list))
+    return np.array([skyfun(p) for p in pos_list])
+
+def _fill_chunk(chunk):
+    """ evaluate a slice of the table in a worker; return (start, values) """
+    start, stop = chunk
+    return start, _table_values(_table_skyfun, _table_positions[start:stop], _table_multi_ts)
+
+
 class ROItables(object):
     """ manage one or more tables of values subdividing a HEALpix roi
     
@@ -339,9 +373,18 @@ class ROItables(object):
                 (ResidualTS,'ts',  dict(photon_index=2.0),) , 
                 (KdeMap,    'kde', dict()),
             If skyfunction is a string, evaluate it 
+        workers : int
+            if >1, the number of processes forked, after the sky function is set up, to fill 
+            each table: each evaluates a set of chunks of the positions
+        multi_ts : bool
+            if True, sky functions with a tsvalues method, like ResidualTS, evaluate all positions
+            together with the approximate views.MultiTSmapView fits, rather than a full fit
+            for each position
     """
     
     def __init__(self, outdir, nside, roi_nside=12, **kwargs):
+        self.workers = kwargs.pop('workers', 1)
+        self.multi_ts = kwargs.pop('multi_ts', False)
         self.index_table = make_index_table(roi_nside, nside)
         self.subdirfun = Band(nside).dir
         self.skyfuns = kwargs.pop('skyfuns', 
@@ -355,7 +398,10 @@ class ROItables(object):
                     
     def process_table(self, skyfun, name, pos_list, outfile=None, **kwargs):
         sys.stdout.flush()
-        skytable = np.array([skyfun(p) for p in pos_list])
+        if self.workers>1 and len(pos_list)>1:
+            skytable = self.fill_parallel(skyfun, pos_list)
+        else:
+            skytable = _table_values(skyfun, pos_list, self.multi_ts)
         print ' min=%6.2e, max=%6.2e, mean=%6.2e ' \
             % (skytable.min(), skytable.max(),skytable.mean()) ,
         if outfile is not None:
@@ -363,6 +409,22 @@ class ROItables(object):
             pickle.dump(skytable, open(outfile,'wb'))
         else: print  
         if hasattr(skyfun,'reset'): skyfun.reset() 
+
+    def fill_parallel(self, skyfun, pos_list, chunks_per_worker=4):
+        """ evaluate the table with a pool of forked processes, which inherit the set-up sky function
+        """
+        global _table_skyfun, _table_positions, _table_multi_ts
+        _table_skyfun, _table_positions, _table_multi_ts = skyfun, pos_list, self.multi_ts
+        edges = np.linspace(0, len(pos_list), min(len(pos_list), self.workers*chunks_per_worker)+1).astype(int)
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            results = dict(pool.imap_unordered(_fill_chunk, zip(edges[:-1], edges[1:])))
+        finally:
+            pool.close()
+            pool.join()
+            _table_skyfun = _table_positions = None
+            _table_multi_ts = False
+        return np.concatenate([results[start] for start in edges[:-1]])
   
     def __call__(self, roi):
         index = int(roi.name[5:])
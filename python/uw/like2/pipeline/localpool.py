@@ -0,0 +1,214 @@
+"""
+Run a pipeline stage for a set of ROIs on the local node, with a pool of processes
+
+Each worker sets up a Process object (usually a process.BatchJob, as in stagedict) once, then
+calls process_roi for the ROI indices it is sent. Output from each worker is copied to a log file,
+a failure in one ROI is recorded and does not affect the others, and failed ROIs are retried.
+An ROI whose worker dies, e.g. with a segmentation fault in C++ code, or that runs longer than 
+an optional timeout, is recorded as failed; the pool replaces the worker.
+The status of each ROI is appended to a journal file, so an interrupted run can be resumed: ROIs
+already recorded as successful are skipped.
+
+Example, from a skymodel folder:
+    python -m uw.like2.pipeline.localpool update_full --rois 0-1727 --workers 32
+"""
+import os, sys, time, signal, argparse, traceback, Queue
+import multiprocessing
+from uw.like2 import tools
+
+# the Process object of a worker, and the queue for start messages, set up by _init_worker
+_worker = None
+_started = None
+
+def _init_worker(proc, pars, logdir, started=None):
+    global _worker, _started
+    _started = started
+    logfile = os.path.join(logdir, 'worker_%d.txt' % os.getpid())
+    tools.OutputTee(logfile) # not closed: lasts for the life of the worker
+    print '%4d-%02d-%02d %02d:%02d:%02d - worker %d starting' % (time.localtime()[:6]+(os.getpid(),))
+    sys.stdout.flush()
+    _worker = proc(**pars)
+
+def _process_one(index):
+    """ run process_roi for the index; return a tuple (index, status, elapsed time, message) """
+    tstart = time.time()
+    if _started is not None:
+        _started.put((index, os.getpid(), tstart))
+    try:
+        _worker.process_roi(index)
+        status, msg = 'ok', ''
+    except Exception, e:
+        print 'ROI %d failed: %s' % (index, e)
+        traceback.print_exc(file=sys.stdout)
+        status, msg = 'fail', str(e).replace('\n', ' ')
+    sys.stdout.flush()
+    return index, status, time.time()-tstart, msg
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class Journal(object):
+    """ Manage a file with a line for each completed ROI, which allows resuming
+    Each line has the ROI index, status ('ok' or 'fail'), elapsed time, and message
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def done(self):
+        """ return the set of ROI indices with a successful entry """
+        if not os.path.exists(self.filename): return set()
+        ok = set()
+        for line in open(self.filename):
+            t = line.split()
+            if len(t)>1 and t[1]=='ok':
+                ok.add(int(t[0]))
+        return ok
+
+    def record(self, index, status, elapsed, msg=''):
+        with open(self.filename, 'a') as out:
+            out.write('%4d %-4s %8.1f %s\n' % (index, status, elapsed, msg))
+            out.flush()
+
+
+class LocalPool(object):
+    """ run process_roi for a list of ROIs with a pool of worker processes
+    """
+    def __init__(self, proc, pars={}, workers=None, retries=1, outdir='.',
+            journal='localpool_journal.txt', maxtasksperchild=None, timeout=None, poll=1.0):
+        """
+        proc : class
+            a Process subclass, like process.BatchJob, constructed in each worker with pars
+        pars : dict
+            keyword arguments for proc
+        workers : int | None
+            number of worker processes; if None, the number of CPUs
+        retries : int
+            number of times to resubmit a failed ROI
+        outdir : string
+            folder for the journal file, and the worker log files in a "log" subfolder
+        journal : string
+            name of the journal file
+        maxtasksperchild : int | None
+            if set, replace a worker after this many ROIs
+        timeout : float | None
+            if set, the maximum time in seconds for an ROI: its worker is then killed
+        poll : float
+            interval, in seconds, for checking the workers
+        """
+        self.proc, self.pars = proc, pars
+        self.workers = workers if workers is not None else multiprocessing.cpu_count()
+        self.retries = retries
+        self.maxtasksperchild = maxtasksperchild
+        self.timeout, self.poll = timeout, poll
+        self.logdir = os.path.join(outdir, 'log')
+        if not os.path.exists(self.logdir): os.makedirs(self.logdir)
+        self.journal = Journal(os.path.join(outdir, journal))
+
+    def __repr__(self):
+        return '%s.%s: %s with %d workers, journal %s' % (self.__module__, self.__class__.__name__,
+            self.proc.__name__, self.workers, self.journal.filename)
+
+    def __call__(self, roi_list):
+        """ process the ROIs that are not already in the journal as successful
+        return a list of those that failed after all retries
+        """
+        done = self.journal.done()
+        todo = [i for i in roi_list if i not in done]
+        print '%d ROIs to process (%d already done) with %d workers' % (len(todo), len(roi_list)-len(todo), self.workers)
+        sys.stdout.flush()
+        tzero = time.time()
+        started = multiprocessing.Queue()
+        pool = multiprocessing.Pool(self.workers, initializer=_init_worker,
+                initargs=(self.proc, self.pars, self.logdir, started), maxtasksperchild=self.maxtasksperchild)
+        self.lost = 0
+        try:
+            for attempt in range(self.retries+1):
+                if len(todo)==0: break
+                if attempt>0:
+                    print 'Retry #%d for %d failed ROIs: %s' % (attempt, len(todo), todo)
+                failed = []
+                for n, (index, status, elapsed, msg) in enumerate(self.results(pool, started, todo)):
+                    self.journal.record(index, status, elapsed, msg)
+                    if status!='ok': failed.append(index)
+                    print '%4d/%4d: ROI %4d %-4s %6.1f s (total %.0f s)' % (n+1, len(todo), index, status,
+                        elapsed, time.time()-tzero)
+                    sys.stdout.flush()
+                todo = sorted(failed)
+        finally:
+            # a pool with tasks that will never finish cannot be closed
+            if self.lost>0: pool.terminate()
+            else: pool.close()
+            pool.join()
+        if len(todo)>0:
+            print 'Failed ROIs: %s' % todo
+        return todo
+
+    def results(self, pool, started, todo):
+        """ submit the ROIs, and generate a tuple (index, status, elapsed time, message) for each, 
+        as it finishes. The workers report the ROI they start, so that the ROI of a worker that dies,
+        or that exceeds the timeout, is reported as failed, rather than waited for forever.
+        """
+        pending = dict((index, pool.apply_async(_process_one, (index,))) for index in todo)
+        running = dict() # index: (pid, start time)
+        while len(pending)>0:
+            while True:
+                try:
+                    index, pid, tstart = started.get_nowait()
+                except Queue.Empty:
+                    break
+                running[index] = (pid, tstart)
+            for index in sorted(pending.keys()):
+                result = pending[index]
+                if result.ready():
+                    del pending[index]; running.pop(index, None)
+                    yield result.get()
+                    continue
+                if index not in running: continue
+                pid, tstart = running[index]
+                elapsed = time.time()-tstart
+                if not _alive(pid):
+                    result.wait(self.poll) # the result may be on its way
+                    if result.ready(): continue
+                    msg = 'worker %d died' % pid
+                elif self.timeout is not None and elapsed>self.timeout:
+                    msg = 'timeout after %.0f s, killed worker %d' % (self.timeout, pid)
+                    os.kill(pid, signal.SIGKILL)
+                else:
+                    continue
+                print 'ROI %d failed: %s' % (index, msg)
+                del pending[index]; del running[index]
+                self.lost += 1
+                yield index, 'fail', elapsed, msg
+            if len(pending)>0: time.sleep(self.poll)
+
+
+def parse_rois(rois):
+    """ list of ROI indices from a string: either a range "9-30" or comma-delimited "1,5,6" """
+    t = rois.split('-')
+    if len(t)>1:
+        return range(int(t[0]), int(t[1])+1)
+    return map(int, filter(lambda x: len(x)>0, rois.split(',')))
+
+def main(args):
+    from uw.like2.pipeline import stagedict
+    proc, pars = stagedict.stagenames[args.stage].setup()
+    pool = LocalPool(proc, pars, workers=args.workers, retries=args.retries,
+        maxtasksperchild=args.maxtasks, timeout=args.timeout)
+    failed = pool(parse_rois(args.rois))
+    return 1 if len(failed)>0 else 0
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Run a pipeline stage for ROIs in a local pool of processes')
+    parser.add_argument('stage', help='stage name, in stagedict')
+    parser.add_argument('--rois', default='0-1727', help='range like 9-30, or list like 1,5,6; default %(default)s')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, default number of CPUs')
+    parser.add_argument('--retries', type=int, default=1, help='number of retries for failed ROIs, default %(default)s')
+    parser.add_argument('--maxtasks', type=int, default=None, help='replace worker after this many ROIs')
+    parser.add_argument('--timeout', type=float, default=None, help='maximum time for an ROI, in seconds')
+    args = parser.parse_args()
+    sys.exit(main(args))
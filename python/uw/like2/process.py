@@ -45,6 +45,8 @@ class Process(main.MultiROI):
         ('tables_flag',   False,  'set True for tables run; all else ignored'),
         #('xtables_flag',  False,  'set True for special tables run; all else ignored'),
         ('tables_nside',  512,    'nside to use for table generation'),
+        ('tables_workers', 1,     'number of processes forked to fill each table, sharing the ROI'),
+        ('tables_multi_ts', False, 'set True to fit all TS table positions together, with the approximate MultiTSmapView'),
         ('table_keys',    None,   'list of keys for table generation: if None, all else ignored'),
         ('seed_key',      None,   'set to name of key for seed check run'),
         ('update_positions_flag',False,  'set True to update positions before fitting'),
@@ -93,6 +95,7 @@ class Process(main.MultiROI):
         sys.stdout.flush()
         try:
             self.process()
+            self.bands.save_state() # for a warm start of the next stage
         finally:
             if outtee is not None: outtee.close()
         
@@ -240,7 +243,7 @@ class Process(main.MultiROI):
             if skymodel.startswith('month') or skymodel.startswith('year'): 
                 print 'Not running tsmap analysis since data subset'
                 tsmap_dir=None
-            roi.localize('all', tsmap_dir=tsmap_dir)
+            roi.localize('all', tsmap_dir=tsmap_dir, **self.localize_kw)
         
         if self.associate_flag:
             print '-------- running associations --------'; sys.stdout.flush()
@@ -357,7 +360,8 @@ class Process(main.MultiROI):
         maps.nside = self.tables_nside
         tinfo = [maps.table_info[key] for key in mapkeys]
         skyfuns = [(entry[0], key, entry[1]) for key,entry in zip(mapkeys, tinfo)]  
-        rt = maps.ROItables(self.outdir, nside=self.tables_nside, skyfuns=skyfuns )
+        rt = maps.ROItables(self.outdir, nside=self.tables_nside, skyfuns=skyfuns, workers=self.tables_workers,
+            multi_ts=self.tables_multi_ts)
         rt(self)
         
     def update_positions(self, tsmin=10, qualmax=8):
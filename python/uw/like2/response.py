@@ -4,11 +4,12 @@ Classes to compute response from various sources
 $Header: /nfs/slac/g/glast/ground/cvs/pointlike/python/uw/like2/response.py,v 1.21 2018/01/27 15:37:17 burnett Exp $
 author:  Toby Burnett
 """
-import os, pickle
+import os, pickle, collections
 import numpy as np
 import pandas as pd
 import healpy
 import skymaps
+from scipy import interpolate
 from uw.utilities import keyword_options
 from . import convolution, diffuse
 
@@ -28,6 +29,176 @@ extended_grid_defaults = [
         ('quiet',     False, ''),
         ]
 
+class PointResponseCache(object):
+    """ A bounded LRU cache of the PSF overlap, exposure ratio, and pixel values of point sources 
+    in an ROI. It is shared by all the bands: the key is the band energy, event type, and the source
+    position quantized to resolution degrees, so repeated initializations of sources at the same
+    position during localization or TS maps become lookups.
+    The arrays, added with put_array, are shared by the clients, so are made read-only.
+    """
+    def __init__(self, maxsize=5000, maxbytes=2**27, resolution=1e-4):
+        """
+        maxsize : int
+            maximum number of entries; the least recently used is dropped
+        maxbytes : int
+            maximum total size of the arrays in the entries; the least recently used are dropped
+        resolution : float
+            position quantization, in degrees
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.resolution = resolution
+        self.clear()
+
+    def clear(self):
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = 0
+
+    def __repr__(self):
+        return '%s.%s: %d/%d entries, %.1f/%.1f MB, %d hits, %d misses' % (self.__module__, 
+            self.__class__.__name__, len(self.entries), self.maxsize, self.nbytes/2.**20, 
+            self.maxbytes/2.**20, self.hits, self.misses)
+
+    @staticmethod
+    def entry_bytes(entry):
+        return sum(v.nbytes for v in entry.values() if isinstance(v, np.ndarray))
+
+    def drop_oldest(self, size=0):
+        """ drop least recently used entries, to leave size entries, or the arrays within maxbytes;
+        the most recent entry is kept """
+        while len(self.entries)>max(size, 1) or (len(self.entries)>1 and self.nbytes>self.maxbytes):
+            key, value = self.entries.popitem(last=False)
+            self.nbytes -= self.entry_bytes(value)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, band, skydir):
+        q = self.resolution
+        return (int(round(band.energy)), band.event_type, 
+                int(round(skydir.ra()/q)), int(round(skydir.dec()/q)))
+
+    def entry(self, band, skydir):
+        """ return the dict for the band and position, which the client fills as needed.
+        A new entry is created on a miss, perhaps discarding the oldest
+        """
+        key = self.key(band, skydir)
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            value = dict()
+            self.drop_oldest(self.maxsize-1)
+        else:
+            self.hits += 1
+        self.entries[key] = value # most recently used at end
+        return value
+
+    def put_array(self, entry, name, value):
+        """ add a read-only array to an entry """
+        value = np.asarray(value)
+        value.flags.writeable = False
+        self.nbytes += value.nbytes - getattr(entry.get(name, None), 'nbytes', 0)
+        entry[name] = value
+        self.drop_oldest(self.maxsize)
+
+    def restore(self, state):
+        """ add the entries saved in a statecache.StateCache object """
+        for key, entry in state.entries.items():
+            if key[0]=='point':
+                self.nbytes -= self.entry_bytes(self.entries.pop(key[1:], {}))
+                self.entries[key[1:]] = dict(entry) # arrays are read-only views of the file
+                self.nbytes += self.entry_bytes(entry)
+        self.drop_oldest(self.maxsize)
+
+    def save(self, state):
+        """ copy the entries to a statecache.StateCache object """
+        for key, entry in self.entries.items():
+            saved = state.get(('point',)+key)
+            if len(entry)>len(saved if saved is not None else []):
+                state.put(('point',)+key, **entry)
+
+class OverlapTable(object):
+    """ Interpolation table of the overlap of the PSF of a band with the ROI aperture, as a function
+    of the offset of the source from the ROI center. 
+    
+    The overlap depends only on the event type, energy and ROI radius, so tables are shared by all ROIs.
+    The offsets extend beyond the aperture by several times R68, to cover the nearby sources outside 
+    the ROI. The table is checked against the integral at the midpoints of the nodes, and the node
+    spacing reduced until the difference is less than tol. If that fails after maxiter halvings, the
+    table is marked invalid, and psf_overlap uses the integral.
+    """
+    tables = dict() # key: (event type, energy, radius, PSF parameters)
+
+    def __init__(self, psf, radius, r68, tol=1e-4, extent=5, maxiter=4):
+        """
+        psf : PSF object for the band, with an overlap method
+        radius : float
+            ROI radius, degrees
+        r68 : float
+            68% containment radius, degrees, sets the node spacing
+        extent : float
+            the table extends to radius + extent*r68
+        """
+        self.radius = radius
+        self.max_offset = min(radius + extent*r68, 90.)
+        center = skymaps.SkyDir(0,0)
+        overlap = lambda offsets: np.array([psf.overlap(center, radius, skymaps.SkyDir(x,0)) for x in offsets])
+        npts = max(20, int(self.max_offset/(0.25*r68)))+1
+        offsets = np.linspace(0, self.max_offset, npts)
+        values = overlap(offsets)
+        for i in range(maxiter):
+            self.spline = interpolate.InterpolatedUnivariateSpline(offsets, values, k=3)
+            midpoints = 0.5*(offsets[1:]+offsets[:-1])
+            mvalues = overlap(midpoints)
+            self.error = np.abs(self.spline(midpoints)-mvalues).max()
+            # interleave the midpoints, to halve the spacing for the next check
+            t = np.empty(2*npts-1)
+            t[0::2], t[1::2] = offsets, midpoints
+            v = np.empty(2*npts-1)
+            v[0::2], v[1::2] = values, mvalues
+            offsets, values, npts = t, v, len(t)
+            if self.error<tol: break
+        self.spline = interpolate.InterpolatedUnivariateSpline(offsets, values, k=3)
+        self.offsets = offsets
+        self.valid = self.error<tol
+        if not self.valid:
+            print 'Warning: %s: error exceeds %.1e, will use the integral' % (self, tol)
+
+    def __repr__(self):
+        return '%s.%s: %d offsets to %.2f deg, radius %.1f, max error %.1e' % (self.__module__, 
+            self.__class__.__name__, len(self.offsets), self.max_offset, self.radius, self.error)
+
+    def __call__(self, offset):
+        """ overlap for the offset in degrees, which must be less than max_offset """
+        return float(np.clip(self.spline(offset), 0, 1))
+
+    @classmethod
+    def get(cls, band):
+        """ return the table for the band, creating it if needed, or None if the PSF has no R68, 
+        or parameters to identify it 
+        """
+        r68 = getattr(band.psf, 'r68', None)
+        par, scale = getattr(band.psf, 'par', None), getattr(band.psf, 'scale', None)
+        if r68 is None or par is None or scale is None: return None
+        # the PSF parameters distinguish IRFs, or PSF managers, with the same event type and energy
+        key = (band.event_type, int(round(band.energy)), band.radius, 
+            tuple(np.ravel(par)), tuple(np.ravel(scale)))
+        if key not in cls.tables:
+            cls.tables[key] = cls(band.psf, band.radius, r68)
+        return cls.tables[key]
+
+def psf_overlap(band, skydir, use_table=True):
+    """ overlap of the PSF for a source at skydir with the ROI of the band: from the shared
+    OverlapTable if within its range, otherwise the integral
+    """
+    table = OverlapTable.get(band) if use_table else None
+    if table is not None and table.valid:
+        offset = np.degrees(band.skydir.difference(skydir))
+        if offset<table.max_offset: return table(offset)
+    return band.psf.overlap(band.skydir, band.radius, skydir)
+
+
 class Response(object):
     """ Base class for classes that manage the response of a source, in total counts 
     or count density for any position within the ROI. Created by the response function of each source.  
@@ -83,6 +254,7 @@ class NoResponse(Response):
     def initialize(self): 
         self.counts=0
         self.pix_counts=0
+        self.pix_norm=0
     def __call__(self, skydir):
         return 0.
 
@@ -96,31 +268,47 @@ class PointResponse(Response):
         
     """
     max_overlap = 1e-2 # zero response below this
+    use_overlap_table = False # if set, interpolate the overlap in the shared OverlapTable for the band
     def initialize(self):
-        self.overlap = self.band.psf.overlap(self.roicenter, self.band.radius, self.source.skydir)
+        # values depending only on the position are shared with other sources, via the ROI cache
+        cache = getattr(self.band, 'response_cache', None)
+        entry = cache.entry(self.band, self.source.skydir) if cache is not None else dict()
+        if 'overlap' not in entry:
+            entry['overlap'] = psf_overlap(self.band, self.source.skydir, self.use_overlap_table)
+        self.overlap = entry['overlap']
 
         # declare inactive if not free, and small overlap
         self.active= self.overlap>PointResponse.max_overlap or np.sum(self.source.model.free)>0
         if not self.active:
             self.counts=0
             return
-        self._exposure_ratio = self.band.exposure(self.source.skydir)/self.band.exposure(self.roicenter)
+        if 'exposure_ratio' not in entry:
+            entry['exposure_ratio'] = self.band.exposure(self.source.skydir)/self.band.exposure(self.roicenter)
+        self._exposure_ratio = entry['exposure_ratio']
         if self.band.has_pixels:
-            if hasattr(self.band.psf, 'cpsf'):
-                # old PSF class, uses C++ code for speed
-                wsdl = self.band.wsdl
-                rvals  = np.empty(len(wsdl),dtype=float)
-                self.band.psf.cpsf.wsdl_val(rvals, self.source.skydir, wsdl) #from C++: sets rvals
-                self.pixel_values = rvals * self.band.pixel_area
-            else:
-                #  new psf class: cpsf is internal
-                # psf_weights =self.band.psf(
-                #     [self.source.skydir.difference(sd) for sd in self.band.wsdl])
-                psf_weights = self.band.psf.wsdl_value(self.source.skydir, self.band.wsdl)
-                self.pixel_values = psf_weights * self.band.pixel_area
+            if 'pixel_values' not in entry:
+                if cache is not None:
+                    cache.put_array(entry, 'pixel_values', self.psf_pixel_values())
+                else:
+                    entry['pixel_values'] = self.psf_pixel_values()
+            self.pixel_values = entry['pixel_values'] # shared: read-only
         self.evaluate()
 
         
+    def psf_pixel_values(self):
+        """ return the PSF times the pixel area for the pixels with data """
+        if hasattr(self.band.psf, 'cpsf'):
+            # old PSF class, uses C++ code for speed
+            wsdl = self.band.wsdl
+            rvals  = np.empty(len(wsdl),dtype=float)
+            self.band.psf.cpsf.wsdl_val(rvals, self.source.skydir, wsdl) #from C++: sets rvals
+            return rvals * self.band.pixel_area
+        #  new psf class: cpsf is internal
+        # psf_weights =self.band.psf(
+        #     [self.source.skydir.difference(sd) for sd in self.band.wsdl])
+        psf_weights = self.band.psf.wsdl_value(self.source.skydir, self.band.wsdl)
+        return psf_weights * self.band.pixel_area
+        
     def evaluate(self): 
         """ update values of counts, pix_counts used for likelihood calculation, derivatives
         Called when source parameters change
@@ -130,15 +318,18 @@ class PointResponse(Response):
         self.expected = self.band.integrator(model)
         assert not np.isinf(self.expected), 'model integration failure'
         self.counts =  self.expected * self.overlap
-        self.model_grad = self.band.integrator( model.gradient)[model.free] #* self.exposure_ratio
+        self.model_grad = self.band.integrator(model, gradient=True)[model.free] #* self.exposure_ratio
         if self.band.has_pixels:
-            self.pix_counts = self.pixel_values * self.expected
+            self.pix_norm = self.expected
+            self.pix_counts = self.pixel_values * self.pix_norm
         
-    def grad(self, weights, exposure_factor=1): 
+    def grad(self, weights, exposure_factor=1, pixterm=None): 
         """ contribution to the overall gradient
         weights : arrary of float
             
             weights = self.data / self.model_pixels
+        pixterm : None or float
+            if set, the precomputed sum of weights*pixel_values
         Assume that evaluate has set model_grad
         """
         if not self.active: return None # don't expect to be called
@@ -148,9 +339,14 @@ class PointResponse(Response):
         #g = self.band.integrator( model.gradient)[model.free] #* self.exposure_ratio
         g = self.model_grad
         apterm = exposure_factor* self.overlap
-        pixterm = (weights*self.pixel_values).sum() if self.band.has_pixels else 0
+        if pixterm is None:
+            pixterm = (weights*self.pixel_values).sum() if self.band.has_pixels else 0
         return g * (apterm - pixterm)
 
+    def norm_gradient(self):
+        """ gradient of pix_norm with respect to the free parameters """
+        return self.model_grad
+
     def __call__(self, skydir):
         if not self.active: return 0
         return self.band.psf(skydir.difference(self.source.skydir))[0]  * self.expected
@@ -159,6 +355,7 @@ class PointResponse(Response):
     
 class DiffuseResponse(Response):
         
+    use_state_cache = True # subclasses that do not manage their values with restore, save
     defaults = diffuse_grid_defaults
     @keyword_options.decorate(defaults)
     def __init__(self, source, band, roi, **kwargs):
@@ -173,11 +370,28 @@ class DiffuseResponse(Response):
         self.setup=True
         #set up the spatial model 
         self.dmodel = self.source.dmodel[self.band.event_type]
-        self.dmodel.load()
         self.energy = self.band.energy
-        self.dmodel.setEnergy(self.band.energy)
-        
+        self.delta_e = self.band.emax - self.band.emin
         roi_index = skymaps.Band(12).index(self.roicenter)
+        
+        # warm start: use values saved by a previous run, if any, without loading the diffuse model
+        state = getattr(self.band, 'state_cache', None) if self.use_state_cache else None
+        if state is not None and self.restore(state, roi_index):
+            self.evaluate()
+            return
+            
+        self.setup_evalpoints(roi_index)
+        self.factor = self.ap_average * self.band.solid_angle * self.delta_e
+        if self.band.has_pixels:
+            self.pixel_values = self.evalpoints(self.band.wsdl) * self.band.pixel_area * self.delta_e
+        if state is not None: self.save(state)
+
+        self.evaluate()
+        
+    def setup_evalpoints(self, roi_index):
+        """ load the diffuse model, set the function evalpoints, and ap_average """
+        self.dmodel.load()
+        self.dmodel.setEnergy(self.band.energy)
         self._keyword_check(roi_index)
         if getattr(self, 'preconvolved', False):
             #print 'Using preconvolved'
@@ -192,9 +406,14 @@ class DiffuseResponse(Response):
                 scale_factor = (self.band.emax-self.band.emin) * smband.pixelArea()
             else: scale_factor=1
 
-            dirs = map(self.dmodel.dirfun, hplist)
-            self.evalpoints = lambda dirs : np.array(map(self.dmodel, dirs)) * self.corr / scale_factor
-            self.ap_average = self.evalpoints(dirs).mean()
+            if hasattr(self.dmodel, 'pixel_values'):
+                # evaluate arrays of points in one pass
+                self.evalpoints = lambda dirs : self.dmodel.values(dirs) * self.corr / scale_factor
+                self.ap_average = self.dmodel.pixel_values(hplist).mean() * self.corr / scale_factor
+            else:
+                dirs = map(self.dmodel.dirfun, hplist)
+                self.evalpoints = lambda dirs : np.array(map(self.dmodel, dirs)) * self.corr / scale_factor
+                self.ap_average = self.evalpoints(dirs).mean()
         
         else:
             self.create_grid() # will raise exception if no overlap
@@ -203,13 +422,48 @@ class DiffuseResponse(Response):
             self.ap_average = grid.cvals[inside].mean()
             self.evalpoints = lambda dirs : grid(dirs, grid.cvals)
 
-        self.delta_e = self.band.emax - self.band.emin
+    def state_key(self):
+        return ('diffuse', self.source.name, int(round(self.band.emin)), self.band.event_type)
+
+    def correction(self, roi_index):
+        """ the normalization correction factor that was applied to the grid """
+        return self.corr
+
+    def restore(self, state, roi_index):
+        """ set ap_average, factor and pixel_values from a statecache.StateCache entry
+        The values are proportional to the correction factor, which may have been changed
+        by a previous stage, so they are rescaled.
+        Return False if there is no entry, or it cannot be used
+        """
+        entry = state.get(self.state_key())
+        if entry is None or (self.band.has_pixels and 'pixel_values' not in entry): 
+            return False
+        self._keyword_check(roi_index)
+        corr = float(self.correction(roi_index))
+        if entry['corr']==0: 
+            return False
+        scale = corr/entry['corr']
+        self.corr = corr
+        self.ap_average = entry['ap_average'] * scale
         self.factor = self.ap_average * self.band.solid_angle * self.delta_e
         if self.band.has_pixels:
-            self.pixel_values = self.evalpoints(self.band.wsdl) * self.band.pixel_area * self.delta_e
-
-        self.evaluate()
+            pv = entry['pixel_values']
+            self.pixel_values = pv * scale if scale!=1 else pv
+        # the model and grid are only needed to evaluate other directions: set up when requested
+        self.evalpoints = self._deferred_evalpoints
+        self.roi_index = roi_index
+        return True
         
+    def save(self, state):
+        """ add an entry to a statecache.StateCache object """
+        values = dict(corr=float(self.corr), ap_average=self.ap_average)
+        if self.band.has_pixels: values['pixel_values'] = self.pixel_values
+        state.put(self.state_key(), **values)
+
+    def _deferred_evalpoints(self, dirs):
+        self.setup_evalpoints(self.roi_index)
+        return self.evalpoints(dirs)
+
     def create_grid(self):
         # create a grid for evaluating counts integral over ROI, individual pixel predictions
         grid = self.grid= convolution.ConvolvableGrid(center=self.roicenter, 
@@ -236,20 +490,31 @@ class DiffuseResponse(Response):
         norm = self.source.model(self.band.energy)
         self.counts = norm * self.factor
         if self.band.has_pixels:
+            self.pix_norm = norm
             self.pix_counts = self.pixel_values * norm
 
-    def grad(self, weights, exposure_factor=1): 
+    def grad(self, weights, exposure_factor=1, pixterm=None): 
         """ contribution to the overall gradient
         weights : arrary of float
             weights = self.data / self.model_pixels
+        pixterm : None or float
+            if set, the precomputed sum of weights*pixel_values
         """
         model = self.spectral_model
         if np.sum(model.free)==0 : 
             return []
-        pixterm = ( self.pixel_values * weights ).sum() if self.band.has_pixels else 0
-        return (self.factor*exposure_factor - pixterm) * model.gradient(self.energy)[model.free] 
+        if pixterm is None:
+            pixterm = ( self.pixel_values * weights ).sum() if self.band.has_pixels else 0
+        return (self.factor*exposure_factor - pixterm) * self.norm_gradient()
+
+    def norm_gradient(self):
+        """ gradient of pix_norm with respect to the free parameters """
+        model = self.spectral_model
+        return model.gradient(self.energy)[model.free]
         
     def __call__(self, skydir):
+        if self.evalpoints==self._deferred_evalpoints: # warm start: model not loaded yet
+            self.setup_evalpoints(self.roi_index)
         self.dmodel.setEnergy(self.band.energy) # needed if convolved
         return self.evalpoints([skydir])[0] * self.delta_e
 
@@ -298,7 +563,7 @@ class DiffuseResponse(Response):
         """
         if scale_factor != 1.:
             self.factor *= scale_factor
-            self.pixel_values *= scale_factor
+            self.pixel_values = self.pixel_values * scale_factor # may be a read-only array
             self.corr *= scale_factor
             self.evaluate()
         return self.corr #new total correction
@@ -390,6 +655,8 @@ class DiffuseCorrection(object):
         
 class CachedDiffuseResponse(DiffuseResponse):
         
+    use_state_cache = False # correction depends on the cached grid
+    
     def create_grid(self):
         """ set up the grid from the cached files """
         
@@ -447,17 +714,24 @@ class IsotropicResponse(DiffuseResponse):
             self.source.model.ct=self.band.event_type
         super(IsotropicResponse, self).evaluate()
             
-    def grad(self, weights, exposure_factor=1): 
+    def norm_gradient(self): 
         # deal with FrontBackConstant case, which uses different conatants for front/back
         if hasattr(self.source.model, 'ct'): # bit ugly
             self.source.model.ct=self.band.event_type
-        return super(IsotropicResponse, self).grad(weights, exposure_factor)
+        return super(IsotropicResponse, self).norm_gradient()
 
 
     def fill_grid(self):
         # fill the grid for evaluating counts integral over ROI, individual pixel predictions
         roi_index = skymaps.Band(12).index(self.roicenter)
         dmodel = self.dmodel
+        self.corr = self.correction(roi_index)
+        grid = self.grid
+        grid.cvals = grid.fill(self.band.exposure) * dmodel(self.band.skydir) * self.corr
+        
+    def correction(self, roi_index):
+        """ the correction factor for the isotropic normalization """
+        dmodel = self.dmodel
         self.corr = 1.0
         # TODO: modify this to use the kw "key" if exists
         haskey = hasattr(dmodel, 'kw') and dmodel.kw is not None
@@ -484,9 +758,7 @@ class IsotropicResponse(DiffuseResponse):
             #     else:
             #         self.corr = DiffuseCorrection(corr_file)(roi_index, energy)
             # #print 'ISO: {} {} MeV: apply correction {} '.format(corr_file, energy, self.corr)
-
-        grid = self.grid
-        grid.cvals = grid.fill(self.band.exposure) * dmodel(self.band.skydir) * self.corr
+        return self.corr
         
 
 class ExtendedResponse(DiffuseResponse):
@@ -621,23 +893,32 @@ class ExtendedResponse(DiffuseResponse):
         total_counts = self.exposure_integral()
         self.counts = total_counts * self.factor
         if self.band.has_pixels:
+            self.pix_norm = total_counts
             self.pix_counts = self.pixel_values * total_counts
         
-    def grad(self, weights, exposure_factor=1): 
+    def grad(self, weights, exposure_factor=1, pixterm=None): 
         """ contribution to the overall gradient
         weights : arrary of float
             weights = self.data / self.model_pixels
+        pixterm : None or float
+            if set, the precomputed sum of weights*pixel_values
         """
         model = self.spectral_model
         if np.sum(model.free)==0 : 
             return []
         #pixterm = ( self.pixel_values * weights ).sum() * self.exposure_at_center if self.band.has_pixels else 0
         #return (self.factor*exposure_factor - pixterm) * model.gradient(self.energy)[model.free] 
-        g = self.band.integrator( model.gradient)[model.free] #* self.exposure_ratio
+        g = self.norm_gradient()
         apterm = exposure_factor * self.factor #self.overlap
-        pixterm = (weights*self.pixel_values).sum() if self.band.has_pixels else 0
+        if pixterm is None:
+            pixterm = (weights*self.pixel_values).sum() if self.band.has_pixels else 0
         return g * (apterm - pixterm)
 
+    def norm_gradient(self):
+        """ gradient of pix_norm with respect to the free parameters """
+        model = self.spectral_model
+        return self.band.integrator(model, gradient=True)[model.free] #* self.exposure_ratio
+
     def __call__(self, skydir, force=False):
         """ return value of perhaps convolved grid for the position
         skydir : SkyDir object | [SkyDir]
@@ -748,18 +1029,27 @@ class AllSkyDiffuse(Response):
         norm = self.source.model(self.band.energy)
         self.counts = norm * self.factor
         if self.band.has_pixels:
+            self.pix_norm = norm
             self.pix_counts = self.pixel_values * norm
 
-    def grad(self, weights, exposure_factor=1): 
+    def grad(self, weights, exposure_factor=1, pixterm=None): 
         """ contribution to the overall gradient
         weights : arrary of float
             weights = self.data / self.model_pixels
+        pixterm : None or float
+            if set, the precomputed sum of weights*pixel_values
         """
         model = self.spectral_model
         if np.sum(model.free)==0 : 
             return []
-        pixterm = ( self.pixel_values * weights ).sum() if self.band.has_pixels else 0
-        return (self.factor*exposure_factor - pixterm) * model.gradient(self.energy)[model.free] 
+        if pixterm is None:
+            pixterm = ( self.pixel_values * weights ).sum() if self.band.has_pixels else 0
+        return (self.factor*exposure_factor - pixterm) * self.norm_gradient()
+
+    def norm_gradient(self):
+        """ gradient of pix_norm with respect to the free parameters """
+        model = self.spectral_model
+        return model.gradient(self.energy)[model.free]
         
     def __call__(self, skydir):
         assert False
@@ -0,0 +1,178 @@
+"""
+Persistent cache of the per-band response calculations for an ROI
+
+The expensive parts of setting up an ROI are the convolution of each diffuse model with the PSF,
+and the PSF integrals for the point sources. These depend only on the data, the IRF, the diffuse
+model files and the positions, not on the spectral parameters that a pipeline stage fits. A StateCache
+saves them in a folder for each ROI, so a later stage, or a rerun, reads them instead: the arrays are
+in a single .npy file that is memory-mapped, with a unique name recorded in the index file.
+Array files that the index does not refer to, left by an earlier or a concurrent save, are removed
+by each save, and only the max_entries most recently used entries are saved.
+
+Enable with a key in config.txt, the name of a folder relative to the configuration folder:
+    state_cache = 'state_cache'
+
+The cache is ignored, and then replaced, if the version, dataset, IRF or diffuse specification differs.
+"""
+import os, glob, pickle, hashlib, uuid
+from collections import OrderedDict
+import numpy as np
+
+class StateCache(object):
+    """ Manage the saved response values for an ROI
+
+    Each entry is a dict of floats or float arrays, with a tuple key chosen by the client.
+    Entries loaded from the file are read-only: array values are views of a memory-mapped file.
+    They are kept in order of use, the most recent last, as saved.
+    """
+    version = 2
+
+    def __init__(self, config, roi_index, folder='state_cache', quiet=True, max_entries=10000):
+        """
+        config : configuration.Configuration object
+        roi_index : int
+            HEALPix nside=12 index of the ROI
+        folder : string
+            cache folder, relative to config.configdir; each ROI has a subfolder
+        max_entries : int
+            maximum number of entries to save: the least recently used are dropped
+        """
+        self.path = os.path.join(config.configdir, folder, 'HP12_%04d' % roi_index)
+        self.quiet = quiet
+        self.max_entries = max_entries
+        dset = config.dataset
+        self.key = dict(version=self.version, roi_index=roi_index,
+            dataset=dset.name, binfile=getattr(dset, 'binfile', None),
+            irf=getattr(dset, 'irf', None) or config.get('irf', None),
+            diffuse=hashlib.md5(repr(config.diffuse)).hexdigest(),
+            )
+        self.entries = OrderedDict()
+        self.array_name = None
+        self.modified = False
+        self.load()
+
+    def __repr__(self):
+        return '%s.%s: %d entries in %s' % (self.__module__, self.__class__.__name__,
+            len(self.entries), self.path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    @property
+    def index_file(self):
+        return os.path.join(self.path, 'index.pickle')
+
+    @property
+    def array_file(self):
+        """ the file with the arrays of the loaded or saved version, or None """
+        return os.path.join(self.path, self.array_name) if self.array_name is not None else None
+
+    def load(self):
+        """ load the index, and memory-map the arrays, if the file exists and has the same key """
+        self.entries = OrderedDict()
+        self.array_name = None
+        if not os.path.exists(self.index_file): return
+        try:
+            index = pickle.load(open(self.index_file))
+        except Exception, msg:
+            print 'StateCache: failed to read %s: %s' % (self.index_file, msg)
+            return
+        if index.get('key', None)!=self.key:
+            if not self.quiet:
+                print 'StateCache: ignoring %s, created with %s' % (self.path, index.get('key'))
+            return
+        arrays = None
+        if index['size']>0:
+            array_file = os.path.join(self.path, index['array_name'])
+            try:
+                arrays = np.load(array_file, mmap_mode='r')
+            except (IOError, ValueError), msg:
+                # removed by a concurrent save since the index was read
+                print 'StateCache: failed to read %s: %s' % (array_file, msg)
+                return
+            self.array_name = index['array_name']
+        for key, (scalars, slices) in index['entries'].items():
+            entry = dict(scalars)
+            for name, (start, stop) in slices.items():
+                entry[name] = arrays[start:stop]
+            self.entries[key] = entry
+        if not self.quiet: print 'StateCache: loaded %s' % self
+
+    def get(self, key):
+        """ return the entry for the key, or None; a found entry becomes the most recently used """
+        entry = self.entries.pop(key, None)
+        if entry is not None: self.entries[key] = entry
+        return entry
+
+    def put(self, key, **values):
+        """ add or replace an entry: values are floats or 1-d float arrays """
+        self.entries.pop(key, None)
+        self.entries[key] = values
+        self.modified = True
+
+    def save(self):
+        """ write the index and the arrays if any entry was added, then remove unreferenced array files
+        Only the max_entries most recently used entries are saved, and kept.
+        """
+        if not self.modified: return
+        if not os.path.exists(self.path): os.makedirs(self.path)
+        while len(self.entries)>self.max_entries:
+            self.entries.popitem(last=False)
+        index_entries, arrays, size = OrderedDict(), [], 0
+        for key, entry in self.entries.items():
+            scalars, slices = dict(), dict()
+            for name, value in entry.items():
+                if np.ndim(value)==0:
+                    scalars[name] = value
+                else:
+                    value = np.asarray(value, float).ravel()
+                    slices[name] = (size, size+len(value))
+                    size += len(value)
+                    arrays.append(value)
+            index_entries[key] = (scalars, slices)
+        # the arrays go to a new file with a unique name, recorded in the index, which is then
+        # replaced with a rename: a concurrent reader sees either the old index and arrays, or the new
+        # (the arrays are concatenated first, since the entries may be views of the old file)
+        array_name = None
+        if size>0:
+            allarrays = np.concatenate(arrays)
+            array_name = 'arrays_%s.npy' % uuid.uuid4().hex
+            with open(os.path.join(self.path, array_name), 'wb') as out:
+                np.save(out, allarrays)
+        tmp = self.index_file+'.tmp'
+        with open(tmp, 'wb') as out:
+            pickle.dump(dict(key=self.key, size=size, array_name=array_name, entries=index_entries), out)
+        os.rename(tmp, self.index_file)
+        self.array_name = array_name
+        self.remove_unreferenced()
+        self.modified = False
+        if not self.quiet: print 'StateCache: saved %s' % self
+
+    def remove_unreferenced(self):
+        """ remove the array files that the index file does not refer to
+        The index is read again, since a concurrent save may have replaced it. A reader with a removed
+        file memory-mapped keeps it until closed. If the file of a save that has not yet replaced the
+        index is removed, that index is treated as no cache by load, until the next save.
+        """
+        try:
+            referenced = pickle.load(open(self.index_file)).get('array_name', None)
+        except Exception, msg:
+            print 'StateCache: failed to read %s: %s' % (self.index_file, msg)
+            return
+        for f in glob.glob(os.path.join(self.path, 'arrays*.npy')):
+            if os.path.basename(f)==referenced: continue
+            try:
+                os.remove(f)
+            except OSError:
+                pass # removed by a concurrent save
+
+    def clear(self):
+        """ remove all entries, and the files """
+        self.entries = OrderedDict()
+        self.array_name = None
+        self.modified = False
+        for f in [self.index_file]+glob.glob(os.path.join(self.path, 'arrays*.npy')):
+            if os.path.exists(f): os.remove(f)
@@ -18,11 +18,17 @@ from uw.like2 import ( configuration,
     to_xml, from_xml,
     dataset,
     bandlike,
+    localization,
+    response,
+    statecache,
     views,
     sedfuns,
     associate,
     main,
     )
+from uw.like2.pipeline import localpool
+from uw.irfs import psfman
+from uw.utilities.parmap import LogMapper
 
 # globals: references set by setUp methods in classes as needed
 config_dir = '/tmp/like2' # os.path.expandvars('$HOME/test') #skymodels/P202/uw29')
@@ -142,6 +148,83 @@ class TestConfig(TestSetup):
         band = bands.EnergyBand(self.config, self.skydir)
         self.assertDictContainsSubset(dict(radius=5, event_type=1), band.__dict__, str(band.__dict__))
 
+class TestPSF(TestSetup):
+    """the batched methods of the psfman BandPSF, compared with the per-pair and scalar ones
+    """
+    def setUp(self):
+        super(TestPSF, self).setUp()
+        self.psf = self.config.psfman(1, 1000)
+        rng = np.random.RandomState(7)
+        ra, dec = self.skydir.ra(), self.skydir.dec()
+        self.sources = [SkyDir(ra+x, dec+y) for x,y in rng.uniform(-1, 1, (5,2))]
+        # include a pixel 1e-4 deg from the first source
+        self.pixels = [SkyDir(self.sources[0].ra(), self.sources[0].dec()+1e-4)]\
+            + [SkyDir(ra+x, dec+y) for x,y in rng.uniform(-3, 3, (200,2))]
+
+    def differences(self):
+        return np.array([[s.difference(p) for p in self.pixels] for s in self.sources])
+
+    def test_angular_distance(self):
+        """-->angular_distance the same as SkyDir.difference, and precise at small angles"""
+        delta = psfman.angular_distance(views.unit_vectors(self.sources), views.unit_vectors(self.pixels))
+        self.assertEqual((len(self.sources), len(self.pixels)), delta.shape)
+        self.assertTrue(np.allclose(delta, self.differences(), rtol=1e-6, atol=1e-9))
+        self.assertAlmostEqual(1, delta[0,0]/np.radians(1e-4), delta=1e-6)
+
+    def test_matrix(self):
+        """-->matrix the same as the PSF of each difference; with table=True within 1e-3 of the peak"""
+        psf = self.psf
+        x, p = views.unit_vectors(self.sources), views.unit_vectors(self.pixels)
+        expect = np.array([psf(d) for d in self.differences()])
+        m = psf.matrix(x, p)
+        self.assertEqual(expect.shape, m.shape)
+        self.assertTrue(np.allclose(m, expect, rtol=1e-6, atol=0))
+        peak = psf(0)[0]
+        self.assertTrue(np.abs(psf.matrix(x, p, table=True)-expect).max() < 1e-3*peak)
+
+    def test_radial_table(self, npts=1000):
+        """-->radial_table: logarithmic angles from 1e-3 R68 to pi, kept until the energy changes"""
+        psf = self.psf
+        r, v = psf.radial_table(npts)
+        self.assertEqual(npts, len(r))
+        self.assertEqual(0, r[0])
+        self.assertAlmostEqual(1, r[1]/np.radians(1e-3*psf.r68), delta=1e-9)
+        self.assertAlmostEqual(np.pi, r[-1], delta=1e-9)
+        self.assertTrue(np.allclose(np.diff(np.log(r[1:])), np.log(r[2]/r[1])))
+        self.assertTrue(np.all(v==psf(r)))
+        self.assertTrue(psf.radial_table(npts)[1] is v)
+        psf.setEnergy(2000)
+        try:
+            self.assertFalse(psf.radial_table(npts)[1] is v)
+        finally:
+            psf.setEnergy(1000)
+
+    def test_derivatives(self, tol=1e-5):
+        """-->psf_base_derivatives and derivatives agree with central differences"""
+        psf = self.psf
+        nc,nt,gc,gt,sc,st,w = psf.par
+        delta = np.linspace(0, 5, 51) * np.radians(psf.r68)
+        h = 1e-4 * np.radians(psf.r68)
+        for g, s in ((gc,sc), (gt,st)):
+            f = lambda d: psfman.psf_base(g, s, d)
+            d1, d2 = psfman.psf_base_derivatives(g, s, delta)
+            n1 = (f(delta+h)-f(delta-h))/(2*h)
+            n2 = (f(delta+h)-2*f(delta)+f(delta-h))/h**2
+            self.assertTrue(np.all(np.abs(d1-n1) < tol*np.abs(d1).max()))
+            self.assertTrue(np.all(np.abs(d2-n2) < tol*np.abs(d2).max()))
+        v, d1, d2 = psf.derivatives(delta)
+        self.assertTrue(np.allclose(v, psf(delta)))
+        n1 = (psf(delta+h)-psf(delta-h))/(2*h)
+        self.assertTrue(np.all(np.abs(d1-n1) < tol*np.abs(d1).max()))
+
+    def test_integral(self):
+        """-->integral of an array the same as the integral of each element"""
+        psf = self.psf
+        dmax = np.linspace(0.1, 5, 10) * np.radians(psf.r68)
+        expect = np.array([psf.integral(d) for d in dmax])
+        self.assertTrue(np.allclose(psf.integral(dmax), expect, rtol=1e-12, atol=0))
+        self.assertAlmostEqual(0.68, psf.integral(np.radians(psf.r68)), delta=1e-3)
+
 class TestDiffuse(TestSetup):
     
     def setUp(self, **kwargs):
@@ -291,6 +374,29 @@ class TestPoint(TestSetup):
         #c = conv(source.skydir)/1e12
         #self.assertAlmostEqual(a,c)
         
+    def test_overlap_table(self, offsets=(0, 1.3, 2.7, 4.1, 6.5), tol=1e-3):
+        """-->check the interpolated PSF overlap against the integral"""
+        band = self.back_band
+        table = response.OverlapTable.get(band)
+        self.assertTrue(table is not None and table.valid, msg=str(table))
+        for offset in offsets:
+            sd = SkyDir(band.skydir.ra(), band.skydir.dec()+offset)
+            direct = band.psf.overlap(band.skydir, band.radius, sd)
+            self.assertAlmostEqual(direct, table(np.degrees(band.skydir.difference(sd))), delta=tol)
+            self.assertAlmostEqual(direct, response.psf_overlap(band, sd), delta=tol)
+
+    def test_response_cache(self, n=10, size=1000):
+        """-->response cache: shared arrays read-only, total size bounded"""
+        band = self.back_band
+        cache = response.PointResponseCache(maxbytes=(n//2)*size*8)
+        for i in range(n):
+            entry = cache.entry(band, SkyDir(band.skydir.ra(), band.skydir.dec()+0.1*i))
+            cache.put_array(entry, 'pixel_values', np.ones(size))
+            self.assertFalse(entry['pixel_values'].flags.writeable)
+            self.assertTrue(cache.nbytes<=cache.maxbytes)
+        self.assertEqual(n//2, len(cache))
+        self.assertEqual(cache.nbytes, sum(cache.entry_bytes(e) for e in cache.entries.values()))
+
     def test_create_2deg(self):
         self.make_test_source(2, 0.588)
     def test_create_6deg(self):
@@ -437,6 +543,63 @@ class TestBands(TestSetup):
         self.assertEquals( 156221, roi_bands.pixels)
 
         
+class TestStateCache(TestSetup):
+    def setUp(self):
+        import tempfile
+        super(TestStateCache, self).setUp()
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def test_save_restore(self):
+        """-->save then restore: same scalars and arrays, and a second save replaces the arrays"""
+        cache = statecache.StateCache(self.config, roi_index, self.folder)
+        values = dict(a=np.arange(10.), b=np.linspace(0,1,5), norm=2.5)
+        cache.put(('test',1), **values)
+        cache.put(('test',2), c=np.ones(3))
+        cache.save()
+        restored = statecache.StateCache(self.config, roi_index, self.folder)
+        self.assertEqual(2, len(restored))
+        entry = restored.get(('test',1))
+        self.assertEqual(values['norm'], entry['norm'])
+        for name in 'ab':
+            self.assertTrue(np.all(values[name]==entry[name]))
+        first_file = restored.array_file
+        restored.put(('test',3), d=np.zeros(4))
+        restored.save()
+        self.assertNotEqual(first_file, restored.array_file)
+        self.assertFalse(os.path.exists(first_file))
+        again = statecache.StateCache(self.config, roi_index, self.folder)
+        self.assertEqual(3, len(again))
+        self.assertTrue(np.all(again.get(('test',1))['a']==values['a']))
+
+    def test_unreferenced(self):
+        """-->save removes array files that the index does not refer to"""
+        cache = statecache.StateCache(self.config, roi_index, self.folder)
+        cache.put(('test',1), a=np.arange(10.))
+        cache.save()
+        # as left by a concurrent save that lost the race to replace the index
+        stray = os.path.join(cache.path, 'arrays_stray.npy')
+        np.save(stray, np.ones(3))
+        cache.put(('test',2), b=np.ones(4))
+        cache.save()
+        self.assertEqual([os.path.basename(cache.array_file)],
+            [f for f in os.listdir(cache.path) if f.startswith('arrays')])
+        self.assertEqual(2, len(statecache.StateCache(self.config, roi_index, self.folder)))
+
+    def test_max_entries(self):
+        """-->only the most recently used entries are saved"""
+        cache = statecache.StateCache(self.config, roi_index, self.folder, max_entries=2)
+        for i in range(3):
+            cache.put(('test',i), a=np.arange(i+1.))
+        cache.get(('test',0))
+        cache.save()
+        restored = statecache.StateCache(self.config, roi_index, self.folder, max_entries=2)
+        self.assertEqual([('test',2), ('test',0)], restored.entries.keys())
+        self.assertTrue(np.all(restored.get(('test',2))['a']==np.arange(3.)))
+
 class TestLikelihood(TestSetup):
     def setUp(self):
         self.bl = setup('blike')
@@ -463,6 +626,82 @@ class TestLikelihood(TestSetup):
         t = np.array(corr.T - corr).flatten()
         self.assertTrue( np.abs(t).max()<0.02)
 
+    def test_check_hessian(self, tol=0.1):
+        """-->Fisher approximation to the hessian close to the numerical one"""
+        bl = self.bl
+        ha, hn, maxdiff = bl.check_hessian()
+        self.assertEqual(hn.shape, ha.shape)
+        self.assertTrue(np.allclose(ha, ha.T), msg='Fisher hessian not symmetric')
+        self.assertTrue(np.all(ha.diagonal()>0), msg='diagonal: %s' % ha.diagonal())
+        self.assertTrue(maxdiff<tol, msg='maximum relative difference %.3f' % maxdiff)
+        self.assertTrue(np.allclose(ha, bl.hessian(fisher=True)))
+
+    def test_fisher_normalizations(self, tol=1e-3):
+        """-->only normalizations free: the Fisher hessian plus the neglected term is the hessian"""
+        bl = self.bl
+        saved = [(s, s.model.free.copy()) for s in bl.free_sources]
+        try:
+            for s, free in saved:
+                s.model.free[1:] = False
+                s.changed = True
+            bl.reinitialize()
+            ha, hn, maxdiff = bl.check_hessian()
+            # each model is linear in its normalization, so only the diagonal terms of
+            # the log10 parameters, ln(10) times the gradient, are neglected
+            mappers = [s.model.get_mapper(0) for s in bl.free_sources]
+            log = np.array([m is LogMapper or isinstance(m, LogMapper) for m in mappers])
+            exact = ha + np.diag(np.log(10) * log * bl.gradient())
+            d = np.sqrt(np.outer(np.abs(hn.diagonal()), np.abs(hn.diagonal())))
+            reldiff = np.max(np.abs(exact-hn)/d)
+            self.assertTrue(reldiff<tol, msg='maximum relative difference %.2g' % reldiff)
+        finally:
+            for s, free in saved:
+                s.model.free[:] = free
+                s.changed = True
+            bl.reinitialize()
+
+    def test_incremental_update(self, steps=20, rtol=1e-9):
+        """-->many incremental model updates agree with a full recalculation"""
+        bl = self.bl
+        parameters = bl.sources.parameters
+        parz = parameters.get_parameters()
+        rng = np.random.RandomState(1)
+        for b in bl:
+            b.full_update_interval = 1000
+            b.initialize(b.free)
+            b.update()
+        try:
+            for step in range(steps):
+                i = rng.randint(len(parz))
+                parameters[i] = parz[i] + 0.01*rng.randn()
+                bl.update()
+            incremental = [(b.model_pixels.copy(), b.counts) for b in bl]
+            bl.update(force=True)
+            for b, (pix, counts) in zip(bl, incremental):
+                self.assertTrue(np.allclose(pix, b.model_pixels, rtol=rtol, atol=0), msg=str(b))
+                self.assertAlmostEqual(counts, b.counts, delta=rtol*abs(b.counts))
+        finally:
+            for b in bl: b.full_update_interval = 0
+            parameters.set_parameters(parz)
+            bl.update(force=True)
+
+    def test_vectorized(self):
+        """-->vectorized templates: log likelihood, per band, and gradient same as the default"""
+        vbl = bandlike.BandLikeList(roi_bands, roi_sources, vectorized=True)
+        self.assertTrue(np.all([b.vectorized for b in vbl]))
+        self.assertTrue(np.allclose(self.bl.log_like(summed=False), vbl.log_like(summed=False), 
+            rtol=1e-9))
+        self.assertTrue(np.allclose(self.bl.gradient(), vbl.gradient(), rtol=1e-6, atol=1e-9))
+
+    def test_packed(self):
+        """-->packed bands: log likelihood, per band and summed, and gradient same as unpacked"""
+        packed = bandlike.BandLikeList(roi_bands, roi_sources, packed=True)
+        self.assertAlmostEqual(self.bl.log_like(), packed.log_like(), delta=1e-6)
+        self.assertTrue(np.allclose(self.bl.log_like(summed=False), packed.log_like(summed=False), 
+            rtol=1e-9))
+        self.assertAlmostEqual(packed.log_like(), packed.log_like(summed=False).sum(), delta=1e-6)
+        self.assertTrue(np.allclose(self.bl.gradient(), packed.gradient(), rtol=1e-6, atol=1e-9))
+
     def test_bandsubset(self):
         bl = self.bl
         bl.selected = bl
@@ -552,6 +791,41 @@ class TestLocalization(TestSetup):
             self.assertEquals(0, tsm())
             self.assertAlmostEquals(-0.007, tsm((267.013,-24.781)), delta=0.1)
         self.assertAlmostEquals(init, likeviews.log_like(), delta=0.1)
+
+    def test_gradient_derivatives(self, delta=0.01, tol=0.02):
+        """--> GradientLocalization: gradient and Hessian agree with finite differences"""
+        with likeviews.tsmap_view(sourcename) as tsm:
+            loc = localization.GradientLocalization(tsm, quiet=True)
+            x = views.unit_vectors([loc.skydir])[0]
+            east, north = loc.tangent_basis(x)
+            w, grad, hess = loc.loglike_position(x, True)
+            h = np.radians(delta)
+            def ll(a, b):
+                y = x + h*(a*east + b*north)
+                return loc.loglike_position(y/np.sqrt((y**2).sum()))
+            ngrad = np.array([ll(1,0)-ll(-1,0), ll(0,1)-ll(0,-1)])/(2*h)
+            mixed = (ll(1,1)-ll(1,-1)-ll(-1,1)+ll(-1,-1))/(4*h**2)
+            nhess = np.array([[ll(1,0)-2*w+ll(-1,0), mixed*h**2], 
+                              [mixed*h**2, ll(0,1)-2*w+ll(0,-1)]])/h**2
+        scale = np.abs(hess).max()
+        self.assertTrue(np.allclose(grad, ngrad, rtol=tol, atol=tol*np.sqrt(scale)), 
+            msg='gradient %s, numerical %s' % (grad, ngrad))
+        self.assertTrue(np.allclose(hess, nhess, rtol=tol, atol=tol*scale),
+            msg='hessian %s, numerical %s' % (hess, nhess))
+
+    def test_gradient_localize(self):
+        """--> GradientLocalization: position and ellipse agree with Localization"""
+        ellipses = []
+        for loctype in (localization.Localization, localization.GradientLocalization):
+            with likeviews.tsmap_view(sourcename) as tsm:
+                loc = loctype(tsm, quiet=True)
+                self.assertTrue(loc.localize(), msg=loctype.__name__)
+                ellipses.append(loc.ellipse)
+        quad, grad = ellipses
+        moved = np.degrees(SkyDir(quad['ra'],quad['dec']).difference(SkyDir(grad['ra'],grad['dec'])))
+        self.assertTrue(moved < 0.2*quad['a'], msg='positions differ by %.4f deg' % moved)
+        for q in 'ab':
+            self.assertAlmostEqual(quad[q], grad[q], delta=0.1*quad[q])
         
 class TestROI(TestSetup):
     def setUp(self):
@@ -584,6 +858,28 @@ class TestROI(TestSetup):
         pass
         
     
+class TestResidualTS(TestSetup):
+    def setUp(self):
+        setup('roi')
+        self.init = roi.log_like()
+
+    def tearDown(self):
+        self.assertAlmostEquals(self.init, roi.log_like(), delta=0.1)
+
+    def test_tsvalues(self, offsets=(0.5, 1.0, 2.0)):
+        """-->compare TS values fit together with the fit at each position: within 1, or 5%"""
+        from uw.like2 import maps
+        rts = maps.ResidualTS(roi, model='LogParabola(1e-13, 2.2, 0, 1000.)')
+        try:
+            skydirs = [SkyDir(roi.roi_dir.ra(), roi.roi_dir.dec()+d) for d in offsets]
+            multi = rts.tsvalues(skydirs)
+            single = [rts.tsfun(s) for s in skydirs]
+        finally:
+            rts.reset()
+        for a, b in zip(multi, single):
+            self.assertAlmostEquals(b, a, delta=max(1.0, 0.05*b))
+
+
 class TestAssociations(TestSetup):
     def test(self):
         assoc = associate.SrcId()
@@ -591,24 +887,80 @@ class TestAssociations(TestSetup):
         self.assertTrue(set(['ra', 'deltats', 'ang', 'name', 'prior', 'density', 'dec', 'prob',
                 'dir', 'cat']).issubset(t.keys()))
         self.assertAlmostEquals(2.614, t['deltats'][0], delta=0.001)
-     
+
+
+class PoolTestJob(object):
+    """ process_roi for TestLocalPool: on its first try, ROI 3 fails, and ROI 5 kills its worker """
+    def __init__(self, folder):
+        self.folder = folder
+    def process_roi(self, index):
+        marker = os.path.join(self.folder, 'tried_%d' % index)
+        first = not os.path.exists(marker)
+        open(marker, 'w').close()
+        if first and index==3: raise Exception('first try fails')
+        if first and index==5: os._exit(1)
+
+class TestLocalPool(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def test_parse_rois(self):
+        self.assertEqual([9,10,11,12], list(localpool.parse_rois('9-12')))
+        self.assertEqual([1,5,6], list(localpool.parse_rois('1,5,6')))
+        self.assertEqual([3], list(localpool.parse_rois('3')))
+        self.assertEqual([1,5], list(localpool.parse_rois('1,5,')))
+
+    def test_journal(self):
+        """--> journal: only successful ROIs are done, and a later success counts"""
+        filename = os.path.join(self.folder, 'journal.txt')
+        journal = localpool.Journal(filename)
+        self.assertEqual(set(), journal.done())
+        journal.record(1, 'ok', 10.)
+        journal.record(2, 'fail', 5., 'a message with spaces')
+        self.assertEqual(set([1]), localpool.Journal(filename).done())
+        journal.record(2, 'ok', 12.)
+        self.assertEqual(set([1,2]), localpool.Journal(filename).done())
+
+    def test_pool(self):
+        """--> pool: a failure and a dead worker are retried, and a second run resumes"""
+        pool = localpool.LocalPool(PoolTestJob, dict(folder=self.folder), workers=2, retries=1, 
+            outdir=self.folder, poll=0.1)
+        self.assertEqual([], pool(range(8)))
+        lines = [line.split() for line in open(pool.journal.filename)]
+        self.assertEqual(set([3,5]), set(int(t[0]) for t in lines if t[1]=='fail'))
+        self.assertEqual(set(range(8)), pool.journal.done())
+        os.remove(os.path.join(self.folder, 'tried_0'))
+        self.assertEqual([], pool(range(10)))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'tried_0')), msg='ROI 0 was rerun')
+        self.assertEqual(set(range(10)), pool.journal.done())
+
     
 test_cases = (
     TestConfig, 
+    TestPSF,
     TestPoint, 
     TestDiffuse, 
     TestExtended, 
     TestROImodel, 
     TestXML,
     TestBands, 
+    TestStateCache,
     TestLikelihood,
     # changes fitter test? TestAddRemoveSource,
     TestFitterView,
     TestSED,
     TestLocalization,
     TestAssociations,
+    TestLocalPool,
     # no memory to do this at the same time since it creates duplicate large objects
+    # run separately, e.g. run(TestResidualTS)
     #TestROI,
+    #TestResidualTS,
     )
     
 def run(t='all', loader=unittest.TestLoader(), debug=False): 
@@ -12,7 +12,8 @@ import sys, types
 import numpy as np
 from scipy import misc, optimize
 from skymaps import SkyDir
-from . import (roimodel, bandlike, tools, parameterset)
+from uw.irfs import psfman
+from . import (roimodel, bandlike, tools, parameterset, response)
 
 class FitterSummaryMixin(object):
     """mixin to summarize variables"""
@@ -455,6 +456,190 @@ class TSmapView(tools.WithMixin):
         return 2*(self.func.log_like()-self.wzero)
 
 
+def unit_vectors(dirs):
+    """ (n x 3) array of the direction cosines of a list of SkyDir or WeightedSkyDir objects """
+    return np.array([(v.x(), v.y(), v.z()) for v in (d.dir() for d in dirs)], float).reshape((-1,3))
+
+class MultiTSmapView(tools.WithMixin):
+    """ TS for a test point source at many positions, evaluated together
+
+    The predictions of all the other sources, the model without the test source, are fixed.
+    For a block of positions, the PSF values at the data pixels of each band form a
+    (positions x pixels) matrix, and the fits of the test source normalization, or the normalization
+    and the spectral index, are done for all positions together with vectorized Newton iterations.
+    The ROI is not modified.
+    """
+    def __init__(self, blike, source_name, free_index=False, block_size=200, niter=20, tol=1e-3,
+            index_range=(0., 5.), psf_table=False, quiet=True):
+        """
+        blike : LikelihoodViews object, updated for the current parameters
+        source_name : string
+            name of the test source, which provides the spectral model. Its current
+            contribution is removed from the model.
+        free_index : bool
+            if set, fit the spectral index (second parameter of the model) as well as the normalization
+        block_size : int
+            number of positions evaluated together
+        niter : int
+            maximum number of Newton iterations
+        tol : float
+            convergence criterion, the change in log likelihood
+        index_range : tuple of float
+            limits for the spectral index
+        psf_table : bool
+            if set, and the PSF supports it, interpolate PSF values in its radial table
+        """
+        self.blike = blike
+        self.source = blike.sources.find_source(source_name)
+        self.model = self.source.model
+        self.free_index = free_index
+        self.block_size, self.niter, self.tol = block_size, niter, tol
+        self.index_range = index_range
+        self.psf_table = psf_table
+        self.quiet = quiet
+        self.bandlikes = [b for b in blike.selected if b.band.has_pixels]
+        self.batch = self.bandlikes[0].band.integrator.batch
+        self.band_index = np.array([b.band.integrator.index for b in self.bandlikes])
+        self.data, self.fixed, self.pixel_vectors = [], [], []
+        for b in self.bandlikes:
+            response = b[self.source.name]
+            fixed = b.model_pixels - response.pix_counts if response.active else b.model_pixels
+            self.data.append(np.asarray(b.data, float))
+            self.fixed.append(np.array(fixed, float))
+            self.pixel_vectors.append(unit_vectors(b.band.wsdl))
+        self.unweights = np.array([b.unweight for b in self.bandlikes])
+        self.exposure_factors = np.array([b.exposure_factor for b in self.bandlikes])
+
+    def __repr__(self):
+        return '%s.%s: source %s, %d bands, %s' % (self.__module__, self.__class__.__name__,
+            self.source.name, len(self.bandlikes), 'norm and index' if self.free_index else 'norm')
+
+    def restore(self):
+        pass
+
+    def templates(self, skydirs):
+        """ return a list, one per band, of (positions x pixels) arrays of PSF value times pixel area,
+        and a (positions x bands) array of the overlaps with the ROI aperture
+        """
+        x = unit_vectors(skydirs)
+        temps, overlaps = [], []
+        for b, p in zip(self.bandlikes, self.pixel_vectors):
+            band = b.band
+            if hasattr(band.psf, 'matrix'):
+                values = band.psf.matrix(x, p, table=self.psf_table)
+            else:
+                delta = psfman.angular_distance(x, p)
+                values = band.psf(delta.ravel()).reshape(delta.shape)
+            temps.append(values * band.pixel_area)
+            overlaps.append([response.psf_overlap(band, sd) for sd in skydirs])
+        return temps, np.array(overlaps).T
+
+    def counts(self, pars):
+        """ (positions x bands) array of predicted counts for the (positions x npar) external parameters
+        and, if the index is free, (positions x 2 x bands) array of derivatives with respect to the
+        normalization and the index
+        """
+        mu = self.batch.integrate_sets(self.model, pars)[:, self.band_index]
+        if not self.free_index: return mu, None
+        grad = self.batch.gradient_sets(self.model, pars)[:, :2, self.band_index]
+        return mu, grad
+
+    def band_sums(self, temps, mu, second=True):
+        """ for each position and band, the change in pixel log likelihood from the test source,
+        and its first and second derivatives with respect to the counts mu
+        """
+        dlogl, g, h = [np.zeros(mu.shape) for i in range(3)]
+        for k, (t, d, m) in enumerate(zip(temps, self.data, self.fixed)):
+            s = mu[:,k:k+1] * t
+            dlogl[:,k] = np.dot(np.log1p(s/m), d)
+            q = t / (m + s)
+            g[:,k] = np.dot(q, d)
+            if second: h[:,k] = -np.dot(q*q, d)
+        return dlogl, g, h
+
+    def fit_block(self, skydirs):
+        """ return the TS values and fitted parameters for a block of positions
+        """
+        temps, overlaps = self.templates(skydirs)
+        aperture = overlaps * self.exposure_factors # (positions x bands)
+        npos = len(skydirs)
+        pars = np.tile(self.model.get_all_parameters(), (npos,1))
+        norm = self.model[0]
+
+        def loglike(pars):
+            mu = self.counts(pars)[0]
+            dlogl = self.band_sums(temps, mu, second=False)[0]
+            return np.dot(dlogl - mu*aperture, self.unweights)
+
+        # normalization: the derivative of the log likelihood with respect to the scale factor
+        # is convex and decreasing, so Newton iterations starting from zero increase monotonically
+        e = self.counts(pars)[0] / norm # counts per unit normalization
+        a = np.zeros(npos)
+        for i in range(self.niter):
+            dlogl, g, h = self.band_sums(temps, a[:,None]*e)
+            grad = np.dot((g - aperture)*e, self.unweights)
+            hess = np.dot(h*e**2, self.unweights)
+            if i==0: active = grad>0 # otherwise the maximum is at zero
+            step = np.where(active, -grad/np.where(active, hess, -1), 0)
+            a += step
+            if np.all(np.abs(step*grad)<self.tol): break
+        pars[:,0] = a * norm
+
+        if self.free_index:
+            pars = self.fit_index(pars, norm, active, temps, aperture, loglike)
+        ts = 2*loglike(pars)
+        return np.where(active, np.maximum(ts,0), 0), pars
+
+    def fit_index(self, pars, norm, active, temps, aperture, loglike):
+        """ Newton iterations for the normalization and index, for the active positions
+        The hessian is the Fisher information estimate, and the step is halved if the likelihood decreases
+        """
+        w = loglike(pars)
+        for i in range(self.niter):
+            mu, grad = self.counts(pars)
+            grad[:,0] *= norm # the normalization relative to the initial value
+            dlogl, g, h = self.band_sums(temps, mu)
+            # derivatives with respect to the parameters, from the derivatives for each band
+            dl = np.einsum('pkb,pb->pk', grad, (g - aperture)*self.unweights)
+            hess = np.einsum('pkb,pjb,pb->pkj', grad, grad, h*self.unweights)
+            hess[~active] = -np.eye(2) # not fit, and singular if the normalization is zero
+            hess[:,1,1] -= 1e-9*np.abs(hess[:,1,1]) + 1e-12
+            step = -np.linalg.solve(hess, dl[:,:,None])[:,:,0]
+            step[~active] = 0
+            step[:,0] *= norm
+            for j in range(5):
+                trial = pars.copy()
+                trial[:,:2] += step
+                trial[:,0] = np.maximum(trial[:,0], 0)
+                trial[:,1] = np.clip(trial[:,1], *self.index_range)
+                wtrial = loglike(trial)
+                better = wtrial>=w
+                pars[better] = trial[better]
+                if np.all(better): break
+                step[better] = 0
+                step *= 0.5
+            dw = np.where(better, wtrial-w, 0)
+            w = np.where(better, wtrial, w)
+            if np.all(dw<self.tol): break
+        return pars
+
+    def __call__(self, skydirs):
+        """ return an array of TS values for the list of positions
+        The fitted parameters are saved as the (positions x npar) array fit_pars
+        """
+        if isinstance(skydirs, SkyDir): skydirs = [skydirs]
+        skydirs = [sd if isinstance(sd, SkyDir) else SkyDir(*sd) for sd in skydirs]
+        ts, pars = [], []
+        for i in range(0, len(skydirs), self.block_size):
+            t, p = self.fit_block(skydirs[i:i+self.block_size])
+            ts.append(t); pars.append(p)
+            if not self.quiet:
+                print '%d/%d positions, max TS %.1f' % (min(i+self.block_size, len(skydirs)),
+                    len(skydirs), ts[-1].max())
+        self.fit_pars = np.vstack(pars)
+        return np.concatenate(ts)
+
+
 class EnergyFluxView(tools.WithMixin):
 
     def __init__(self, blike, func, energy, **kw):
@@ -533,6 +718,7 @@ class LikelihoodViews(bandlike.BandLikeList):
     * fits: fitter_view, return a FitterView or SubsetFitterView
     * SED : energy_flux_view, a fitterView with a source selected
     * TSmap : tsmap_view : a FitterView with the source flux selected which can have the position changed.
+    * TSmap : multi_tsmap_view : TS for the source at a list of positions, evaluated together
     """
     
     def fitter_view(self, select=None, setpars=None, **kwargs):
@@ -576,6 +762,15 @@ class LikelihoodViews(bandlike.BandLikeList):
         except Exception, msg:
             raise Exception('could not create tsmap function for source %s;%s' %(source_name, msg))
         return TSmapView(self, func, **kw)
+
+    def multi_tsmap_view(self, source_name, **kw):
+        """Return a MultiTSmapView for the test source, to evaluate TS for a list of positions
+        """
+        if source_name is None and self.sources.selected_source is not None:
+            source_name = self.sources.selected_source.name 
+        if source_name is None: 
+            raise Exception('No source is selected for a tsmap')
+        return MultiTSmapView(self, source_name, **kw)
         
     def normalization_view(self, source_name):
         return NormalizationView(self, source_name)
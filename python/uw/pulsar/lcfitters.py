@@ -15,14 +15,22 @@ author: M. Kerr <matthew.kerr@gmail.com>
 
 """
 
+import os
 import numpy as np
 from copy import deepcopy
+import multiprocessing
 import scipy
 from scipy.optimize import fmin,fmin_tnc,leastsq
 from uw.pulsar.stats import z2mw,hm,hmw
 
 SECSPERDAY = 86400.
 
+# the LCResampler for the worker processes, set before the pool is forked
+_resampler = None
+
+def _refit_sample(index):
+    return _resampler.refit(index)
+
 def shifted(m,delta=0.5):
     """ Produce a copy of a binned profile shifted in phase by delta."""
     f = np.fft.fft(m,axis=-1) 
@@ -530,6 +538,10 @@ class WeightedLCFitter(UnweightedLCFitter):
         a = np.argsort(self.phases)
         self.phases = self.phases[a]
         self.weights = self.weights[a]
+        # keep any photon times in the same order
+        times = getattr(self,'times',None)
+        if (np.ndim(times)>0) and (len(times)==len(a)):
+            self.times = np.asarray(times)[a]
         self.counts_centers = []
         self.slices = []
         indices = np.arange(len(self.weights))
@@ -657,6 +669,168 @@ class ChiSqLCFitter(object):
         if not resids:
             pl.plot(x,my,color='red')
 
+class LCResampler(object):
+    """ Refit a light curve template to bootstrap or jackknife resamplings
+        of the photons of a fitter, with a pool of processes.
+
+        Each sample is fit by a new fitter, with a copy of the template,
+        so the original fitter is not changed.  The photons of sample i
+        are drawn with a random state seeded with (seed,i), so results do
+        not depend on the number of processes or the order of execution.
+        With an output file, each result is appended as it arrives, and
+        samples already in the file are not refit, so an interrupted run
+        can be resumed.  The first line of the file records the method
+        and seed, and resuming with different ones raises a ValueError.
+
+        Example:
+            r = LCResampler(fitter,workers=16,outfile='boot.txt')
+            results = r.bootstrap(1000)
+            errors = r.errors()
+    """
+
+    def __init__(self,fitter,fit_kwargs={},workers=None,seed=0,
+        outfile=None,max_tries=2):
+        """ fitter -- an UnweightedLCFitter or WeightedLCFitter
+            fit_kwargs -- arguments for fit; errors are never estimated
+            workers -- number of processes; if None, the number of CPUs
+            seed -- the base seed for the random resampling
+            outfile -- if set, a text file for the results
+            max_tries -- number of resamplings to try for a bootstrap
+                sample whose fit fails
+        """
+        self.fitter = fitter
+        self.fit_kwargs = dict(fit_kwargs)
+        self.fit_kwargs['estimate_errors'] = False # never estimate errors
+        if 'unbinned' not in self.fit_kwargs.keys():
+            self.fit_kwargs['unbinned'] = True
+        self.workers = workers or multiprocessing.cpu_count()
+        self.seed = seed
+        self.outfile = outfile
+        self.max_tries = max_tries
+        self.method = None
+
+    def sample_indices(self,index,attempt=0):
+        """ Return the indices of the photons in a sample."""
+        n = len(self.fitter.phases)
+        if self.method == 'jackknife':
+            return np.delete(np.arange(n),self.groups[index])
+        rng = np.random.RandomState([self.seed,index,attempt])
+        return rng.randint(0,n,n)
+
+    def resampled_fitter(self,a):
+        """ Return a new fitter for the photons with indices a."""
+        # the same indices for the phases, weights and times, which are
+        # in the same order (see WeightedLCFitter._hist_setup)
+        f = self.fitter
+        times = getattr(f,'times',1)
+        if np.ndim(times)>0 and len(times)==len(f.phases):
+            times = times[a]
+        kwargs = dict(times=times,binned_bins=f.binned_bins,
+            phase_shift=f.phase_shift,
+            weights=None if f.weights is None else f.weights[a])
+        return f.__class__(f.template.copy(),f.phases[a],**kwargs)
+
+    def refit(self,index):
+        """ Fit sample index; return index, the number of tries (0 if
+            all failed), the log likelihood, and the parameters."""
+        ntries = 1 if self.method=='jackknife' else self.max_tries
+        for attempt in xrange(ntries):
+            f = self.resampled_fitter(self.sample_indices(index,attempt))
+            if f.fit(**self.fit_kwargs):
+                return index,attempt+1,f.ll,f.template.get_parameters()
+        npar = len(self.fitter.template.get_parameters())
+        return index,0,np.nan,np.nan*np.ones(npar)
+
+    def header(self):
+        """ Return the description of the samples for the output file."""
+        h = 'method=%s seed=%s'%(self.method,self.seed)
+        if self.method == 'jackknife':
+            h += ' ngroups=%d'%(len(self.groups))
+        return h
+
+    def _read(self):
+        """ Return a dict of the results in the output file; raise a
+            ValueError if it was written for different samples."""
+        if (self.outfile is None) or (not os.path.exists(self.outfile)):
+            return dict()
+        done = dict()
+        header = None
+        for line in open(self.outfile):
+            if line.startswith('#'):
+                if header is None: header = line[1:].strip()
+                continue
+            toks = line.split()
+            done[int(toks[0])] = (int(toks[1]),float(toks[2]),
+                np.asarray(toks[3:],dtype=float))
+        if header != self.header():
+            raise ValueError('%s has samples for "%s", not "%s"'%(
+                self.outfile,header,self.header()))
+        return done
+
+    def run(self,nsamp):
+        """ Fit samples 0 to nsamp-1 that are not already in the output
+            file; return an (nsamp x npar) array of the fit parameters,
+            with NaN for failed fits."""
+        global _resampler
+        done = self._read()
+        todo = [i for i in xrange(nsamp) if i not in done]
+        out = None
+        if self.outfile is not None:
+            new_file = not os.path.exists(self.outfile)
+            out = open(self.outfile,'a')
+            if new_file:
+                names = self.fitter.template.get_parameter_names()
+                out.write('# %s\n# sample tries logl %s\n'%(self.header(),' '.join(names)))
+        _resampler = self
+        pool = multiprocessing.Pool(self.workers) if self.workers > 1 else None
+        try:
+            results = map(_refit_sample,todo) if pool is None else \
+                pool.imap_unordered(_refit_sample,todo)
+            for index,ntries,ll,p in results:
+                done[index] = (ntries,ll,p)
+                if out is not None:
+                    # full precision, so a resumed run gives the same results
+                    out.write('%d %d %.17g %s\n'%(index,ntries,ll,' '.join(['%.17g'%x for x in p])))
+                    out.flush()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if out is not None: out.close()
+            _resampler = None
+        self.ntries = np.asarray([done[i][0] for i in xrange(nsamp)])
+        self.logls = np.asarray([done[i][1] for i in xrange(nsamp)])
+        self.results = np.asarray([done[i][2] for i in xrange(nsamp)])
+        return self.results
+
+    def bootstrap(self,nsamp=100,set_errors=False):
+        """ Refit nsamp bootstrap samples: photons drawn with replacement."""
+        self.method = 'bootstrap'
+        results = self.run(nsamp)
+        if set_errors:
+            self.fitter.template.set_errors(self.errors())
+        return results
+
+    def jackknife(self,ngroups=100,set_errors=False):
+        """ Refit the samples made by deleting each of ngroups groups of
+            photons, assigned at random."""
+        self.method = 'jackknife'
+        n = len(self.fitter.phases)
+        perm = np.random.RandomState([self.seed]).permutation(n)
+        self.groups = np.array_split(perm,ngroups)
+        results = self.run(ngroups)
+        if set_errors:
+            self.fitter.template.set_errors(self.errors())
+        return results
+
+    def errors(self):
+        """ Return the parameter errors from the successful samples."""
+        r = self.results[self.ntries > 0]
+        if self.method == 'jackknife':
+            n = len(r)
+            return ((n-1.)/n*((r-r.mean(axis=0))**2).sum(axis=0))**0.5
+        return np.std(r,axis=0)
+
 def hessian(m,mf,*args,**kwargs):
     """Calculate the Hessian; mf is the minimizing function, m is the model,args additional arguments for mf."""
     p = m.get_parameters().copy()
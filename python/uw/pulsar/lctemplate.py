@@ -32,6 +32,7 @@ class LCTemplate(object):
         self._sanity_checks()
         self._cache = None
         self._cache_out_of_date = True
+        self._interp = None
 
     def _sanity_checks(self):
         if len(self.primitives) != len(self.norms):
@@ -59,6 +60,7 @@ class LCTemplate(object):
             start += n
         self.norms.set_parameters(p[start:],free)
         self._cache_out_of_date = True
+        if self._interp is not None: self._interp.clear()
         return params_ok
 
     def set_errors(self,errs):
@@ -156,7 +158,13 @@ class LCTemplate(object):
 
     def __call__(self,phases,log10_ens=3,suppress_bg=False,use_cache=False):
         """ Evaluate template at the provided phases and (if provided)
-            energies.  If "suppress_bg" is set, ignore the DC component."""
+            energies.  If "suppress_bg" is set, ignore the DC component.
+            If enable_cache has been called, the values are interpolated."""
+        if (self._interp is not None) and (not suppress_bg):
+            return self._interp(phases,log10_ens)
+        return self._evaluate(phases,log10_ens,suppress_bg,use_cache)
+
+    def _evaluate(self,phases,log10_ens=3,suppress_bg=False,use_cache=False):
         if use_cache:
             if self._cache_out_of_date:
                 self.set_cache()
@@ -174,10 +182,38 @@ class LCTemplate(object):
         return (1.-norm) + rvals
 
     def set_cache(self,ncache=1000):
-        t = self(np.linspace(0,1,ncache+1))
+        t = self._evaluate(np.linspace(0,1,ncache+1))
         self._cache = 0.5*(t[1:]+t[:-1]) 
         self._cache_out_of_date = False
 
+    def enable_cache(self,nphase=1024,log10_ens=None):
+        """ Evaluate the template, and its gradient, by interpolation in
+            tables on a grid of phase and, for an energy-dependent
+            template, log10(energy).  The tables are remade when the
+            parameters change.  See InterpolatedCache.
+
+            nphase -- number of phase grid points; the interpolation error
+                scales as nphase**-3
+            log10_ens -- increasing grid of log10(E/MeV), required if the
+                template is energy dependent
+        """
+        if self.is_energy_dependent() and (log10_ens is None):
+            raise ValueError('An energy-dependent template needs a log10_ens grid.')
+        if not self.is_energy_dependent():
+            log10_ens = None
+        self._interp = InterpolatedCache(self,nphase=nphase,log10_ens=log10_ens)
+
+    def disable_cache(self):
+        self._interp = None
+
+    def _cache_state(self,free=True):
+        """ Return a key for the parameters, and the free mask, which
+            determine the values or gradient of the template."""
+        p = tuple(self.get_parameters(free=False))
+        if not free: return p
+        masks = [prim.free for prim in self.primitives] + [self.norms.free]
+        return p + tuple(np.concatenate(masks))
+
     def single_component(self,index,phases,log10_ens=3):
         """ Evaluate a single component of template."""
         n = self.norms(log10_ens)[index]
@@ -193,6 +229,11 @@ class LCTemplate(object):
 
 
     def gradient(self,phases,log10_ens=3,free=True):
+        if self._interp is not None:
+            return self._interp.gradient(phases,log10_ens,free=free)
+        return self._gradient(phases,log10_ens,free)
+
+    def _gradient(self,phases,log10_ens=3,free=True):
         r = np.empty([len(self.get_parameters(free=free)),len(phases)])
         c = 0
         norms = self.norms()
@@ -570,6 +611,76 @@ class LCBridgeTemplate(LCTemplate):
         rvals /= w[0].sum()
         return rvals
 
+class InterpolatedCache(object):
+    """ Tables of the values and the parameter gradient of a template on a
+        uniform grid in phase, and optionally a grid in log10(energy).
+
+        Values at arbitrary phases are found by periodic cubic (Catmull-
+        Rom) interpolation in phase, and linear interpolation in energy,
+        with energies outside the grid clipped to its range.  A table is
+        made when first needed, for the current parameters (and, for the
+        gradient, free mask), so evaluating a template for many photons
+        costs a grid evaluation and an interpolation.  Discontinuous
+        templates, e.g. the bridge pedestal, are smoothed at the scale of
+        the grid spacing.  The cubic can overshoot below zero next to a
+        peak narrower than the grid spacing, so values are clipped at 0.
+    """
+
+    def __init__(self,template,nphase=1024,log10_ens=None):
+        self.template = template
+        self.nphase = nphase
+        self.dom = np.arange(nphase)/float(nphase)
+        self.log10_ens = None if log10_ens is None else np.asarray(log10_ens,dtype=float)
+        self.clear()
+
+    def clear(self):
+        self.values = self.gradients = None
+        self.values_state = self.gradients_state = None
+
+    def _make_table(self,func):
+        """ Return an array (..., energies, nphase) of func(phases,log10_ens)."""
+        if self.log10_ens is None:
+            t = func(self.dom,3)
+            return t.reshape(t.shape[:-1]+(1,self.nphase))
+        t = np.asarray([func(self.dom,en) for en in self.log10_ens])
+        return np.rollaxis(t,0,t.ndim-1)
+
+    def _interpolate(self,table,phases,log10_ens):
+        phases = np.asarray(phases,dtype=float)
+        shape = phases.shape
+        n = self.nphase
+        x = np.mod(phases.ravel(),1)*n
+        i = np.floor(x).astype(int)
+        t = x - i
+        i1 = i % n; i0 = (i1-1) % n; i2 = (i1+1) % n; i3 = (i1+2) % n
+        def cubic(j):
+            p0,p1,p2,p3 = [table[...,j,k] for k in (i0,i1,i2,i3)]
+            return p1 + 0.5*t*(p2-p0 + t*(2*p0-5*p1+4*p2-p3 + t*(3*(p1-p2)+p3-p0)))
+        if self.log10_ens is None:
+            rvals = cubic(0)
+        else:
+            grid = self.log10_ens
+            en = np.clip(np.broadcast_to(log10_ens,shape).ravel(),grid[0],grid[-1])
+            j = np.clip(np.searchsorted(grid,en)-1,0,len(grid)-2)
+            w = (en-grid[j])/(grid[j+1]-grid[j])
+            rvals = (1-w)*cubic(j) + w*cubic(j+1)
+        return rvals.reshape(table.shape[:-2]+shape)
+
+    def __call__(self,phases,log10_ens=3):
+        state = self.template._cache_state(free=False)
+        if (self.values is None) or (self.values_state != state):
+            self.values = self._make_table(self.template._evaluate)
+            self.values_state = state
+        return np.maximum(self._interpolate(self.values,phases,log10_ens),0)
+
+    def gradient(self,phases,log10_ens=3,free=True):
+        state = (free,) + self.template._cache_state(free=free)
+        if (self.gradients is None) or (self.gradients_state != state):
+            f = lambda ph,en: self.template._gradient(ph,en,free=free)
+            self.gradients = self._make_table(f)
+            self.gradients_state = state
+        return self._interpolate(self.gradients,phases,log10_ens)
+
 def get_gauss2(pulse_frac=1,x1=0.1,x2=0.55,ratio=1.5,width1=0.01,width2=0.02,lorentzian=False,bridge_frac=0,skew=False):
     """Return a two-gaussian template.  Convenience function."""
     n1,n2 = np.asarray([ratio,1.])*(1-bridge_frac)*(pulse_frac/(1.+ratio))
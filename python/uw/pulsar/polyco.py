@@ -217,20 +217,38 @@ class Polyco:
         sorting = np.argsort(keys)
         self.entries = np.asarray(self.entries)[sorting]
         self.keys = np.append(self.entries[0].tstart,keys[sorting])
+        self.make_columns()
+
+    def make_columns(self):
+        """Arrays of the entry parameters, in the order of the keys, for
+           vectorized evaluation.  The coefficients are the rows of a
+           matrix, padded with zeros to the largest number."""
+        self.tmids = np.asarray([e.tmid for e in self.entries])
+        self.rphases = np.asarray([e.rphase for e in self.entries])
+        self.f0s = np.asarray([e.f0 for e in self.entries])
+        self.uids = np.asarray([e.uid for e in self.entries])
+        ncoeff = max([e.ncoeff for e in self.entries])
+        self.coeffs = np.zeros([len(self.entries),ncoeff])
+        for i,e in enumerate(self.entries):
+            self.coeffs[i,:e.ncoeff] = e.coeffs[:e.ncoeff]
+
+    def entry_index(self,t):
+        '''Returns the index of the polyco entry for time(s) t (in MJD)'''
+        idx = np.searchsorted(self.keys,t)
+        if np.any(idx == len(self.keys)):
+            print 'The following MJDS were beyond the end of the polyco validity (%s):'%(self.keys[-1])
+            print t[idx == len(self.keys)] if type(t) is type(np.array([1])) else t
+            raise IndexError
+        if np.any(idx==0):
+            print 'The following MJDS were before the start of the polyco validity (%s):'%(self.keys[0])
+            print t[idx == 0] if type(t) is type(np.array([1])) else t
+            raise IndexError
+        return idx-1
 
     def getentry(self,t,use_keys=True):
         '''Returns the polyco entry corresponding to time t (in MJD)'''
         if use_keys:
-            idx = np.searchsorted(self.keys,t)
-            if np.any(idx == len(self.keys)):
-                print 'The following MJDS were beyond the end of the polyco validity (%s):'%(self.keys[-1])
-                print t[idx == len(self.keys)] if type(t) is type(np.array([1])) else t
-                raise IndexError
-            if np.any(idx==0):
-                print 'The following MJDS were before the start of the polyco validity (%s):'%(self.keys[0])
-                print t[idx == 0] if type(t) is type(np.array([1])) else t
-                raise IndexError
-            return self.entries[idx-1]
+            return self.entries[self.entry_index(t)]
         for pe in self.entries:
             if pe.valid(t):
                 return pe
@@ -239,32 +257,54 @@ class Polyco:
         sys.exit(9)
         return None
 
-    def _vec_eval(self,times,func):
-        if not hasattr(times,'__len__'):
-            times = [times]
-        pces = self.getentry(times,use_keys=True)
-        self.ids = np.asarray([pc.uid for pc in pces])
-        return np.asarray(map(func,pces,times))
+    def _vec_dt(self,times):
+        """ Return the entry indices and the offsets (in minutes) from the
+            entry midpoints for a vector of times."""
+        times = np.atleast_1d(np.asarray(times,dtype=float))
+        idx = self.entry_index(times)
+        self.ids = self.uids[idx]
+        return idx,(times-self.tmids[idx])*1440.0
+
+    def _vec_absphase(self,idx,dt):
+        # Horner's rule over the columns, in the order of evalabsphase
+        c = self.coeffs
+        phase = c[idx,-1]
+        for i in xrange(c.shape[1]-2,-1,-1):
+            phase = c[idx,i] + dt*phase
+        # Add DC term
+        phase += self.rphases[idx] + dt*60.0*self.f0s[idx]
+        return phase
 
     def vec_evalphase(self,times):
         """ Return the phases for a vector of times; NB times should be in
             MJD @ GEO."""
-        return self._vec_eval(times,PolycoEntry.evalphase)
+        phase = self._vec_absphase(*self._vec_dt(times))
+        return phase - np.floor(phase)
 
     def vec_evalabsphase(self,times):
         """ Return the phases for a vector of times; NB times should be in
             MJD @ GEO."""
-        return self._vec_eval(times,PolycoEntry.evalabsphase)
+        return self._vec_absphase(*self._vec_dt(times))
 
     def vec_evalfreq(self,times):
-        """ Return the phases for a vector of times; NB times should be in
-            MJD @ GEO."""
-        return self._vec_eval(times,PolycoEntry.evalfreq)
+        """ Return the frequencies for a vector of times; NB times should be
+            in MJD @ GEO."""
+        idx,dt = self._vec_dt(times)
+        c = self.coeffs
+        s = np.zeros_like(dt)
+        for i in xrange(c.shape[1]-1,0,-1):
+            s = float(i)*c[idx,i] + dt*s
+        return self.f0s[idx] + s/60.0
 
     def vec_evalfreqderiv(self,times):
-        """ Return the phases for a vector of times; NB times should be in
-            MJD @ GEO."""
-        return self._vec_eval(times,PolycoEntry.evalfreqderiv)
+        """ Return the frequency derivatives for a vector of times; NB times
+            should be in MJD @ GEO."""
+        idx,dt = self._vec_dt(times)
+        c = self.coeffs
+        s = np.zeros_like(dt)
+        for i in xrange(c.shape[1]-1,1,-1):
+            s = float(i)*float(i-1)*c[idx,i] + dt*s
+        return s/(60.0*60.0)
 
     def invert_phase_shift(self,t0,phi):
         """ Compute the time lapse (in s) corresponding to phi at t0."""
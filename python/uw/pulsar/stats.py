@@ -104,25 +104,55 @@ def sigma_trials(sigma,trials):
       return (sigma**2 - 2*np.log(trials))**0.5
 
 
+def trig_moments(phases,m=2,weights=None,chunk=1000000):
+    """ Return the (weighted) sums of cos(2 pi k phi) and sin(2 pi k phi)
+        for the harmonics k = 1..m, as two arrays with shape (..., m).
+
+        The harmonics are found together from the powers of the complex
+        exponential exp(2 pi i phi), evaluated once per phase, and the
+        phases are processed in blocks of about chunk values to bound the
+        memory.
+
+        args
+        ----
+        phases  array of phases (0 to 1); the last axis is summed, and any
+                leading axes, e.g. for a set of trial ephemerides, are kept
+
+        kwargs
+        ------
+        m       [2] the number of harmonics
+        weights [None] photon weights, with the shape of phases or of the
+                last axis
+        chunk   [1000000] the number of values in a block
+    """
+    phases = np.asarray(phases,dtype=float)
+    shape,n = phases.shape[:-1],phases.shape[-1]
+    phases = phases.reshape(-1,n)
+    if weights is not None:
+        weights = np.broadcast_to(np.asarray(weights,dtype=float),
+            shape+(n,)).reshape(-1,n)
+    step = max(1,chunk//len(phases))
+    sums = np.zeros([len(phases),m],dtype=complex)
+    for i in xrange(0,n,step):
+        z = np.exp((2j*np.pi)*phases[:,i:i+step])
+        zk = z.copy() if weights is None else z*weights[:,i:i+step]
+        for k in xrange(m):
+            sums[:,k] += zk.sum(axis=1)
+            np.multiply(zk,z,out=zk)
+    sums = sums.reshape(shape+(m,))
+    return sums.real,sums.imag
+
+def _weight_norm(weights):
+    """ The sum of the squared weights, for broadcasting against (..., m)."""
+    return np.asarray((np.asarray(weights,dtype=float)**2).sum(axis=-1))[...,None]
+
 def z2m(phases,m=2):
     """ Return the Z^2_m test for each harmonic up to the specified m.
         See de Jager et al. 1989 for definition.    
+        Phases may have leading axes, see trig_moments.
     """
-
-    phases = np.asarray(phases)*TWOPI #phase in radians
-    n = len(phases)
-
-    if n < 5e3:  #faster for 100s to 1000s of phases, but requires ~20x memory of alternative
-
-        s = (np.cos(np.outer(np.arange(1,m+1),phases))).sum(axis=1)**2 +\
-            (np.sin(np.outer(np.arange(1,m+1),phases))).sum(axis=1)**2
-
-    else:
-
-        s = (np.asarray([(np.cos(k*phases)).sum() for k in xrange(1,m+1)]))**2 +\
-            (np.asarray([(np.sin(k*phases)).sum() for k in xrange(1,m+1)]))**2
-
-    return (2./n)*np.cumsum(s)
+    c,s = trig_moments(phases,m)
+    return (2./np.shape(phases)[-1])*np.cumsum(c**2+s**2,axis=-1)
 
 def z2mw(phases,weights,m=2):
    """ Return the Z^2_m test for each harmonic up to the specified m.
@@ -131,13 +161,8 @@ def z2mw(phases,weights,m=2):
        well-distributed or assumed to be fixed, the CLT applies and the
        statistic remains calibrated.  Nice!
     """
-
-   phases = np.asarray(phases)*(2*np.pi) #phase in radians
-
-   s = (np.asarray([(np.cos(k*phases)*weights).sum() for k in xrange(1,m+1)]))**2 +\
-       (np.asarray([(np.sin(k*phases)*weights).sum() for k in xrange(1,m+1)]))**2
-
-   return np.cumsum(s) * (2./(weights**2).sum())
+   c,s = trig_moments(phases,m,weights=weights)
+   return np.cumsum(c**2+s**2,axis=-1) * (2./_weight_norm(weights))
 
 def sf_z2m(ts,m=2):
     """ Return the survival function (chance probability) according to the
@@ -151,22 +176,17 @@ def sf_z2m(ts,m=2):
     return chi2.sf(ts,2*m)
 
 def best_m(phases,weights=None,m=100):
-    z = z2mw(phases,np.ones_like(phases) if weights is None else weights,m=m) 
-    return np.arange(1,m+1)[np.argmax(z-4*np.arange(0,m))]
+    z = z2m(phases,m=m) if weights is None else z2mw(phases,weights,m=m)
+    return np.arange(1,m+1)[np.argmax(z-4*np.arange(0,m),axis=-1)]
 
 def em_four(phases,m=2,weights=None):
     """ Return the empirical Fourier coefficients up to the mth harmonic.
         These are derived from the empirical trignometric moments."""
    
-    phases = np.asarray(phases)*TWOPI #phase in radians
-
-    n = len(phases) if weights is None else weights.sum()
-    weights = 1. if weights is None else weights
-
-    aks = (1./n)*np.asarray([(weights*np.cos(k*phases)).sum() for k in xrange(1,m+1)])
-    bks = (1./n)*np.asarray([(weights*np.sin(k*phases)).sum() for k in xrange(1,m+1)])
-
-    return aks,bks
+    n = np.shape(phases)[-1] if weights is None else \
+        np.asarray(np.sum(weights,axis=-1))[...,None]
+    c,s = trig_moments(phases,m,weights=weights)
+    return (1./n)*c,(1./n)*s
 
 def em_lc(coeffs,dom):
     """ Evaluate the light curve at the provided phases (0 to 1) for the
@@ -186,12 +206,7 @@ def hm(phases,m=20,c=4):
         m == maximum search harmonic
         c == offset for each successive harmonic
     """
-    phases = np.asarray(phases)*(2*np.pi) #phase in radians
-
-    s = (np.asarray([(np.cos(k*phases)).sum() for k in xrange(1,m+1)]))**2 +\
-        (np.asarray([(np.sin(k*phases)).sum() for k in xrange(1,m+1)]))**2
-
-    return ((2./len(phases))*np.cumsum(s) - c*np.arange(0,m)).max()
+    return (z2m(phases,m) - c*np.arange(0,m)).max(axis=-1)
 
 
 def hmw(phases,weights,m=20,c=4):
@@ -200,12 +215,7 @@ def hmw(phases,weights,m=20,c=4):
         is corrected such that the CLT still applies, i.e., it maintains
         the same calibration as the unweighted version."""
 
-    phases = np.asarray(phases)*(2*np.pi) #phase in radians
-
-    s = (np.asarray([(weights*np.cos(k*phases)).sum() for k in xrange(1,m+1)]))**2 +\
-        (np.asarray([(weights*np.sin(k*phases)).sum() for k in xrange(1,m+1)]))**2
-
-    return ( (2./(weights**2).sum()) * np.cumsum(s) - c*np.arange(0,m) ).max()
+    return (z2mw(phases,weights,m) - c*np.arange(0,m)).max(axis=-1)
 
 
 #@vec
@@ -0,0 +1,388 @@
+"""
+Tests of the pulsar package, using unittest
+"""
+import os, sys, shutil, tempfile, unittest
+import numpy as np
+from scipy.stats import norm
+
+from uw.pulsar import polyco, lctemplate, lcfitters, toabinner, toagen, stats
+
+def write_polycos(filename, nentries=5, nspan=60, ncoeffs=(12,9), mjd0=55000., seed=0):
+    """ write a tempo-format polyco file with random coefficients, alternating the number of 
+        coefficients, and entries covering contiguous spans of nspan minutes
+    """
+    rng = np.random.RandomState(seed)
+    with open(filename, 'w') as out:
+        for k in xrange(nentries):
+            tmid = mjd0 + (k+0.5)*nspan/1440.
+            ncoeff = ncoeffs[k%len(ncoeffs)]
+            coeffs = rng.randn(ncoeff) * 10.**(-2*np.arange(ncoeff))
+            out.write('J0000+0000 01-Jan-00 120000.00 %.10f 10.0 0.0 -6.0\n' % tmid)
+            out.write('%20.6f%18.12f%5s%6d%5d%10.3f\n' % (1e6*(k+1)+rng.rand(), 100+rng.rand(),
+                '@', nspan, ncoeff, 1400.))
+            for i in xrange(0, ncoeff, 3):
+                out.write(''.join('%25.17e' % c for c in coeffs[i:i+3])+'\n')
+
+
+class TestPolyco(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        fname = os.path.join(self.folder, 'polyco.dat')
+        write_polycos(fname)
+        self.polyco = polyco.Polyco(fname, recalc_polycos=False)
+        self.times = np.sort(np.random.RandomState(1).uniform(
+            self.polyco.keys[0], self.polyco.keys[-1], 1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def compare(self, vec_func, entry_func, tol=1e-12, atol=None):
+        """ compare to tol relative to the maximum, or, if atol is set, to atol """
+        p = self.polyco
+        a = vec_func(self.times)
+        b = np.asarray([getattr(p.getentry(t), entry_func)(t) for t in self.times])
+        if atol is None: atol = tol*np.abs(b).max()
+        else: tol = 0
+        self.assertTrue(np.allclose(a, b, rtol=tol, atol=atol), 
+            msg='%s: maximum difference %.3g' % (entry_func, np.abs(a-b).max()))
+
+    def test_entries(self):
+        """-->vectorized entry lookup the same as the valid entry for each time"""
+        p = self.polyco
+        p.vec_evalabsphase(self.times)
+        for t, uid in zip(self.times, p.ids):
+            self.assertTrue(p.getentry(t, use_keys=False).uid==uid)
+
+    def test_absphase(self):
+        """-->Horner evaluation of the absolute phase the same as for each entry"""
+        # the same operations in the same order, so equal
+        self.compare(self.polyco.vec_evalabsphase, 'evalabsphase', atol=1e-12)
+
+    def test_phase(self):
+        """-->Horner evaluation of the phase the same as for each entry"""
+        self.compare(self.polyco.vec_evalphase, 'evalphase', atol=1e-12)
+
+    def test_freq(self):
+        """-->Horner evaluation of the frequency and its derivative agrees with each entry"""
+        self.compare(self.polyco.vec_evalfreq, 'evalfreq')
+        self.compare(self.polyco.vec_evalfreqderiv, 'evalfreqderiv')
+
+
+class ToaData(object):
+    """ the photon data used by a TOA generator, as in phasedata.PhaseData """
+    def __init__(self, mjds, ph, weights=None):
+        self.mjds, self.ph, self.weights = mjds, ph, weights
+        self.bary = True
+
+    def toa_data(self, mjd_start, mjd_stop):
+        mask = (self.mjds >= mjd_start)&(self.mjds < mjd_stop)
+        return self.ph[mask], (None if self.weights is None else self.weights[mask])
+
+def cluster_phases(centres, nsig=100, nbkg=20, width=0.02):
+    """ return phases and weights of symmetric gaussian clusters at the centres, taken from
+        the quantiles rather than random draws, and of a uniform background
+    """
+    q = norm.ppf((np.arange(nsig)+0.5)/nsig)
+    sig = np.concatenate([c + width*q for c in centres])
+    ph = np.mod(np.append(sig, (np.arange(nbkg)+0.5)/nbkg), 1)
+    return ph, np.append(np.ones(len(sig))*0.9, np.ones(nbkg)*0.3)
+
+
+class TestTOAGenerator(unittest.TestCase):
+    """ get_toas_parallel compared with get_toas, for a gaussian template at phase 0.5
+
+        The first interval has a peak at 0.503, on the grid at 0.50, and the second has two
+        peaks, at 0.25 and 0.75.  Tracking the grid position is a tie, which chooses 0.25,
+        while the fitted position chooses 0.75, so the replay must refit it.
+    """
+    centres = [(0.503,), (0.25, 0.75), (0.76,), (0.742,)]
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        fname = os.path.join(self.folder, 'polyco.dat')
+        write_polycos(fname)
+        self.polyco = polyco.Polyco(fname, recalc_polycos=False)
+        edges = np.linspace(self.polyco.keys[0], self.polyco.keys[-1], len(self.centres)+1)
+        self.starts, self.stops = edges[:-1], edges[1:]
+        mjds, ph, w = [], [], []
+        for start, stop, centres in zip(self.starts, self.stops, self.centres):
+            p, wt = cluster_phases(centres)
+            mjds.append(np.linspace(start, stop, len(p)+2)[1:-1])
+            ph.append(p); w.append(wt)
+        self.mjds, self.ph, self.weights = map(np.concatenate, (mjds, ph, w))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def generator(self, weighted):
+        data = ToaData(self.mjds, self.ph, self.weights if weighted else None)
+        template = lctemplate.get_gauss1(pulse_frac=0.8, x1=0.5, width1=0.02)
+        return toagen.UnbinnedTOAGenerator(data, self.polyco, template, display=False)
+
+    def compare(self, weighted, workers=1):
+        """ compare the results, and return the grid index of each call of profile_refine 
+            made by the process running get_toas_parallel
+        """
+        toas, err_toas, tim_strings = self.generator(weighted).get_toas(
+            toabinner.PrebinnedBinner(self.starts, self.stops))
+        calls = []
+        refine = toagen.profile_refine
+        def counted(f, cod, idx):
+            calls.append(idx)
+            return refine(f, cod, idx)
+        toagen.profile_refine = counted
+        try:
+            ptoas, perr_toas, ptim_strings = self.generator(weighted).get_toas_parallel(
+                toabinner.PrebinnedBinner(self.starts, self.stops), workers=workers)
+        finally:
+            toagen.profile_refine = refine
+        self.assertTrue(np.allclose(toas, ptoas, rtol=0, atol=1e-12))
+        self.assertTrue(np.allclose(err_toas, perr_toas, rtol=1e-9))
+        self.assertEqual(tim_strings, ptim_strings)
+        return calls
+
+    def test_refit(self):
+        """-->get_toas_parallel the same as get_toas; the second interval is refit"""
+        calls = self.compare(weighted=False)
+        self.assertEqual(len(self.centres)+1, len(calls))
+        self.assertEqual([25, 75], [calls[1], calls[-1]])
+
+    def test_weighted(self):
+        """-->get_toas_parallel the same as get_toas, for weighted photons"""
+        self.compare(weighted=True)
+
+    def test_pool(self):
+        """-->get_toas_parallel the same as get_toas, with the fits done by two processes"""
+        self.compare(weighted=False, workers=2)
+
+
+class DriftTemplate(lctemplate.LCTemplate):
+    """ a template whose peaks move with energy, by drift per decade """
+    drift = 0.02
+
+    def is_energy_dependent(self):
+        return True
+
+    def _evaluate(self, phases, log10_ens=3, suppress_bg=False, use_cache=False):
+        x = phases - self.drift*(np.asarray(log10_ens)-3)
+        return lctemplate.LCTemplate._evaluate(self, x, 3, suppress_bg)
+
+    def _gradient(self, phases, log10_ens=3, free=True):
+        x = phases - self.drift*(np.asarray(log10_ens)-3)
+        return lctemplate.LCTemplate._gradient(self, x, 3, free)
+
+
+class TestInterpolatedCache(unittest.TestCase):
+    """ values and gradients of a template with enable_cache, compared with the direct evaluation """
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.phases = rng.rand(2000)
+        self.log10_ens = rng.uniform(2, 4, 2000)
+
+    def two_gauss(self):
+        return lctemplate.get_gauss2(pulse_frac=0.9, width1=0.02, width2=0.03)
+
+    def close(self, a, b, tol=2e-3):
+        """ compare each row to tol times its maximum """
+        scale = np.abs(b).max(axis=-1)[...,None]
+        self.assertEqual(a.shape, b.shape)
+        self.assertTrue(np.all(np.abs(a-b) <= tol*scale),
+            msg='maximum relative difference %.3g' % (np.abs(a-b)/scale).max())
+
+    def check(self, t, log10_ens=3):
+        self.close(t(self.phases, log10_ens), t._evaluate(self.phases, log10_ens))
+        self.close(t.gradient(self.phases, log10_ens), t._gradient(self.phases, log10_ens))
+
+    def test_values(self):
+        """-->two gaussians: interpolated values and gradient"""
+        t = self.two_gauss()
+        t.enable_cache(nphase=2048)
+        self.check(t)
+
+    def test_energy(self):
+        """-->energy-dependent template: interpolated in phase and energy"""
+        g = self.two_gauss()
+        t = DriftTemplate(g.primitives, g.norms)
+        self.assertRaises(ValueError, t.enable_cache)
+        t.enable_cache(nphase=2048, log10_ens=np.linspace(2, 4, 41))
+        self.check(t, self.log10_ens)
+
+    def test_rebuild(self):
+        """-->the tables are remade for new parameters, overall phase, or free mask"""
+        t = self.two_gauss()
+        t.enable_cache(nphase=2048)
+        self.check(t)
+        p = t.get_parameters()
+        p[0] *= 1.2
+        t.set_parameters(p)
+        self.check(t)
+        t.set_overall_phase(0.3)
+        self.check(t)
+        t.primitives[0].free[0] = False
+        self.check(t)
+        t.norms.free[:] = False
+        self.check(t)
+
+    def test_clip(self):
+        """-->no negative values from the overshoot of a peak narrower than the grid"""
+        t = lctemplate.get_gauss1(pulse_frac=1, width1=0.002)
+        t.enable_cache(nphase=64)
+        x = np.linspace(0, 1, 10001)
+        self.assertTrue(np.all(t(x) >= 0))
+        interp = t._interp
+        self.assertTrue(interp._interpolate(interp.values, x, 3).min() < 0)
+
+def old_sums(phases, m, weights=None):
+    """ the cosine and sine sums, one harmonic at a time, as the statistics used before trig_moments """
+    phases = np.asarray(phases)*(2*np.pi)
+    w = 1. if weights is None else weights
+    c = np.asarray([(w*np.cos(k*phases)).sum() for k in xrange(1,m+1)])
+    s = np.asarray([(w*np.sin(k*phases)).sum() for k in xrange(1,m+1)])
+    return c, s
+
+def old_z2mw(phases, weights, m):
+    c, s = old_sums(phases, m, weights)
+    return np.cumsum(c**2+s**2) * (2./(weights**2).sum())
+
+def old_z2m(phases, m):
+    c, s = old_sums(phases, m)
+    return (2./len(phases))*np.cumsum(c**2+s**2)
+
+
+class TestStats(unittest.TestCase):
+    """ harmonic statistics from trig_moments, compared with the per-harmonic sums """
+    def setUp(self):
+        rng = np.random.RandomState(4)
+        # a pulsed signal in a uniform background, for three trials
+        self.phases = np.mod(np.append(rng.rand(3, 700), 0.3+0.05*rng.randn(3, 300), axis=1), 1)
+        self.weights = rng.rand(1000)
+
+    def close(self, a, b, tol=1e-10):
+        self.assertTrue(np.allclose(a, b, rtol=tol, atol=0), 
+            msg='maximum difference %.3g' % np.abs(np.asarray(a)-b).max())
+
+    def compare(self, func, ref, weighted):
+        """ compare func for the first trial, and for the batch, with ref for each trial """
+        w = (self.weights,) if weighted else ()
+        expect = [ref(ph, *w) for ph in self.phases]
+        self.close(func(self.phases[0], *w), expect[0])
+        self.close(func(self.phases, *w), expect)
+
+    def test_trig_moments(self):
+        """-->trig_moments, in blocks smaller than the data"""
+        for weights in (None, self.weights):
+            for chunk in (1000000, 999, 100):
+                c, s = stats.trig_moments(self.phases, 5, weights=weights, chunk=chunk)
+                self.assertEqual((3,5), c.shape)
+                for i, ph in enumerate(self.phases):
+                    rc, rs = old_sums(ph, 5, weights)
+                    self.close(c[i], rc); self.close(s[i], rs)
+
+    def test_z2m(self):
+        """-->z2m and z2mw"""
+        self.compare(lambda ph: stats.z2m(ph, m=10), lambda ph: old_z2m(ph, 10), False)
+        self.compare(lambda ph, w: stats.z2mw(ph, w, m=10), lambda ph, w: old_z2mw(ph, w, 10), True)
+
+    def test_hm(self):
+        """-->hm and hmw"""
+        offset = 4*np.arange(20)
+        self.compare(stats.hm, lambda ph: (old_z2m(ph, 20)-offset).max(), False)
+        self.compare(stats.hmw, lambda ph, w: (old_z2mw(ph, w, 20)-offset).max(), True)
+
+    def test_em_four(self):
+        """-->em_four"""
+        for weights in (None, self.weights):
+            a, b = stats.em_four(self.phases, m=6, weights=weights)
+            for i, ph in enumerate(self.phases):
+                n = len(ph) if weights is None else weights.sum()
+                rc, rs = old_sums(ph, 6, weights)
+                self.close(a[i], rc/n); self.close(b[i], rs/n)
+            a0, b0 = stats.em_four(self.phases[0], m=6, weights=weights)
+            self.close(a0, a[0]); self.close(b0, b[0])
+
+    def test_best_m(self):
+        """-->best_m"""
+        offset = 4*np.arange(30)
+        best = lambda z: np.arange(1, 31)[np.argmax(z-offset)]
+        ones = np.ones(self.phases.shape[-1])
+        for weights in (None, self.weights):
+            w = ones if weights is None else weights
+            expect = [best(old_z2mw(ph, w, 30)) for ph in self.phases]
+            self.assertEqual(expect, list(stats.best_m(self.phases, weights, m=30)))
+            self.assertEqual(expect[0], stats.best_m(self.phases[0], weights, m=30))
+
+class TestLCResampler(unittest.TestCase):
+    """ bootstrap and jackknife refits of a two-gaussian template """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.outfile = os.path.join(self.folder, 'boot.txt')
+        np.random.seed(5)
+        t = lctemplate.get_gauss2(pulse_frac=0.7, width1=0.02, width2=0.03)
+        phases = t.random(1000)
+        weights = np.random.uniform(0.3, 1, 1000)
+        self.fitter = lcfitters.LCFitter(t, phases, weights=weights)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def resampler(self, **kwargs):
+        return lcfitters.LCResampler(self.fitter, **kwargs)
+
+    def same(self, a, b):
+        self.assertEqual(a.shape, b.shape)
+        self.assertTrue(np.all((a==b) | (np.isnan(a) & np.isnan(b))))
+
+    def test_workers(self):
+        """-->the same bootstrap results from one or two processes"""
+        one = self.resampler(workers=1).bootstrap(6)
+        two = self.resampler(workers=2).bootstrap(6)
+        self.same(one, two)
+
+    def test_resume(self):
+        """-->an interrupted run resumed from its output file gives the same results"""
+        expect = self.resampler(workers=1).bootstrap(6)
+        self.resampler(workers=1, outfile=self.outfile).bootstrap(3)
+        r = self.resampler(workers=2, outfile=self.outfile)
+        self.same(expect, r.bootstrap(6))
+        self.assertEqual(6, len([line for line in open(self.outfile) if not line.startswith('#')]))
+
+    def test_header(self):
+        """-->resuming with another seed or method raises ValueError"""
+        self.resampler(workers=1, outfile=self.outfile).bootstrap(2)
+        self.assertRaises(ValueError, self.resampler(workers=1, seed=1, outfile=self.outfile).bootstrap, 2)
+        self.assertRaises(ValueError, self.resampler(workers=1, outfile=self.outfile).jackknife, 2)
+
+    def test_original(self):
+        """-->the phases, weights and template of the fitter are not changed"""
+        f = self.fitter
+        phases, weights, p = f.phases.copy(), f.weights.copy(), f.template.get_parameters().copy()
+        r = self.resampler(workers=2)
+        r.bootstrap(3)
+        r.jackknife(3)
+        self.assertTrue(np.all(f.phases==phases))
+        self.assertTrue(np.all(f.weights==weights))
+        self.assertTrue(np.all(f.template.get_parameters()==p))
+
+test_cases = (
+    TestPolyco,
+    TestTOAGenerator,
+    TestInterpolatedCache,
+    TestStats,
+    TestLCResampler,
+    )
+
+def run(t='all', loader=unittest.TestLoader(), debug=False):
+    if t=='all':
+        suite = unittest.TestSuite()
+        for test_class in test_cases:
+            suite.addTests(loader.loadTestsFromTestCase(test_class))
+    else:
+        suite = loader.loadTestsFromTestCase(t)
+    print 'running %d tests %s' % (suite.countTestCases(), 'in debug mode' if debug else '')
+    if debug:
+        suite.debug()
+    else:
+        unittest.TextTestRunner(stream=sys.stdout,verbosity=2).run(suite)
+
+if __name__=='__main__':
+    run()
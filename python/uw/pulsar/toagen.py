@@ -14,6 +14,7 @@ from scipy.optimize import fmin,golden,brentq
 from stats import hm,hmw,sf_hm
 from edf import EDF,find_alignment
 from collections import deque
+import multiprocessing
 
 try:
     import fftfit
@@ -30,6 +31,32 @@ except:
 
 SECSPERDAY = 86400.
 
+# the generator and time-sorted photons for the worker processes of
+# UnbinnedTOAGenerator.get_toas_parallel, set before the pool is forked
+_toa_generator = None
+_toa_photons = None
+
+def _interval_data(start,stop):
+    phases,weights = _toa_photons
+    return phases[start:stop],(None if weights is None else weights[start:stop])
+
+def _profile_interval(args):
+    """ Evaluate the likelihood profile for one interval in a worker."""
+    start,stop,nsamp = args
+    phases,weights = _interval_data(start,stop)
+    f = _toa_generator.__toa_loglikelihood__
+    return np.asarray([f([x],phases,weights) for x in np.linspace(0,1,nsamp+1)[:-1]])
+
+def _refine_interval(args):
+    """ Fit the phase shift of one interval in a worker; return tau,
+        tau_err, the minimum, and the H-test probability."""
+    start,stop,cod,idx = args
+    phases,weights = _interval_data(start,stop)
+    f = lambda x: _toa_generator.__toa_loglikelihood__([x],phases,weights)
+    tau,tau_err,fmin = profile_refine(f,cod,idx)[:3]
+    h = hm(phases) if (weights is None) else hmw(phases,weights)
+    return tau,tau_err,fmin,sf_hm(h)
+
 class TOAGenerator(object):
     """Manage a data set and set of options to produce the required TOAs from LAT events."""
 
@@ -60,19 +87,8 @@ class TOAGenerator(object):
 
         for ii,(mjdstart,mjdstop) in enumerate(binner):
 
-            # Compute freq and period at middle of observation
-            tmid = (mjdstop + mjdstart)/2.
-            pe   = self.polyco.getentry(tmid)
-            freq = pe.evalfreq(tmid)
-            period = 1.0/freq
-            if period < 0:
-                raise ValueError(
-                    'Something went horribly wrong with the folding period.')
-
-            # Compute phase at start of observation or at midpoint
-            phase_time = tmid if use_midpoint else mjdstart
-            pe = self.polyco.getentry(phase_time)
-            polyco_phase0 = pe.evalphase(phase_time)
+            phase_time,period,polyco_phase0,pe = \
+                self.interval_ephemeris(mjdstart,mjdstop,use_midpoint)
             
             # Select phases
             phases,weights = self.data.toa_data(mjdstart,mjdstop)
@@ -93,19 +109,8 @@ class TOAGenerator(object):
             rms = 0.
 
             # Prepare a string to write to a .tim file or to send to STDOUT
-            #print period
-            toa = phase_time + (tau*period)/SECSPERDAY
-            if tau_err < 100:
-                toa_err = tau_err*period*1.0e6
-            else:
-                toa_err = 1e7 # hard code to 10s errors for nondetections
-            frac_err = tau_err
-            frame_label = 'BAT' if self.data.bary else 'GEO'
-            weight_string = '' if (weights is None) else '-nwp %.2f'%(weights.sum())
-            duration_string = '-tstart %s -tstop %s'%(mjdstart,mjdstop)
-            rms_string = '-drms %.2f'%(rms)
-            logl_string = '-logl %.2f'%(logl)
-            s = " %s 0.0 %.12f %.2f %s -i LAT %s -np %d %s -chanceprob %.2e -pherr %.3f %s %s" % (frame_label,toa,toa_err,pe.obs,duration_string,len(phases),weight_string,prob,frac_err,rms_string,logl_string)
+            toa,toa_err,s = self.format_toa(mjdstart,mjdstop,phase_time,
+                period,pe,tau,tau_err,prob,logl,phases,weights,rms=rms)
             toas[ii] = toa
             err_toas[ii] = toa_err
             tim_strings.append(s)
@@ -129,6 +134,41 @@ class TOAGenerator(object):
         # Note TOAS in MJD, err_toas in microseconds, tim_strings a line for a FORMAT 1 .tim file
         return toas,err_toas,tim_strings
 
+    def interval_ephemeris(self,mjdstart,mjdstop,use_midpoint=True):
+        """ Return the reference time, folding period, polyco phase and
+            polyco entry for an interval."""
+        # Compute freq and period at middle of observation
+        tmid = (mjdstop + mjdstart)/2.
+        pe   = self.polyco.getentry(tmid)
+        freq = pe.evalfreq(tmid)
+        period = 1.0/freq
+        if period < 0:
+            raise ValueError(
+                'Something went horribly wrong with the folding period.')
+
+        # Compute phase at start of observation or at midpoint
+        phase_time = tmid if use_midpoint else mjdstart
+        pe = self.polyco.getentry(phase_time)
+        polyco_phase0 = pe.evalphase(phase_time)
+        return phase_time,period,polyco_phase0,pe
+
+    def format_toa(self,mjdstart,mjdstop,phase_time,period,pe,tau,tau_err,
+        prob,logl,phases,weights,rms=0.):
+        """ Return the TOA, its error, and the line for a .tim file."""
+        toa = phase_time + (tau*period)/SECSPERDAY
+        if tau_err < 100:
+            toa_err = tau_err*period*1.0e6
+        else:
+            toa_err = 1e7 # hard code to 10s errors for nondetections
+        frac_err = tau_err
+        frame_label = 'BAT' if self.data.bary else 'GEO'
+        weight_string = '' if (weights is None) else '-nwp %.2f'%(weights.sum())
+        duration_string = '-tstart %s -tstop %s'%(mjdstart,mjdstop)
+        rms_string = '-drms %.2f'%(rms)
+        logl_string = '-logl %.2f'%(logl)
+        s = " %s 0.0 %.12f %.2f %s -i LAT %s -np %d %s -chanceprob %.2e -pherr %.3f %s %s" % (frame_label,toa,toa_err,pe.obs,duration_string,len(phases),weight_string,prob,frac_err,rms_string,logl_string)
+        return toa,toa_err,s
+
 class UnbinnedTOAGenerator(TOAGenerator):
 
     def init(self):
@@ -255,6 +295,13 @@ class UnbinnedTOAGenerator(TOAGenerator):
         x0,x0_err,best_ll = profile_analysis(
             f,(phases,weights),pred_phase=seed,plot_output=plot_output,
             thresh=self.likelihood_threshold)
+        tau,tau_err = self.track_phase_shift(x0,x0_err,polyco_phase0)
+        h = hm(phases) if (weights is None) else hmw(phases,weights)
+        return tau,tau_err,sf_hm(h),best_ll
+
+    def track_phase_shift(self,x0,x0_err,polyco_phase0):
+        """ Update the tracked peak with a fitted position, and return the
+            phase shift relative to the polyco, and its error."""
         if x0_err < 1e2:
             self.prev_peak = x0
         else:
@@ -281,8 +328,132 @@ class UnbinnedTOAGenerator(TOAGenerator):
             print 'Peak Shift: %.5f +/- %.5f'%(peak_shift,tau_err)
         self.phases.append(peak_shift)
         self.phase_errs.append(tau_err)
-        h = hm(phases) if (weights is None) else hmw(phases,weights)
-        return tau,tau_err,sf_hm(h),best_ll
+        return tau,tau_err
+
+    def profile_grid(self,phases,weights,edges,nsamp=100,block=10):
+        """ Return an (intervals x nsamp) array of the negative log
+            likelihood of the phase shift, on a uniform grid, for the
+            intervals of the time-sorted photons given by the index
+            pairs in edges.
+            
+            Since changing the overall phase translates the template,
+            it is evaluated for all photons at once, at phases shifted
+            by each grid value in turn; the sum for each interval is the
+            difference of cumulative sums at its edges."""
+        dom = np.linspace(0,1,nsamp+1)[:-1]
+        shifts = dom - self.template.get_location()
+        starts,stops = np.asarray(edges).T
+        cod = np.empty((len(starts),nsamp))
+        for i in xrange(0,nsamp,block):
+            x = np.mod(phases-shifts[i:i+block,None],1)
+            t = self.template(x.ravel()).reshape(x.shape)
+            if weights is None:
+                logl = np.log(t)
+            else:
+                logl = np.log(1+weights*(t-1))
+            csum = np.zeros((len(t),len(phases)+1))
+            np.cumsum(logl,axis=1,out=csum[:,1:])
+            cod[:,i:i+block] = (csum[:,starts]-csum[:,stops]).T
+        return cod
+
+    def get_toas_parallel(self,binner,use_midpoint=True,workers=None,
+        nsamp=100):
+        """ Calculate the TOAs specified by the binner, as get_toas.
+
+            The photons are sorted by time once, and the intervals are
+            slices found with searchsorted.  The likelihood profiles of
+            all intervals are evaluated together, on a grid (with the
+            processes of a pool if the likelihood is not the basic one),
+            then the fits of the chosen peaks are done in parallel.  The
+            peak tracking from interval to interval is replayed in order,
+            and a peak refit if the tracked seed selects a different one,
+            so the results agree with those of get_toas to rounding: the
+            profiles are evaluated as differences of cumulative sums.
+
+            workers -- number of processes; if None, the number of CPUs
+        """
+        global _toa_generator,_toa_photons
+        if self.plot_stem is not None:
+            # the profile plots are made one at a time
+            return self.get_toas(binner,use_midpoint)
+        self.phases.clear(); self.phase_errs.clear()
+        self.counter = 0
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        # sort photons by time, and find the slices for the intervals
+        order = np.argsort(self.data.mjds,kind='mergesort')
+        mjds = self.data.mjds[order]
+        phases = self.data.ph[order]
+        weights = None if self.data.weights is None else self.data.weights[order]
+        intervals = list(binner)
+        mjdstarts,mjdstops = np.asarray(intervals,dtype=float).reshape(-1,2).T
+        starts = np.searchsorted(mjds,mjdstarts,side='left')
+        stops = np.searchsorted(mjds,mjdstops,side='left')
+        good = np.arange(len(intervals))[stops > starts]
+        edges = zip(starts[good],stops[good])
+
+        basic = (self.__toa_loglikelihood__.im_func is 
+            UnbinnedTOAGenerator.__toa_loglikelihood__.im_func)
+        _toa_generator,_toa_photons = self,(phases,weights)
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        try:
+            fmap = map if pool is None else pool.map
+            # (0) profiles for all intervals
+            if basic:
+                cods = self.profile_grid(phases,weights,edges,nsamp=nsamp)
+            else:
+                cods = fmap(_profile_interval,[e+(nsamp,) for e in edges])
+
+            # (1-4) choose the peaks, tracking the grid position
+            seeds = []
+            pred = self.prev_peak
+            for cod in cods:
+                seed = pred if self.good_ephemeris else None
+                idx,m2 = profile_select(cod,seed,self.likelihood_threshold)
+                x0 = np.linspace(0,1,nsamp+1)[idx]
+                x0_err = profile_check(x0,0,m2,seed)[1]
+                if x0_err < 1e2: pred = x0
+                seeds.append(idx)
+
+            # (5-7) fit the peaks
+            fits = fmap(_refine_interval,
+                [e+(cod,idx) for e,cod,idx in zip(edges,cods,seeds)])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _toa_generator = _toa_photons = None
+
+        toas = np.empty(binner.ntoa)
+        err_toas = np.empty(binner.ntoa)
+        tim_strings = ['FORMAT 1']
+        for ii,(start,stop),cod,idx,fit in zip(good,edges,cods,seeds,fits):
+            mjdstart,mjdstop = intervals[ii]
+            phase_time,period,polyco_phase0,pe = \
+                self.interval_ephemeris(mjdstart,mjdstop,use_midpoint)
+            ph = phases[start:stop]
+            w = None if weights is None else weights[start:stop]
+
+            # replay the tracking with the fitted positions
+            seed = self.prev_peak if self.good_ephemeris else None
+            idx2,m2 = profile_select(cod,seed,self.likelihood_threshold)
+            x0,x0_err,logl,prob = fit
+            if idx2 != idx:
+                f = lambda x: self.__toa_loglikelihood__([x],ph,w)
+                x0,x0_err,logl = profile_refine(f,cod,idx2)[:3]
+            x0,x0_err = profile_check(x0,x0_err,m2,seed)
+            tau,tau_err = self.track_phase_shift(x0,x0_err,polyco_phase0)
+            self.mean_err = (self.mean_err*ii + tau_err)/(ii+1)
+
+            toa,toa_err,s = self.format_toa(mjdstart,mjdstop,phase_time,
+                period,pe,tau,tau_err,prob,logl,ph,w)
+            toas[ii] = toa
+            err_toas[ii] = toa_err
+            tim_strings.append(s)
+            self.counter += 1
+
+        return toas,err_toas,tim_strings
 
 class UnbinnedTOAGeneratorF0Search(UnbinnedTOAGenerator):
 
@@ -394,6 +565,10 @@ class UnbinnedTOAGeneratorF0Search(UnbinnedTOAGenerator):
         # Note TOAS in MJD, err_toas in microseconds, tim_strings a line for a FORMAT 1 .tim file
         return toas,err_toas,tim_strings
 
+    def get_toas_parallel(self,binner,use_midpoint=True,**kwargs):
+        """ The F0 grid depends on the interval, so use get_toas."""
+        return self.get_toas(binner,use_midpoint)
+
 class UnbinnedTOAGeneratorProfileAmplitude(UnbinnedTOAGenerator):
 
     def init(self):
@@ -570,13 +745,12 @@ class EDFTOAGenerator(TOAGenerator):
         #tau_err = 0.02
         return peak_shift-polyco_phase0,tau_err,sf_hm(hm(phases)),0
 
-def profile_analysis(logl,logl_args,pred_phase=None,nsamp=100,thresh=5,
-    plot_output=None,max_jump=0.25):
-
-    # (0) establish profile
-    f = lambda x: logl([x],*logl_args)
+def profile_select(cod,pred_phase=None,thresh=5):
+    """ Choose the local minimum of a likelihood profile, sampled on a
+        uniform phase grid, to take as the TOA.  Return the index into
+        the grid, and the mask of minima which pass the threshold."""
+    nsamp = len(cod)
     dom = np.linspace(0,1,nsamp+1)[:-1]
-    cod = np.asarray(map(f,dom))
 
     # (1) find all local minima
     mask = (cod < np.roll(cod,1)) & (cod < np.roll(cod,-1))
@@ -601,6 +775,15 @@ def profile_analysis(logl,logl_args,pred_phase=None,nsamp=100,thresh=5,
     else:
         idx = np.argmin(cod[mask])
     idx = np.arange(nsamp)[mask][idx] # index into main array
+    return idx,m2
+
+def profile_refine(f,cod,idx):
+    """ Find the minimum of f, the negative log likelihood as a function
+        of phase, near the grid point idx of the profile cod, and the
+        interval where it increases by 2.  Return tau, tau_err, the
+        minimum, and the minimum position and interval limits."""
+    nsamp = len(cod)
+    dom = np.linspace(0,1,nsamp+1)[:-1]
 
     # TODO -- something more sophisticated for 0.5 aliasing -- perhaps
     # allow less significant peaks... or possibly "search" at half the
@@ -641,6 +824,33 @@ def profile_analysis(logl,logl_args,pred_phase=None,nsamp=100,thresh=5,
     # (7) construct TOA as the mean of the error positions
     tau = (rt+lt)/2 + phi0
     tau_err = (rt-lt)/4 # by 2 for average, by 2 again for 2->1 sigma
+    return tau,tau_err,fmin,phi0,rt,lt
+
+def profile_check(tau,tau_err,m2,pred_phase=None,max_jump=0.25):
+    """ Flag nondetections and jumps from the predicted phase."""
+    if (m2.sum() == 0):
+        tau_err = 100
+    # this is to catch aliases and prevent following TOAs from having
+    # incorrect seed phase
+    if pred_phase is not None:
+        diff = abs(tau-pred_phase)
+        diff = min(diff,1.-diff)
+        if diff > max_jump:
+            tau_err = 100
+            tau = pred_phase
+    return tau,tau_err
+
+def profile_analysis(logl,logl_args,pred_phase=None,nsamp=100,thresh=5,
+    plot_output=None,max_jump=0.25):
+
+    # (0) establish profile
+    f = lambda x: logl([x],*logl_args)
+    dom = np.linspace(0,1,nsamp+1)[:-1]
+    cod = np.asarray(map(f,dom))
+
+    # (1-4) choose the peak, (5-7) and fit it
+    idx,m2 = profile_select(cod,pred_phase,thresh)
+    tau,tau_err,fmin,phi0,rt,lt = profile_refine(f,cod,idx)
 
     if plot_output is not None:
         pl.rcParams['xtick.labelsize'] = 'large'
@@ -690,15 +900,6 @@ def profile_analysis(logl,logl_args,pred_phase=None,nsamp=100,thresh=5,
         ax2.set_ylabel('Rel. Log Likelihood',size='large')
         pl.savefig(plot_output)
 
-    if (m2.sum() == 0):
-        tau_err = 100
-    # this is to catch aliases and prevent following TOAs from having
-    # incorrect seed phase
-    if pred_phase is not None:
-        diff = abs(tau-pred_phase)
-        diff = min(diff,1.-diff)
-        if diff > max_jump:
-            tau_err = 100
-            tau = pred_phase
+    tau,tau_err = profile_check(tau,tau_err,m2,pred_phase,max_jump)
     return tau,tau_err,fmin
 
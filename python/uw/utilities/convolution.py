@@ -13,8 +13,62 @@ from scipy.integrate import quad,romberg,cumtrapz
 from scipy.special import hyp2f1
 from uw.like.pypsf import BandCALDBPsf,PretendBand
 from uw.like.SpatialModels import SpatialMap
-from numpy.fft import fftshift,ifft2,fft2
+from numpy.fft import fftshift,ifft2,fft2,rfft2,irfft2
+import collections, hashlib
 import keyword_options
+try:
+    # optional: multithreaded FFTs
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft as fftw
+    pyfftw.interfaces.cache.enable()
+except ImportError:
+    fftw = None
+
+fft_threads = 1 # number of threads for FFTs, if pyfftw is available
+
+def real_fft2(a):
+    if fftw is not None and fft_threads>1:
+        return fftw.rfft2(a, threads=fft_threads)
+    return rfft2(a)
+
+def real_ifft2(a, shape):
+    if fftw is not None and fft_threads>1:
+        return fftw.irfft2(a, s=shape, threads=fft_threads)
+    return irfft2(a, s=shape)
+
+class KernelCache(object):
+    """ Process-wide cache of the Fourier transforms of PSF grids.
+    The PSF grid for a band depends only on the event type, energy and the grid geometry, so the 
+    same kernel is used for all diffuse sources and ROIs. The key is a digest of the values.
+    """
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    def __repr__(self):
+        return '%s.%s: %d/%d entries, %d hits, %d misses' % (self.__module__, self.__class__.__name__,
+            len(self.entries), self.maxsize, self.hits, self.misses)
+
+    def __call__(self, psf_vals):
+        """ return the real FFT of the 2-d array psf_vals """
+        psf_vals = np.ascontiguousarray(psf_vals)
+        key = (psf_vals.shape, hashlib.md5(psf_vals.view(np.uint8)).hexdigest())
+        ft = self.entries.pop(key, None)
+        if ft is None:
+            self.misses += 1
+            ft = real_fft2(psf_vals)
+            if len(self.entries)>=self.maxsize:
+                self.entries.popitem(last=False)
+        else:
+            self.hits += 1
+        self.entries[key] = ft
+        return ft
+
+kernel_cache = KernelCache()
 
 ### TODO -- find a way to evaluate the PSF on a finer grid ###
 
@@ -207,9 +261,10 @@ class BackgroundConvolution(Grid):
     def convolve(self):
         """ Perform the convolution with the current values of the bg
             and psf evaluated over the grid."""
-        fft_kernel = fft2(self.psf_vals)
-        fft_image  = fft2(self.bg_vals)
-        self.cvals = c = np.real(fftshift(ifft2(fft_kernel*fft_image)))
+        # real transforms: the kernel transform is shared by all grids with the same PSF values
+        fft_kernel = kernel_cache(self.psf_vals)
+        fft_image  = real_fft2(self.bg_vals)
+        self.cvals = c = fftshift(real_ifft2(fft_kernel*fft_image, self.bg_vals.shape))
 
         # swap the 0th component into the proper place
         new = np.empty_like(c)